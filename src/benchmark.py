@@ -0,0 +1,485 @@
+# This script benchmarks the API in-process. It builds the app with create_app(), seeds a synthetic school of the requested size and then replays a weighted mix of requests against the blueprints through the Flask test client. For each route it reports the p50/p95/p99 latency, the number of SQL queries and commits per request and the status codes returned, along with the overall requests per second and the peak memory (RSS) of the process.
+# The results are written to a JSON file with sorted keys so two runs can be diffed, or passed back in with --baseline to print the change for each route. For example:
+#   python benchmark.py --students 5000 --requests 5000 --output before.json
+#   python benchmark.py --students 5000 --requests 5000 --output after.json --baseline before.json
+# --compiled-serializers runs the mix with COMPILED_SERIALIZERS turned on and --verify-serializers checks that every schema used during the run produces byte-identical JSON with the compiled and the marshmallow dump (and times both). The script exits with an error if any output differs.
+# --compare-json encodes a few large payloads from the seeded data (every student, every enrollment and the class rosters) with Flask's standard library JSON provider and with the orjson provider, checks they decode to the same values and times both.
+# --rush N also sends N enrollments for the same class at once from N threads (like the first minutes of subject selection) and checks that the class never goes over its max_students and that its enrollment_count matches its enrollments.
+# --verify-timetables checks after the run that the timetable_mask stored for every student matches the lines of the classes they are enrolled in, and exits with an error if any don't.
+# By default a temporary SQLite database is used. Set DATABASE_URL to benchmark against PostgreSQL instead (the tables in that database are dropped and recreated).
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the API with a weighted mix of requests.')
+    parser.add_argument('--students', type=int, default=2000, help='students in the seeded school')
+    parser.add_argument('--employees', type=int, default=150, help='employees in the seeded school')
+    parser.add_argument('--subjects', type=int, default=36, help='subjects in the seeded school')
+    parser.add_argument('--requests', type=int, default=2000, help='requests to replay (after the warm up)')
+    parser.add_argument('--warmup', type=int, default=100, help='requests to replay before measuring')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the data and the request mix')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the results to')
+    parser.add_argument('--baseline', help='a previous results file to compare against')
+    parser.add_argument('--compiled-serializers', action='store_true', help='run the mix with COMPILED_SERIALIZERS turned on')
+    parser.add_argument('--verify-serializers', action='store_true', help='check the compiled serializers against marshmallow for every schema used')
+    parser.add_argument('--compare-json', action='store_true', help='compare the standard library and orjson JSON providers on the seeded data')
+    parser.add_argument('--rush', type=int, default=0, help='students enrolling in one class at the same time (0 to skip)')
+    parser.add_argument('--profile-sample-rate', type=int, default=0, help='profile one in this many requests during the run, to measure what sampling costs (0 to skip)')
+    parser.add_argument('--verify-metrics', action='store_true', help='check that /metrics counted every request sent during the run (and the rush)')
+    parser.add_argument('--deletes', action='store_true', help='after the run, delete the subject with the most enrollments and the one with the fewest and compare how long they take')
+    parser.add_argument('--verify-timetables', action='store_true', help="check every student's stored timetable_mask against their enrollments after the run")
+    return parser.parse_args()
+
+
+# Returns the value at the given percentile (0-100) of a sorted list using the nearest rank method.
+def percentile(values, pct):
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarise(latencies, queries, commits=()):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else None,
+        'p50_ms': round(percentile(latencies, 50), 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 3) if latencies else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'max_queries': max(queries) if queries else None,
+        'commits_per_request': round(sum(commits) / len(commits), 2) if commits else None
+    }
+
+
+class Benchmark:
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.client = app.test_client()
+        self.query_count = 0
+        self.commit_count = 0
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.commits = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.created_enrollments = []
+        self.registrations = itertools.count() # Gives each registered user a new email
+
+    # Loads the ids the request mix picks from and logs in as the generated admin, a teacher and a student.
+    def prepare(self):
+        from sqlalchemy import event
+        from init import db
+        from models.user import User
+        from models.student import Student
+        from models.employee import Employee
+        from models.subject import Subject
+        from models.subject_class import SubjectClass
+        from models.enrollment import Enrollment
+        from models.address import Address
+        from synthetic import SYNTHETIC_PASSWORD
+
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._count_query)
+            event.listen(db.engine, 'commit', self._count_commit)
+            self.user_ids = list(db.session.scalars(db.select(User.id)))
+            self.student_ids = list(db.session.scalars(db.select(Student.id)))
+            self.employee_ids = list(db.session.scalars(db.select(Employee.id)))
+            self.subject_ids = list(db.session.scalars(db.select(Subject.id)))
+            self.class_ids = list(db.session.scalars(db.select(SubjectClass.id)))
+            self.enrollment_ids = list(db.session.scalars(db.select(Enrollment.id)))
+            self.address_ids = list(db.session.scalars(db.select(Address.id)))
+            admin_email = db.session.scalar(db.select(User.email).join(Employee).where(Employee.is_admin == True).order_by(Employee.id))
+            teacher_email = db.session.scalar(db.select(User.email).join(Employee).where(Employee.is_admin == False).order_by(Employee.id))
+            student_email = db.session.scalar(db.select(User.email).join(Student).order_by(Student.id))
+        self.password = SYNTHETIC_PASSWORD
+        self.login_emails = [admin_email, teacher_email, student_email]
+        self.admin = self._login(admin_email)
+
+    def _count_query(self, *args):
+        self.query_count += 1
+
+    def _count_commit(self, *args):
+        self.commit_count += 1
+
+    def _login(self, email):
+        response = self.client.post('/auth/login/', json={'email': email, 'password': self.password})
+        return {'Authorization': f"Bearer {response.json['token']}"}
+
+    # The weighted request mix. Each entry is (weight, route name, function returning the request to send).
+    def mix(self):
+        pick = self.rng.choice
+        return [
+            (5, 'POST /auth/login/', lambda: ('POST', '/auth/login/', {'json': {'email': pick(self.login_emails), 'password': self.password}})),
+            (5, 'GET /users/', lambda: ('GET', '/users/', {})),
+            (5, 'GET /users/<id>', lambda: ('GET', f'/users/{pick(self.user_ids)}', {})),
+            (3, 'PATCH /users/<id>/', lambda: ('PATCH', f'/users/{pick(self.user_ids)}/', {'json': {'phone': '04' + str(self.rng.randrange(10 ** 8)).zfill(8)}})),
+            (10, 'GET /students/', lambda: ('GET', '/students/', {})),
+            (8, 'GET /students/<id>/', lambda: ('GET', f'/students/{pick(self.student_ids)}/', {})),
+            (3, 'PATCH /students/<id>/', lambda: ('PATCH', f'/students/{pick(self.student_ids)}/', {'json': {'homegroup': 'WH01', 'year_level': self.rng.randint(7, 12)}})),
+            (3, 'GET /students/relations/', lambda: ('GET', '/students/relations/', {})),
+            (3, 'GET /students/<id>/timetable', lambda: ('GET', f'/students/{pick(self.student_ids)}/timetable', {})),
+            (2, 'GET /timetables/', lambda: ('GET', f'/timetables/?year_level={self.rng.randint(7, 12)}', {})),
+            (3, 'GET /employees/', lambda: ('GET', '/employees/', {})),
+            (3, 'GET /employees/<id>/', lambda: ('GET', f'/employees/{pick(self.employee_ids)}/', {})),
+            (8, 'GET /subjects/', lambda: ('GET', '/subjects/', {})),
+            (5, 'GET /subjects/<id>/', lambda: ('GET', f'/subjects/{pick(self.subject_ids)}/', {})),
+            (1, 'PATCH /subjects/<id>/', lambda: ('PATCH', f'/subjects/{pick(self.subject_ids)}/', {'json': {'department': pick(['Science', 'Humanities', 'Business'])}})),
+            (5, 'GET /subjects/classes/', lambda: ('GET', '/subjects/classes/', {})),
+            (5, 'GET /subjects/classes/<id>/', lambda: ('GET', f'/subjects/classes/{pick(self.class_ids)}/', {})),
+            (10, 'GET /enrollments/', lambda: ('GET', '/enrollments/', {})),
+            (5, 'GET /enrollments/<id>/', lambda: ('GET', f'/enrollments/{pick(self.enrollment_ids)}/', {})),
+            (4, 'POST /enrollments/', lambda: ('POST', '/enrollments/', {'json': {'student_id': pick(self.student_ids), 'subject_class_id': pick(self.class_ids), 'date': date.today().isoformat()}})),
+            (4, 'DELETE /enrollments/<id>/', self._delete_enrollment),
+            (2, 'GET /exports/roster.csv', lambda: ('GET', f'/exports/roster.csv?year_level={self.rng.randint(7, 12)}', {})),
+            (1, 'POST /auth/register', self._register),
+            (3, 'GET /addresses/', lambda: ('GET', '/addresses/', {})),
+            (3, 'GET /addresses/<id>', lambda: ('GET', f'/addresses/{pick(self.address_ids)}', {}))
+        ]
+
+    # Registers a new user at a new address, which are written in the same transaction.
+    def _register(self):
+        user = {'title': 'Ms', 'first_name': 'Bench', 'middle_name': 'Mark', 'last_name': 'User', 'password': self.password, 'email': f'benchmark.{next(self.registrations)}@example.com', 'phone': '0400000000', 'dob': '1980-01-01', 'gender': 'female'}
+        return 'POST', '/auth/register', {'json': {'street_number': 1, 'street_name': 'Benchmark Street', 'suburb': 'Toowong', 'postcode': 4066, 'users': [user]}}
+
+    # Enrollments created by the benchmark are deleted first so the size of the school stays the same during the run.
+    def _delete_enrollment(self):
+        if self.created_enrollments:
+            enrollment_id = self.created_enrollments.pop(self.rng.randrange(len(self.created_enrollments)))
+        else:
+            enrollment_id = self.enrollment_ids.pop(self.rng.randrange(len(self.enrollment_ids)))
+        return 'DELETE', f'/enrollments/{enrollment_id}/', {}
+
+    def send(self, name, method, url, kwargs, record=True):
+        headers = kwargs.pop('headers', self.admin)
+        self.query_count = 0
+        self.commit_count = 0
+        start = time.perf_counter()
+        response = self.client.open(url, method=method, headers=headers, **kwargs)
+        elapsed = (time.perf_counter() - start) * 1000
+        if name == 'POST /enrollments/' and response.status_code == 201:
+            self.created_enrollments.append(response.json['id'])
+        if record:
+            self.latencies[name].append(elapsed)
+            self.queries[name].append(self.query_count)
+            self.commits[name].append(self.commit_count)
+            self.statuses[name][str(response.status_code)] += 1
+        return response
+
+    def run(self):
+        mix = self.mix()
+        weights = [weight for weight, _, _ in mix]
+        for i in range(self.args.warmup + self.args.requests):
+            _, name, build = self.rng.choices(mix, weights)[0]
+            method, url, kwargs = build()
+            self.send(name, method, url, kwargs, record=i >= self.args.warmup)
+
+    # Sends one enrollment per student for the same class from separate threads, all released at the same moment. Exactly max_students of them should succeed and the rest should be rejected with a 409.
+    def rush(self, students):
+        from sqlalchemy import func
+        from init import db
+        from models.subject_class import SubjectClass
+        from models.enrollment import Enrollment
+
+        with self.app.app_context():
+            subject_class = db.session.get(SubjectClass, self.class_ids[0])
+            subject_class.subject.max_students = subject_class.enrollment_count + max(1, students // 4) # Leave room for a quarter of the rush
+            capacity = subject_class.subject.max_students
+            class_id = subject_class.id
+            enrolled = set(db.session.scalars(db.select(Enrollment.student_id).where(Enrollment.subject_class_id == class_id)))
+            db.session.commit()
+        student_ids = [student_id for student_id in self.student_ids if student_id not in enrolled][:students]
+        barrier = threading.Barrier(len(student_ids))
+        statuses = defaultdict(int)
+        latencies = []
+        lock = threading.Lock()
+
+        def enroll(student_id):
+            client = self.app.test_client()
+            barrier.wait()
+            start = time.perf_counter()
+            response = client.post('/enrollments/', headers=self.admin, json={'student_id': student_id, 'subject_class_id': class_id, 'date': date.today().isoformat()})
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[str(response.status_code)] += 1
+
+        threads = [threading.Thread(target=enroll, args=(student_id,)) for student_id in student_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with self.app.app_context():
+            counted = db.session.scalar(db.select(func.count()).select_from(Enrollment).where(Enrollment.subject_class_id == class_id))
+            enrollment_count = db.session.scalar(db.select(SubjectClass.enrollment_count).where(SubjectClass.id == class_id))
+        return dict(summarise(latencies, []), **{
+            'class': class_id,
+            'max_students': capacity,
+            'enrolled': counted,
+            'enrollment_count': enrollment_count,
+            'statuses': dict(statuses),
+            'ok': counted == enrollment_count == min(capacity, len(enrolled) + len(student_ids))
+        })
+
+    # Returns the total of http_requests_total from /metrics, and how long the scrape took. The scrape itself is counted in the next one.
+    def scrape_requests(self):
+        start = time.perf_counter()
+        response = self.client.get('/metrics')
+        elapsed = (time.perf_counter() - start) * 1000
+        total = sum(float(line.rsplit(' ', 1)[1]) for line in response.get_data(as_text=True).splitlines() if line.startswith('http_requests_total{'))
+        return int(total), elapsed
+
+    # Deletes the subject with the fewest enrollments and then the one with the most. The database removes their classes and enrollments (ON DELETE CASCADE), so both should take about the same time and number of queries. Afterwards no enrollments may be left without a class and every class's enrollment_count must still match its enrollments.
+    def deletes(self):
+        from sqlalchemy import func
+        from init import db
+        from models.subject_class import SubjectClass
+        from models.enrollment import Enrollment
+
+        with self.app.app_context():
+            counts = db.session.execute(db.select(SubjectClass.subject_id, func.count(Enrollment.id)).outerjoin(Enrollment, Enrollment.subject_class_id == SubjectClass.id).group_by(SubjectClass.subject_id).order_by(func.count(Enrollment.id), SubjectClass.subject_id)).all()
+        report = {}
+        for label, (subject_id, enrollments) in (('fewest', counts[0]), ('most', counts[-1])):
+            self.query_count = 0
+            start = time.perf_counter()
+            response = self.client.delete(f'/subjects/{subject_id}/', headers=self.admin)
+            report[label] = {'subject': subject_id, 'enrollments': enrollments, 'status': response.status_code, 'ms': round((time.perf_counter() - start) * 1000, 3), 'queries': self.query_count}
+
+        with self.app.app_context():
+            orphaned = db.session.scalar(db.select(func.count()).select_from(Enrollment).where(~Enrollment.subject_class_id.in_(db.select(SubjectClass.id))))
+            counted = db.select(func.count()).where(Enrollment.subject_class_id == SubjectClass.id).scalar_subquery()
+            miscounted = db.session.scalar(db.select(func.count()).select_from(SubjectClass).where(SubjectClass.enrollment_count != counted))
+        report.update(orphaned=orphaned, miscounted=miscounted, ok=not orphaned and not miscounted and all(report[label]['status'] == 200 for label in ('fewest', 'most')))
+        return report
+
+    # Compares the timetable_mask kept for each student with the one calculated from their enrollments.
+    def verify_timetables(self):
+        from init import db
+        from models.student import Student, timetable_summaries
+
+        with self.app.app_context():
+            stored = dict(db.session.execute(db.select(Student.id, Student.timetable_mask)).all())
+            calculated = timetable_summaries(list(stored))
+        mismatched = [student_id for student_id, mask in stored.items() if calculated[student_id]['timetable_mask'] != mask]
+        return {
+            'students': len(stored),
+            'clashing': sum(1 for summary in calculated.values() if summary['clashes']),
+            'mismatched': mismatched[:20],
+            'ok': not mismatched
+        }
+
+    # Dumps a sample of rows with every schema the routes used during the run, once with marshmallow and once with the compiled serializer, and compares the JSON they produce byte for byte.
+    def verify_serializers(self, sample=200, repeat=5):
+        from init import db
+        from loading import loading_plan
+        from schemas import _schemas, compiled_dump
+
+        report = {}
+        with self.app.app_context():
+            models = {mapper.class_.__name__: mapper.class_ for mapper in db.Model.registry.mappers}
+            for (schema_class, many, only, exclude), schema in list(_schemas.items()):
+                model = models.get(schema_class.__name__[:-len('Schema')])
+                if model is None:
+                    continue
+                rows = list(db.session.scalars(db.select(model).limit(sample).options(*loading_plan(model, schema))).unique())
+                dump_one = compiled_dump(schema)
+                timings = {}
+                outputs = {}
+                for name, dump in (('marshmallow', lambda: schema.dump(rows) if many else [schema.dump(row) for row in rows]), ('compiled', lambda: [dump_one(row) for row in rows])):
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        data = dump()
+                    timings[name] = (time.perf_counter() - start) * 1000 / repeat
+                    outputs[name] = self.app.json.dumps(data)
+                label = f"{schema_class.__name__}(many={many}, only={list(only) if only else None}, exclude={list(exclude)})"
+                report[label] = {
+                    'rows': len(rows),
+                    'identical': outputs['marshmallow'] == outputs['compiled'],
+                    'marshmallow_ms': round(timings['marshmallow'], 3),
+                    'compiled_ms': round(timings['compiled'], 3)
+                }
+        return report
+
+    # Encodes large payloads built from the seeded data with each JSON provider. The outputs must decode to the same values.
+    def compare_json(self, repeat=5):
+        import json
+        from flask.json.provider import DefaultJSONProvider
+        from init import db
+        from loading import loading_plan
+        from schemas import get_schema
+        from json_provider import OrjsonProvider, orjson
+        from models.student import Student, StudentSchema
+        from models.enrollment import Enrollment, EnrollmentSchema
+        from models.subject_class import SubjectClass, SubjectClassSchema
+
+        providers = {'json': DefaultJSONProvider(self.app)}
+        if orjson is not None:
+            providers['orjson'] = OrjsonProvider(self.app)
+        report = {}
+        with self.app.app_context(), self.app.test_request_context():
+            payloads = {}
+            for name, model, schema in (('students', Student, get_schema(StudentSchema, many=True)), ('enrollments', Enrollment, get_schema(EnrollmentSchema, many=True)), ('class rosters', SubjectClass, get_schema(SubjectClassSchema, many=True))):
+                rows = db.session.scalars(db.select(model).options(*loading_plan(model, schema))).unique().all()
+                payloads[name] = schema.dump(rows)
+            payloads['dates'] = [{'dob': date(2008, 1, 1), 'enrollment_date': date.today()}] * 1000 # Raw dates are encoded as HTTP dates by both providers
+            for name, payload in payloads.items():
+                report[name] = {}
+                decoded = None
+                for provider_name, provider in providers.items():
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        body = provider.response(payload).get_data()
+                    elapsed = (time.perf_counter() - start) * 1000 / repeat
+                    value = json.loads(body)
+                    report[name][provider_name] = {'ms': round(elapsed, 3), 'bytes': len(body)}
+                    report[name]['identical'] = decoded is None or value == decoded
+                    decoded = decoded if decoded is not None else value
+        return report
+
+    def results(self, seconds):
+        all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+        all_queries = [count for counts in self.queries.values() for count in counts]
+        all_commits = [count for counts in self.commits.values() for count in counts]
+        routes = {}
+        for name in self.latencies:
+            routes[name] = summarise(self.latencies[name], self.queries[name], self.commits[name])
+            routes[name]['statuses'] = dict(self.statuses[name])
+        return {
+            'meta': {
+                'students': self.args.students,
+                'employees': self.args.employees,
+                'subjects': self.args.subjects,
+                'requests': self.args.requests,
+                'seed': self.args.seed,
+                'compiled_serializers': self.app.config['COMPILED_SERIALIZERS'],
+                'profile_sample_rate': self.app.config['PROFILE_SAMPLE_RATE'],
+                'json_provider': type(self.app.json).__name__,
+                'database': self.app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+                'python': platform.python_version()
+            },
+            'overall': dict(summarise(all_latencies, all_queries, all_commits), seconds=round(seconds, 3), requests_per_second=round(len(all_latencies) / seconds, 1)),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # ru_maxrss is in kilobytes on Linux
+            'routes': routes
+        }
+
+
+# Prints the change in p50/p95 latency and queries per request for every route compared to an earlier results file.
+def compare(results, baseline_path):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    print(f"\n{'route':32} {'p50 ms':>18} {'p95 ms':>18} {'queries':>14}")
+    for name, route in sorted(results['routes'].items()):
+        before = baseline['routes'].get(name)
+        if not before:
+            continue
+        print(f"{name:32} {before['p50_ms']:>8} -> {route['p50_ms']:<8} {before['p95_ms']:>8} -> {route['p95_ms']:<8} {before['queries_per_request']:>5} -> {route['queries_per_request']:<5}")
+    print(f"{'requests/sec':32} {baseline['overall']['requests_per_second']} -> {results['overall']['requests_per_second']}")
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark')
+    if args.compiled_serializers:
+        os.environ['COMPILED_SERIALIZERS'] = 'true'
+    if args.profile_sample_rate:
+        os.environ['PROFILE_SAMPLE_RATE'] = str(args.profile_sample_rate)
+        os.environ['PROFILE_DIR'] = tempfile.mkdtemp()
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from main import create_app
+    from init import db
+    from synthetic import seed_synthetic
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all(bind_key=None)
+        db.create_all(bind_key=None)
+        print('Seeding:', seed_synthetic(args.students, args.employees, args.subjects, seed=args.seed))
+
+    benchmark = Benchmark(app, args)
+    benchmark.prepare()
+    if args.verify_metrics:
+        counted_before, _ = benchmark.scrape_requests()
+    start = time.perf_counter()
+    benchmark.run()
+    results = benchmark.results(time.perf_counter() - start)
+    if args.verify_serializers:
+        results['serializers'] = benchmark.verify_serializers()
+    if args.compare_json:
+        results['json_providers'] = benchmark.compare_json()
+    if args.rush:
+        results['rush'] = benchmark.rush(args.rush)
+    if args.verify_metrics:
+        counted, scrape_ms = benchmark.scrape_requests()
+        expected = args.warmup + args.requests + args.rush + 1 # The first scrape is counted too
+        results['metrics'] = {'counted': counted - counted_before, 'expected': expected, 'scrape_ms': round(scrape_ms, 3), 'ok': counted - counted_before == expected}
+    if args.deletes:
+        results['deletes'] = benchmark.deletes()
+    if args.verify_timetables:
+        results['timetables'] = benchmark.verify_timetables()
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print(f"{'route':32} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'commits':>8}")
+    for name, route in sorted(results['routes'].items()):
+        print(f"{name:32} {route['count']:>6} {route['p50_ms']:>9} {route['p95_ms']:>9} {route['p99_ms']:>9} {route['queries_per_request']:>8} {route['commits_per_request']:>8}")
+    overall = results['overall']
+    print(f"\n{overall['count']} requests in {overall['seconds']}s ({overall['requests_per_second']} requests/sec), peak RSS {results['peak_rss_mb']} MB. Results written to {args.output}")
+    if 'serializers' in results:
+        print(f"\n{'schema':100} {'rows':>5} {'marshmallow ms':>15} {'compiled ms':>12}")
+        for label, check in sorted(results['serializers'].items()):
+            print(f"{label:100} {check['rows']:>5} {check['marshmallow_ms']:>15} {check['compiled_ms']:>12} {'' if check['identical'] else 'OUTPUT DIFFERS'}")
+    if 'json_providers' in results:
+        print(f"\n{'payload':16} {'json ms':>9} {'orjson ms':>10} {'bytes':>10}")
+        for name, check in results['json_providers'].items():
+            orjson_ms = check['orjson']['ms'] if 'orjson' in check else 'n/a'
+            print(f"{name:16} {check['json']['ms']:>9} {orjson_ms:>10} {check['json']['bytes']:>10} {'' if check['identical'] else 'OUTPUT DIFFERS'}")
+    if 'rush' in results:
+        rush = results['rush']
+        print(f"\nRush of {args.rush} enrollments into {rush['class']}: {rush['enrolled']} enrolled (max_students {rush['max_students']}, enrollment_count {rush['enrollment_count']}), statuses {rush['statuses']}, p95 {rush['p95_ms']} ms. {'OK' if rush['ok'] else 'FAILED: the class went over capacity or its count is wrong'}")
+    if 'metrics' in results:
+        checked = results['metrics']
+        print(f"\n/metrics counted {checked['counted']} of the {checked['expected']} requests sent (scraped in {checked['scrape_ms']} ms): {'OK' if checked['ok'] else 'FAILED'}")
+    if 'deletes' in results:
+        deletes = results['deletes']
+        for label in ('fewest', 'most'):
+            delete = deletes[label]
+            print(f"\nDeleting {delete['subject']} ({label} enrollments, {delete['enrollments']}): {delete['status']} in {delete['ms']} ms with {delete['queries']} queries", end='')
+        print(f"\n{'OK' if deletes['ok'] else 'FAILED'}: {deletes['orphaned']} enrollments left without a class, {deletes['miscounted']} classes with the wrong enrollment_count")
+    if 'timetables' in results:
+        timetables = results['timetables']
+        print(f"\nTimetables of {timetables['students']} students ({timetables['clashing']} with clashes): {'OK' if timetables['ok'] else 'FAILED: timetable_mask is wrong for students ' + str(timetables['mismatched'])}")
+    if args.baseline:
+        compare(results, args.baseline)
+    if 'timetables' in results and not results['timetables']['ok']:
+        sys.exit(1)
+    if 'rush' in results and not results['rush']['ok']:
+        sys.exit(1)
+    if 'metrics' in results and not results['metrics']['ok']:
+        sys.exit(1)
+    if 'deletes' in results and not results['deletes']['ok']:
+        sys.exit(1)
+    if 'json_providers' in results and not all(check['identical'] for check in results['json_providers'].values()):
+        sys.exit(1)
+    if 'serializers' in results and not all(check['identical'] for check in results['serializers'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# A small in-process cache used to keep frequently read values in memory between requests. Entries expire after a time to live (TTL) so that a value changed by another worker process is never served for longer than that, and the least recently used entry is dropped once the cache is full so memory use stays bounded.
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl # Seconds an entry is kept for unless another ttl is passed to set()
+        self._entries = OrderedDict() # key: (expires_at, value)
+        self._lock = threading.Lock() # Flask may serve requests on several threads at once
+        self._building = {} # key: (lock held while the value is built, number of threads using the lock)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic(): # The entry has expired
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key) # Mark as most recently used
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False) # Drop the least recently used entry
+
+    # Returns the value for the key, calling build() to create and store it when it isn't cached. If several threads miss the same key at once only the first one calls build() and the others wait for its result, so a popular entry expiring doesn't send a burst of identical queries to the database.
+    def get_or_set(self, key, build, ttl=None):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            key_lock, waiting = self._building.get(key, (threading.Lock(), 0))
+            self._building[key] = (key_lock, waiting + 1)
+        try:
+            with key_lock:
+                value = self.get(key, _MISSING) # Another thread may have built it while this one waited
+                if value is _MISSING:
+                    value = build()
+                    self.set(key, value, ttl)
+                return value
+        finally:
+            with self._lock:
+                key_lock, waiting = self._building[key]
+                if waiting == 1:
+                    del self._building[key]
+                else:
+                    self._building[key] = (key_lock, waiting - 1)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
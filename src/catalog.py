@@ -0,0 +1,62 @@
+# This module caches the responses of the subject catalog routes (/subjects/ and /subjects/<id>/). The catalog is polled far more often than it changes, so instead of querying and serializing every subject on each request the finished response body is kept in memory and reused:
+# - each cached response is stored under the current catalog version. Any successful write to the API bumps the version so the next request builds a fresh response (the catalog includes class rosters and teacher names as well as subjects, so writes outside subjects_bp can change it too).
+# - the version only lives in this process, so entries also expire after CATALOG_CACHE_TTL seconds. This bounds how long another worker process can serve a catalog that is out of date.
+# - every response carries a strong ETag (a hash of its body). A client that sends it back in If-None-Match gets an empty 304 Not Modified response when nothing has changed.
+# - when several requests miss the cache at once only one of them rebuilds the response and the others wait for it.
+import hashlib
+import threading
+import time
+from flask import request, current_app, make_response
+from cache import TTLCache
+from replicas import reading_from_replica
+
+catalog_cache = TTLCache(maxsize=512)
+_version = 0
+_changed_at = 0 # time.monotonic() of the last bump
+_version_lock = threading.Lock()
+
+_CACHED_HEADERS = ('Link', 'X-Next-Cursor') # Pagination headers are part of a cached response
+
+
+def bump_catalog_version():
+    global _version, _changed_at
+    with _version_lock:
+        _version += 1
+        _changed_at = time.monotonic()
+
+
+# Registered with app.after_request. Bumps the catalog version after every successful request that changes data. Logging in is a POST but only changes the user's password hash, so it is skipped.
+def catalog_changed(response):
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 and request.endpoint != 'auth.auth_login':
+        bump_catalog_version()
+    return response
+
+
+# Returns the cached response for the current request, calling build() to create it on a miss. build() must return the same values a route would (such as (body, headers)). Only 200 responses are cached; anything else is returned as it is.
+def cached_response(build):
+    # A read replica may not have caught up with a change made in the last few seconds, so a response built from one then isn't cached under the new version.
+    if reading_from_replica() and time.monotonic() - _changed_at < current_app.config['REPLICA_STICKY_SECONDS']:
+        return make_response(build())
+    key = (_version, request.path, tuple(sorted(request.args.items(multi=True))))
+    entry = catalog_cache.get(key)
+    if entry is None:
+        response = None
+
+        def render():
+            nonlocal response
+            response = make_response(build())
+            if response.status_code != 200:
+                return None
+            body = response.get_data()
+            headers = {name: response.headers[name] for name in _CACHED_HEADERS if name in response.headers}
+            return body, response.mimetype, headers, hashlib.sha1(body).hexdigest()
+
+        entry = catalog_cache.get_or_set(key, render, ttl=current_app.config['CATALOG_CACHE_TTL'])
+        if entry is None: # The response couldn't be cached (for example a 404)
+            catalog_cache.pop(key)
+            return response if response is not None else make_response(build())
+    body, mimetype, headers, etag = entry
+    response = current_app.response_class(body, mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True # Clients may keep a copy but must check it is still current (with If-None-Match) before using it
+    return response.make_conditional(request) # Turns the response into a 304 when If-None-Match matches the ETag
@@ -1,10 +1,14 @@
 # This module contains the CRUD operations for the Address model.
 from flask import Blueprint, request, abort
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from init import db, bcrypt
+from init import db
 from models.address import Address, AddressSchema
 from models.user import User, UserSchema
-from controllers.auth_controller import auth_admin, auth_address
+from controllers.auth_controller import auth_admin, auth_address, invalidate_principal, bump_token_version
+from pagination import paginate
+from loading import loading_plan
+from schemas import get_schema, request_schema, dump
+from dml import update_returning, delete_returning
 # Adding a blueprint for addresses. This will automatically add the prefix addresses to the
 # start of all URL's with this blueprint. 
 addresses_bp = Blueprint('addresses', __name__, url_prefix='/addresses') # addresses is a resource made available through the API
@@ -16,7 +20,7 @@ addresses_bp = Blueprint('addresses', __name__, url_prefix='/addresses') # addre
 # A function is defined that the decorator applies to (the route handler).
 def create_address(): 
     # Create a new Address model instance (SQL: Insert into addresses (complete_number, strret_number...) values...)
-    data = AddressSchema().load(request.json)  # this applies the validation rules set on the schema.
+    data = get_schema(AddressSchema).load(request.json)  # this applies the validation rules set on the schema.
     address = Address(
             complex_number = data.get('complex_number'),  # Get allows this field to be left blank
             street_number = data['street_number'], 
@@ -24,21 +28,22 @@ def create_address():
             suburb = data['suburb'], 
             postcode = data['postcode']
             )
-    # Add and commit address to DB
+    # Add address to DB. It is flushed to get its id and committed at the end of the request.
     db.session.add(address)
-    db.session.commit()
+    db.session.flush()
     #  The following return statement will be the response the server sends across the network to the client:  
-    return AddressSchema(exclude= ['users']).dump(address), 201 # The result is automatically Jsonified.
+    return dump(get_schema(AddressSchema, exclude= ['users']), address), 201 # The result is automatically Jsonified.
 
 # READ
 @addresses_bp.route('/') 
 @jwt_required()
 def get_all_addresses():
     auth_admin()
-    # A route to return all instances of the addresses resource in ascending order by postcode (select * from addresses order by postcode)
-    stmt = db.select(Address).order_by(Address.postcode) # Build the query
-    addresses = db.session.scalars(stmt) # Execute the query
-    return AddressSchema(many=True).dump(addresses) # Respond to client
+    # A route to return one page of the addresses resource in ascending order by postcode (select * from addresses order by postcode, id limit :limit)
+    schema = request_schema(AddressSchema, many=True)
+    stmt = db.select(Address).options(*loading_plan(Address, schema)) # Build the query. The users at each address are loaded with one extra query for the whole page.
+    addresses, headers = paginate(stmt, Address.postcode) # Execute the query for the requested page
+    return dump(schema, addresses), headers # Respond to client
 
 
 @addresses_bp.route('/<int:id>')
@@ -49,33 +54,28 @@ def get_one_address(id):
     # A route to retrieve a single user resource based on the restful id parameter.
      # (select * from subjects where id=id)
     # Build the query
-    stmt = db.select(Address).filter_by(id=id) # stmt is short for statement
+    schema = request_schema(AddressSchema)
+    stmt = db.select(Address).filter_by(id=id).options(*loading_plan(Address, schema)) # stmt is short for statement
     # Execute the query
     user = db.session.scalar(stmt) # Scalar is now singular as only one Address is returned 
     if user: # If the id belongs to an exsiting address then return that address instance
-        return AddressSchema().dump(user) # remove the many=True because we are only returning a single Address instance. 
+        return dump(schema, user) # remove the many=True because we are only returning a single Address instance. 
     else:
         # A 404 error with a custom message will be returned if there is no address with that ID. 
         return {'error': f'Address not found with id {id}.'}, 404
 
 # UPDATE
+ADDRESS_FIELDS = ['complex_number', 'street_number', 'street_name', 'suburb', 'postcode']
+
 @addresses_bp.route('/<int:id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def update_one_address(id):
     auth_address(id)
-    # A route to update one address resource (SQL: Update addresses set .... where id = id)
-    stmt = db.select(Address).filter_by(id=id) # Build the query
-    address = db.session.scalar(stmt) # Execute the query
-    data = AddressSchema().load(request.json, partial=True) # this applies the validation rules set on the schema.
-    if address:  # If an address with that id exsists then update any provided fields
-        address.complex_number = data.get('complex_number') or address.complex_number # The get method will return none if the key doesn't exist rather than raising an exception. 
-        address.street_number = data.get('street_number') or address.street_number
-        address.street_name = data.get('street_name') or address.street_name
-        address.suburb = data.get('suburb') or address.suburb
-        address.postcode = data.get('postcode') or address.postcode
-        
-        db.session.commit()      
-        return AddressSchema().dump(address) # Respond to client
+    # A route to update one address resource with a single statement (SQL: Update addresses set .... where id = id returning ...). Only the fields provided are changed.
+    data = get_schema(AddressSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    address, _ = update_returning(Address, id, data, ADDRESS_FIELDS, returning=['id', *ADDRESS_FIELDS])
+    if address:  # If an address with that id exsists then return it with the changes
+        return dump(get_schema(AddressSchema, only=['id', *ADDRESS_FIELDS]), address) # Respond to client
     else: # If there is no address in a database with that provided id return a not found (404) error with a custom error message. 
         return {'error': f'Address not found with id {id}.'}, 404
 
@@ -84,13 +84,12 @@ def update_one_address(id):
 @jwt_required()
 def delete_one_address(id):
     auth_address(id)
-    # A route to delete one address resource (SQL: Delete from addresses where id=id)
-    stmt = db.select(Address).filter_by(id=id) # Build query 
-    address = db.session.scalar(stmt) # Execute query
-    #  If an address with that id exsists then delete the entire instance of that address
+    # A route to delete one address resource (SQL: Delete from addresses where id=id). The database clears the address_id of the users who lived there (ON DELETE SET NULL) so they aren't loaded.
+    bump_token_version(User.address_id == id) # Tokens carrying this address_id stop working
+    address = delete_returning(Address, id, returning=['id', 'street_name', 'suburb'])
+    #  If an address with that id existed it has been deleted
     if address: 
-        db.session.delete(address)
-        db.session.commit()
+        invalidate_principal() # Every user who lived at this address has their address_id cleared so the whole cache is dropped.
         return {'message': f'The records for address ID {address.id} located on {address.street_name} in {address.suburb} were deleted successfully.'}
     # If the address_id doesn't exist in the database return a not found (404) error
     else:
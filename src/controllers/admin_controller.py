@@ -0,0 +1,104 @@
+# This module contains routes for the people running the API rather than its users. They are only available to admin employees.
+from flask import Blueprint, request, abort, send_file
+from flask_jwt_extended import jwt_required, verify_jwt_in_request
+from init import instrumentation, profiler
+from controllers.auth_controller import auth_admin
+
+admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+# READ Instrumentation settings
+# Returns whether request instrumentation (the Server-Timing header and the slow request and N+1 query logs) is on and the thresholds it uses.
+@admin_bp.route('/instrumentation')
+@jwt_required()
+def get_instrumentation():
+    auth_admin()
+    return _instrumentation_settings()
+
+# UPDATE Instrumentation settings
+# Turns instrumentation on or off, or changes its thresholds, without restarting the app. For example {"enabled": false} or {"slow_request_ms": 250}. The change only applies to the worker process that handles the request, so when running several workers it should be made with the environment variables instead.
+@admin_bp.route('/instrumentation', methods=['PUT', 'PATCH'])
+@jwt_required()
+def update_instrumentation():
+    auth_admin()
+    data = request.json
+    if not isinstance(data, dict):
+        abort(400, description='The request body must be a JSON object.')
+    if 'enabled' in data:
+        if not isinstance(data['enabled'], bool):
+            abort(400, description='enabled must be true or false.')
+        instrumentation.enabled = data['enabled']
+    for name in ('slow_request_ms', 'n_plus_one_threshold'):
+        if name in data:
+            if not isinstance(data[name], int) or isinstance(data[name], bool) or data[name] < 1:
+                abort(400, description=f'{name} must be a whole number greater than 0.')
+            setattr(instrumentation, name, data[name])
+    return _instrumentation_settings()
+
+def _instrumentation_settings():
+    return {
+        'enabled': instrumentation.enabled,
+        'slow_request_ms': instrumentation.slow_request_ms,
+        'n_plus_one_threshold': instrumentation.n_plus_one_threshold
+    }
+
+# The profiler calls this when a request is sent with the X-Profile header. It runs before the route's own checks (and before @jwt_required()), so the token is verified here first.
+def auth_profiling():
+    verify_jwt_in_request()
+    auth_admin()
+
+# READ Profiling settings
+# Returns how often requests are sampled for profiling (one in sample_rate, 0 when sampling is off) and how many profiles are kept.
+@admin_bp.route('/profiling')
+@jwt_required()
+def get_profiling():
+    auth_admin()
+    return _profiling_settings()
+
+# UPDATE Profiling settings
+# Changes the sample rate or the number of profiles kept without restarting the app, for example {"sample_rate": 100} to profile one in every 100 requests or {"sample_rate": 0} to stop sampling. Like the instrumentation settings this only applies to the worker process that handles the request.
+@admin_bp.route('/profiling', methods=['PUT', 'PATCH'])
+@jwt_required()
+def update_profiling():
+    auth_admin()
+    data = request.json
+    if not isinstance(data, dict):
+        abort(400, description='The request body must be a JSON object.')
+    for name, minimum in (('sample_rate', 0), ('keep', 1)):
+        if name in data:
+            if not isinstance(data[name], int) or isinstance(data[name], bool) or data[name] < minimum:
+                abort(400, description=f'{name} must be a whole number of at least {minimum}.')
+            setattr(profiler, name, data[name])
+    return _profiling_settings()
+
+def _profiling_settings():
+    return {
+        'sample_rate': profiler.sample_rate,
+        'keep': profiler.keep
+    }
+
+# READ Profiles
+# Returns the summaries of the saved profiles (from the X-Profile header and from sampling), newest first.
+@admin_bp.route('/profiles/')
+@jwt_required()
+def get_all_profiles():
+    auth_admin()
+    return profiler.profiles()
+
+# READ Profile
+# Returns one saved profile with its report. With ?format=text only the report is returned as plain text, and with ?format=pstats the raw cProfile stats are downloaded (for tools such as snakeviz or pstats).
+@admin_bp.route('/profiles/<string:profile_id>')
+@jwt_required()
+def get_one_profile(profile_id):
+    auth_admin()
+    profile = profiler.profile(profile_id)
+    if profile is None:
+        return {'error': f'Profile not found with id {profile_id}.'}, 404
+    format = request.args.get('format', 'json')
+    if format == 'text':
+        return profile['report'], 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    if format == 'pstats':
+        path = profiler.stats_path(profile_id)
+        if path is None:
+            return {'error': f"Profile {profile_id} was taken with {profile['profiler']} so there are no cProfile stats for it."}, 404
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=f'{profile_id}.prof')
+    return profile
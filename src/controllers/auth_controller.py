@@ -1,13 +1,19 @@
 # Auth will make use of the users model but indirectly. 
-from flask import Blueprint, request, abort
-from init import db, bcrypt
+from collections import namedtuple
+from flask import Blueprint, request, abort, g, current_app
+from init import db, jwt, hasher, instrumentation
 from datetime import timedelta
+from cache import TTLCache
 from models.user import User, UserSchema
 from models.employee import Employee, EmployeeSchema
+from models.student import Student
 from models.address import Address, AddressSchema
 from models.user import User, UserSchema
 from sqlalchemy.exc import IntegrityError
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
+from flask_jwt_extended import create_access_token, get_jwt_identity, get_jwt, jwt_required
+from schemas import get_schema, dump
+from unit_of_work import after_commit
+from dml import update_returning, column_fields
 
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
@@ -18,7 +24,7 @@ auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 @jwt_required()
 def create_address_and_user():
     # Create a new Address model instance (SQL: Insert into addresses (complex_number,...) values...)
-    data = AddressSchema().load(request.json) # Load applies the validation rules set on the schema. 
+    data = get_schema(AddressSchema).load(request.json) # Load applies the validation rules set on the schema. 
     address = Address(
             complex_number = data.get('complex_number'), # Get allows this field to be left blank
             street_number = data['street_number'], 
@@ -26,9 +32,9 @@ def create_address_and_user():
             suburb = data['suburb'], 
             postcode = data['postcode']
             )
-    # Add and commit address to DB
+    # Add the address to the session. It is flushed to the DB to get its id and committed along with the user at the end of the request.
     db.session.add(address)
-    db.session.commit()
+    db.session.flush()
        
     # Now create a new user instance (SQL: Insert into users (title, first_name...) values...)
     try:
@@ -38,18 +44,18 @@ def create_address_and_user():
             first_name = data['users'][0]['first_name'],
             middle_name = data['users'][0]['middle_name'],
             last_name = data['users'][0]['last_name'],
-            password = bcrypt.generate_password_hash(request.json['users'][0]['password']).decode('utf8'),
+            password = hasher.hash_password(request.json['users'][0]['password']),
             email = data['users'][0]['email'],
             phone = data['users'][0]['phone'],
             dob = data['users'][0]['dob'],
             gender = data['users'][0]['gender'],
             address_id = address.id # Note that type cannot be set here. Type can only be set by an admin employee.  The default value of TBC will be set for each user. 
         )
-        # Add and commit user to DB
+        # Add user to DB
         db.session.add(user)
-        db.session.commit()
+        db.session.flush() # A duplicate email is found here
         # Respond to client
-        return UserSchema(exclude=['employee', 'student', 'student_relations']).dump(user), 201
+        return dump(get_schema(UserSchema, exclude=['employee', 'student', 'student_relations']), user), 201
     except IntegrityError:
         return {'error': 'Email address already in use'}, 409
 
@@ -59,40 +65,37 @@ def auth_login():
     stmt = db.select(User).filter_by(email=request.json['email']) # Build the query to select the user with the incoming email address. 
     user = db.session.scalar(stmt) # Execute the query
     # If user exists (if user is truthy) and the incoming password is correct create a JWT token and return it.
-    if user and bcrypt.check_password_hash(user.password, request.json['password']):
-        token = create_access_token(identity=str(user.id), expires_delta=timedelta(days=5)) # Timedelta is a function that allows a time period to be specified in any unit and it will calculate and return how many minutes that is. This token will expire after 5 days. # change this to one before deployment. Delta means difference.
+    with instrumentation.phase('auth'): # Checking the password is most of the time taken to log in
+        password_ok = user is not None and hasher.check_password(user.password, request.json['password'])
+    if password_ok:
+        if hasher.needs_rehash(user.password): # If the password was hashed with a different cost factor to the one now configured it is rehashed while the plain text password is available.
+            user.password = hasher.hash_password(request.json['password'])
+        token = create_access_token(identity=str(user.id), additional_claims=role_claims(user.id), expires_delta=timedelta(days=5)) # Timedelta is a function that allows a time period to be specified in any unit and it will calculate and return how many minutes that is. This token will expire after 5 days. # change this to one before deployment. Delta means difference.
         # The token isn't stored on the server. Instead the server uses the secret key to validate the token.
         return {'email': user.email, 'token': token, 'type': user.type} # The payload of the token identifys the user. 
     else:
         return {'error': 'Invalid email or password'}, 401 # For security reasons users are not told which one is incorrect. This prevents brute force attacks.
 
 # UPDATE: Set a User Type
+USER_TYPE_FIELDS = ['title', 'first_name', 'middle_name', 'last_name', 'email', 'phone', 'dob', 'gender', 'type'] # The fields an admin can change here (passwords are changed by the user themselves)
+USER_COLUMNS = column_fields(User, UserSchema) # The user's own fields, which are returned by the update routes
+EMPLOYEE_COLUMNS = column_fields(Employee, EmployeeSchema)
+
 @auth_bp.route('/set_user_type/<int:user_id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def set_user_type(user_id):
     auth_admin() # Only admin is allowed to make a user an admin user
-    # A route to update one employee resource (SQL: Update employees set .... where id = id)
-    stmt = db.select(User).filter_by(id=user_id) # Build query
-    user = db.session.scalar(stmt) # Execute query 
-    data = UserSchema().load(request.json, partial=True) # this applies the validation rules set on the schema.
-
-    
-    if user: # If a user with that id exsists then update any provided fields
-        user.title = data.get('title') or user.title # The get method will return none if the key doesn't exist rather than raising an exception. 
-        user.first_name = data.get('first_name') or user.first_name
-        user.middle_name = data.get('middle_name') or user.middle_name
-        user.last_name = data.get('last_name') or user.last_name
-        user.email = data.get('email') or user.email
-        user.phone = data.get('phone') or user.phone
-        user.dob = data.get('dob') or user.dob
-        user.gender = data.get('gender') or user.gender
-        user.type = data.get('type') or user.type
-        
-        db.session.commit()      
-        return UserSchema().dump(user) # Respond to client
+    # A route to update one user resource with a single statement (SQL: Update users set .... , token_version = token_version + 1 where id = id returning ...)
+    data = get_schema(UserSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    # Tokens issued with the user's old type stop working, so the token_version is bumped whenever the user changes
+    user, changed = update_returning(User, user_id, data, USER_TYPE_FIELDS, returning=USER_COLUMNS, also={'token_version': User.token_version + 1})
+    if user: # If a user with that id exsists then return it with the changes
+        if changed:
+            invalidate_principal(user_id) # The user's permissions depend on their type so their cached principal is dropped.
+        return dump(get_schema(UserSchema, only=USER_COLUMNS), user) # Respond to client
     else:# If there is no user in a database with that provided id return a not found (404) error with a custom error message.
-        return {'error': f'User not found with user id {id}.'}, 404    
-    
+        return {'error': f'User not found with user id {user_id}.'}, 404
+
 
 
 # UPDATE: Set an Admin User
@@ -100,18 +103,14 @@ def set_user_type(user_id):
 @jwt_required()
 def make_admin(employee_id):
     auth_admin() # Only admin is allowed to make a user an admin user
-    # A route to update one employee resource (SQL: Update employees set .... where id = id)
-    stmt = db.select(Employee).filter_by(id=employee_id) # Build query
-    employee = db.session.scalar(stmt) # Execute query 
-    data = EmployeeSchema().load(request.json, partial=True) # this applies the validation rules set on the schema.
-    if employee: # If an employee with that id exsists then update any provided fields
-        employee.hired_date = data.get('hired_date') or employee.hired_date # The get method will return none if the key doesn't exist rather than raising an exception. 
-        employee.job_title = data.get('job_title') or employee.job_title
-        employee.department = data.get('department') or employee.department
-        employee.is_admin = data.get('is_admin') or employee.is_admin
-   
-        db.session.commit() # commit all changes to db      
-        return EmployeeSchema(only = ['id','user', 'hired_date', 'job_title', 'department', 'is_admin']).dump(employee) # Respond to client
+    # A route to update one employee resource with a single statement (SQL: Update employees set .... where id = id returning ...). is_admin can be set to false to take admin rights away.
+    data = get_schema(EmployeeSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    employee, changed = update_returning(Employee, employee_id, data, ['hired_date', 'job_title', 'department', 'is_admin'], returning=EMPLOYEE_COLUMNS + ['user_id'])
+    if employee: # If an employee with that id exsists then return it with the changes
+        if changed:
+            bump_token_version(User.id == employee.user_id) # Tokens issued before the change in admin rights stop working
+            invalidate_principal(employee.user_id) # Admin rights are part of the cached principal so it is dropped.
+        return dump(get_schema(EmployeeSchema, only=EMPLOYEE_COLUMNS), employee) # Respond to client
     else:# If there is no employee in a database with that provided id return a not found (404) error with a custom error message.
         return {'error': f'Employee not found with employee ID {employee_id}.'}, 404
 
@@ -122,53 +121,124 @@ def get_token_identity():
     stmt = db.select(User).filter_by(id=user_id) # build query to select the user object at that id
     return db.session.scalar(stmt) # execute query and return the result
 
+# The principal holds everything the auth functions below need to know about the user who made the request. It is loaded with one joined query rather than loading the user and then lazy loading their employee, student or address records.
+Principal = namedtuple('Principal', ['user_id', 'type', 'employee_id', 'is_admin', 'student_id', 'address_id', 'token_version'])
+
+# Principals are also kept between requests so that permission checks on the hot path run from memory. Entries expire after PRINCIPAL_CACHE_TTL seconds, which bounds how long another worker process can keep using a principal after a change, and the routes that change a user's type, admin rights or records call invalidate_principal() so the change applies straight away in this process.
+principal_cache = TTLCache(maxsize=1024)
+
+# It is always read from the primary database: a read replica that is behind could still hold the user's old type, admin rights or token version, and those would then be cached for the full PRINCIPAL_CACHE_TTL after invalidate_principal() was called.
+def load_principal(user_id):
+    # (SQL: select users.id, users.type, employees.id, employees.is_admin, students.id, users.address_id from users left join employees ... left join students ... where users.id = user_id)
+    stmt = db.select(User.id, User.type, Employee.id, Employee.is_admin, Student.id, User.address_id, User.token_version).outerjoin(Employee, Employee.user_id == User.id).outerjoin(Student, Student.user_id == User.id).where(User.id == user_id)
+    row = db.session.execute(stmt, bind_arguments={'primary': True}).first()
+    if row is None:
+        return None
+    return Principal(row[0], row[1], row[2], bool(row[3]), row[4], row[5], row[6])
+
+# Returns the principal for a user id from the cache, loading it from the database when it isn't cached.
+def cached_principal(user_id):
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        principal = load_principal(user_id)
+        if principal is not None:
+            principal_cache.set(user_id, principal, ttl=current_app.config['PRINCIPAL_CACHE_TTL'])
+    return principal
+
+# Returns the principal for the user in the JWT token. The result is also stored on flask's g object so it is only looked up once per request even when several auth functions are called. If the user no longer exists the request is terminated with a 401 error.
+# When JWT_ROLE_CLAIMS is turned on and the token carries role claims the principal is read from the signed token itself so no database lookup is needed.
+def get_principal():
+    if 'principal' not in g:
+        with instrumentation.phase('auth'): # Reported in the Server-Timing header
+            claims = get_jwt()
+            if current_app.config['JWT_ROLE_CLAIMS'] and 'user_type' in claims:
+                g.principal = Principal(int(claims['sub']), claims['user_type'], claims['employee_id'], claims['is_admin'], claims['student_id'], claims['address_id'], claims['token_version'])
+            else:
+                g.principal = cached_principal(int(get_jwt_identity()))
+    if g.principal is None:
+        abort(401)
+    return g.principal
+
+# Returns the extra claims to sign into a user's token at login. These are only added when JWT_ROLE_CLAIMS is turned on. The claim is called user_type rather than type because flask_jwt_extended already uses type to tell access and refresh tokens apart.
+def role_claims(user_id):
+    if not current_app.config['JWT_ROLE_CLAIMS']:
+        return {}
+    principal = cached_principal(user_id) # This also primes the cache used to check the token version on the user's next request
+    return {
+        'user_type': principal.type,
+        'is_admin': principal.is_admin,
+        'employee_id': principal.employee_id,
+        'student_id': principal.student_id,
+        'address_id': principal.address_id,
+        'token_version': principal.token_version
+    }
+
+# Increases the token version of every user matching the where clause so that any token carrying their old role claims is rejected (SQL: update users set token_version = token_version + 1 where ...).
+def bump_token_version(where):
+    db.session.execute(db.update(User).where(where).values(token_version=User.token_version + 1).execution_options(synchronize_session=False))
+
+# flask_jwt_extended calls this for every protected request. A token with role claims is revoked once the token_version it was issued with no longer matches the user's current version (or the user has been deleted). The version is read through the principal cache so this normally runs from memory.
+@jwt.token_in_blocklist_loader
+def check_token_version(jwt_header, jwt_payload):
+    if 'token_version' not in jwt_payload or not current_app.config['JWT_ROLE_CLAIMS']:
+        return False
+    with instrumentation.phase('auth'):
+        principal = cached_principal(int(jwt_payload['sub']))
+    return principal is None or principal.token_version != jwt_payload['token_version']
+
+# Drops a user's cached principal after their permissions or records change. If no user_id is given the whole cache is cleared (for example when a change affects many users at once).
+# The cache is cleared once the change is committed, so another request can't load the old principal from the database in between and cache it again.
+def invalidate_principal(user_id=None):
+    g.pop('principal', None)
+    after_commit(lambda: principal_cache.clear() if user_id is None else principal_cache.pop(user_id))
+
 #  This function is used to protect a route so that is can only be accessed by employees. 
 def auth_employee():
-    user = get_token_identity()
+    user = get_principal()
     if not user.type == 'Employee':
         abort(401) # Abort will immediately terminate the request response cycle and send an error response message back to the client. 
 
 #  This function is used to protect a route so that is can only be accessed by employees who also have admin rights. 
 def auth_admin():
-    user = get_token_identity()
+    user = get_principal()
     if not user.type == 'Employee':
         abort(401) # Abort will immediately terminate the request response cycle and send an error response message back to the client.
-    elif not user.employee.is_admin:
+    elif not user.is_admin:
         abort(401)
 
 #  This function is used to protect a route so that is can only be accessed by the student with the student_id passed in as a parameter or an employee. 
 def auth_employee_or_self(student_id):
-    user = get_token_identity()
+    user = get_principal()
     # If it is any student other than the student who's details they are trying to access then terminate the request response cycle and send an error response message back to the client.
     if (user.type == 'Student'):
-        if not user.student.id == student_id:  
+        if not user.student_id == student_id:  
             abort(401)
     elif not user.type == 'Employee': 
         abort(401)
 
 #  This function is used to protect a route so that is can only be accessed by the employee with the employee_id passed in as a parameter or an employee with admin rights.
 def auth_admin_or_self(employee_id):
-    user = get_token_identity()
+    user = get_principal()
     if not user.type == 'Employee': # if the user is any type other than an employee abort
         abort(401) 
         # If not the owner of the employee card request or an admin user abort. 
-    elif not ((user.employee.id == employee_id) or (user.employee.is_admin)):  
+    elif not ((user.employee_id == employee_id) or (user.is_admin)):  
             abort(401)
 
 #  This function is used to protect a route so that is can only be accessed by the users who live at that address or employees with admin rights.
 def auth_address(address_id):
-    user = get_token_identity()
-    if not user.address.id == address_id: # if the user does not have the address listed as their address then
+    user = get_principal()
+    if not user.address_id == address_id: # if the user does not have the address listed as their address then
         if not user.type == 'Employee': 
             abort(401) # Abort will immediately terminate the request response cycle and send an error response message back to the client.
-        elif not user.employee.is_admin: # if the user is not an admin the request is terminated 
+        elif not user.is_admin: # if the user is not an admin the request is terminated 
             abort(401)
 
 #  This function is used to protect a route so that is can only be accessed by the user with the user ID passed in as a parameter or an employee with admin rights.
 def auth_self(id):
-    user = get_token_identity()
-    if not user.id == id: # if the user does not have the same user id as the one they are attempting to select
+    user = get_principal()
+    if not user.user_id == id: # if the user does not have the same user id as the one they are attempting to select
         if not user.type == 'Employee':  
             abort(401) # Abort will immediately terminate the request response cycle and send an error response message back to the client.
-        elif not user.employee.is_admin:
+        elif not user.is_admin:
             abort(401)
@@ -1,25 +1,31 @@
+import csv
+import json
+import time
+import click
 from flask import Blueprint
-from init import db, bcrypt
+from init import db, hasher
 from datetime import date
 from models.user import User
-from models.student import Student
-from models.subject_class import SubjectClass
+from models.student import Student, refresh_timetable_masks
+from models.subject_class import SubjectClass, refresh_enrollment_counts
 from models.enrollment import Enrollment
 from models.subject import Subject
 from models.employee import Employee
 from models.address import Address
 from models.student_relation import StudentRelation
+from synthetic import seed_synthetic, SYNTHETIC_PASSWORD
+from importer import UserImport, IMPORT_CHUNK_SIZE
 
 db_commands = Blueprint('db', __name__)
 
 @db_commands.cli.command('create')
 def create_db():
-    db.create_all()
+    db.create_all(bind_key=None) # Only the primary database. Read replicas get their tables by replicating it.
     print("Tables created")
 
 @db_commands.cli.command('drop')
 def drop_db():
-    db.drop_all()
+    db.drop_all(bind_key=None)
     print("Tables dropped")
 
 @db_commands.cli.command('seed')
@@ -47,14 +53,15 @@ def seed_db():
             )  
     ]
     db.session.add_all(addresses)
-    db.session.commit()
+    # The passwords are hashed in parallel rather than one after the other.
+    passwords = hasher.hash_passwords(['ExamplePassword1!', 'ChangeMe!1', 'ChangeMe1!', 'ChangeMe!%', 'ChangeMe2**', 'ChangeMe2&'])
     users = [
         User(
             title = 'Miss',
             first_name = 'Danielle',
             middle_name = 'Jane',
             last_name = 'Clark',
-            password=bcrypt.generate_password_hash('ExamplePassword1!').decode('utf-8'),
+            password=passwords[0],
             email = 'danielle.clark@bgbc.edu.au',
             phone = '0416393531',
             address = addresses[0],
@@ -67,7 +74,7 @@ def seed_db():
             first_name = 'Damion',
             middle_name = 'George',
             last_name = 'Burns',
-            password=bcrypt.generate_password_hash('ChangeMe!1').decode('utf-8'),
+            password=passwords[1],
             email = 'damion.burns@bgbc.edu.au',
             phone = '0405301451',
             address = addresses[1],
@@ -80,7 +87,7 @@ def seed_db():
             first_name = 'Isabelle',
             middle_name = 'Margaret',
             last_name = 'Smith',
-            password=bcrypt.generate_password_hash('ChangeMe1!').decode('utf-8'),
+            password=passwords[2],
             email = 'Isabelle.Smith@bgbc.edu.au',
             phone = '0405301444',
             address = addresses[2],
@@ -93,7 +100,7 @@ def seed_db():
             first_name = 'Gabriella',
             middle_name = 'Sasha',
             last_name = 'Jones',
-            password=bcrypt.generate_password_hash('ChangeMe!%').decode('utf-8'),
+            password=passwords[3],
             email = 'gabriella.jones@bgbc.edu.au',
             phone = '0408301554',
             dob = '2005-04-07',
@@ -105,7 +112,7 @@ def seed_db():
             first_name = 'Janet',
             middle_name = 'Jane',
             last_name = 'Stone',
-            password=bcrypt.generate_password_hash('ChangeMe2**').decode('utf-8'),
+            password=passwords[4],
             email = 'janet.stone12@gmail.com',
             phone = '0405301554',
             dob = '1975-12-07',
@@ -117,7 +124,7 @@ def seed_db():
             first_name = 'Edward',
             middle_name = 'Michael',
             last_name = 'Smith',
-            password=bcrypt.generate_password_hash('ChangeMe2&').decode('utf-8'),
+            password=passwords[5],
             email = 'eddy.m.smith@gmail.com',
             phone = '0404501554',
             dob = '1968-02-10',
@@ -126,7 +133,6 @@ def seed_db():
         )
     ]
     db.session.add_all(users)
-    db.session.commit()
 
     students = [        
         Student(
@@ -145,7 +151,6 @@ def seed_db():
         )
     ]
     db.session.add_all(students)
-    db.session.commit()
     
     employees = [        
         Employee(
@@ -163,8 +168,7 @@ def seed_db():
             user = users[1]
         )
     ]
-    db.session.add_all(students)
-    db.session.commit()
+    db.session.add_all(employees)
 
     student_relations = [        
         StudentRelation(
@@ -182,7 +186,6 @@ def seed_db():
 
     ]
     db.session.add_all(student_relations)
-    db.session.commit()
     subjects = [
         Subject(
             id = '09EE',
@@ -208,7 +211,6 @@ def seed_db():
         )
     ]    
     db.session.add_all(subjects)
-    db.session.commit()
     subject_classes = [
         SubjectClass(
             id = '09EE01-2023',
@@ -240,7 +242,6 @@ def seed_db():
         )
     ]    
     db.session.add_all(subject_classes)
-    db.session.commit()
 
     enrollments = [
         Enrollment(
@@ -266,8 +267,50 @@ def seed_db():
     ]
     
     db.session.add_all(enrollments)
-    db.session.commit()
+    db.session.flush()
+    refresh_enrollment_counts() # The enrollments above were added directly so each class's enrollment_count is calculated from them
+    refresh_timetable_masks() # and each student's timetable_mask
+    db.session.commit() # Everything is committed in one transaction, so a failure part way through doesn't leave a half seeded database
  
     
 
     print('Tables seeded')
+
+
+# Generates a large school for trying out the API at scale, for example: flask db seed-synthetic --students 50000 --employees 3000 --subjects 120
+@db_commands.cli.command('seed-synthetic')
+@click.option('--students', default=1000, show_default=True, help='The number of students to create (each with one or two caregivers).')
+@click.option('--employees', default=80, show_default=True, help='The number of employees to create. The first one is an admin.')
+@click.option('--subjects', default=36, show_default=True, help='The number of subjects to create across year levels 7 to 12.')
+@click.option('--seed', type=int, default=None, help='Seed for the random number generator so the same school can be generated again.')
+def seed_synthetic_db(students, employees, subjects, seed):
+    start = time.perf_counter()
+    counts = seed_synthetic(students, employees, subjects, seed)
+    for table, count in counts.items():
+        print(f'{table}: {count} rows')
+    print(f'Tables seeded with synthetic data in {time.perf_counter() - start:.1f} seconds. Every generated user has the password {SYNTHETIC_PASSWORD}')
+
+
+# Imports students and caregivers from a CSV file (see importer.py for the columns), for example: flask db import intake-2024.csv --errors intake-errors.csv
+# Rows that can't be imported are listed with their line number and reasons, and the rest are still imported.
+@db_commands.cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--errors', 'errors_file', type=click.File('w'), default=None, help='Write the rows that failed to this CSV file (line number and errors) rather than printing them.')
+def import_db(file, errors_file):
+    start = time.perf_counter()
+    created = failed = 0
+    writer = csv.writer(errors_file) if errors_file else None
+    if writer:
+        writer.writerow(['row', 'errors'])
+    for result in UserImport().run(file):
+        if result['status'] == 'created':
+            created += 1
+        else:
+            failed += 1
+            if writer:
+                writer.writerow([result['row'], json.dumps(result['errors'])])
+            else:
+                print(f"Row {result['row']}: {result['errors']}")
+        if (created + failed) % IMPORT_CHUNK_SIZE == 0:
+            print(f'{created + failed} rows read')
+    print(f'{created} users imported and {failed} rows failed in {time.perf_counter() - start:.1f} seconds')
@@ -2,10 +2,17 @@
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from sqlalchemy.exc import IntegrityError
-from init import db, bcrypt
+from init import db, hasher
 from models.employee import Employee, EmployeeSchema
 from models.user import User, UserSchema
-from controllers.auth_controller import auth_admin, auth_address, auth_admin_or_self
+from models.student import Student, refresh_timetable_masks
+from models.enrollment import Enrollment
+from models.subject_class import SubjectClass
+from controllers.auth_controller import auth_admin, auth_address, auth_admin_or_self, invalidate_principal, bump_token_version
+from pagination import paginate
+from loading import loading_plan
+from schemas import get_schema, request_schema, dump
+from dml import update_returning, delete_returning, column_fields
 
 # Adding a blueprint for employees. This will automatically add the prefix employees to the start of all URL's with this blueprint. 
 employees_bp = Blueprint('employees', __name__, url_prefix='/employees') # employees is a resource made available through the API
@@ -18,14 +25,14 @@ def create_user_and_employee():
     auth_admin() 
     # Create a new user and employee model instance for the new employee. 
     # first create a new instance of the user based on the provided input.(SQL: Insert into users (title,first_name,...) values...)
-    data = UserSchema().load(request.json) # Load applies the validation rules set on the schema.
+    data = get_schema(UserSchema).load(request.json) # Load applies the validation rules set on the schema.
     try:
         user =  User(
             title = data['title'],
             first_name = data['first_name'],
             middle_name = data['middle_name'],
             last_name = data['last_name'],
-            password = bcrypt.generate_password_hash(request.json['password']).decode('utf8'),
+            password = hasher.hash_password(request.json['password']),
             email = data['email'],
             phone = data['phone'],
             dob = data['dob'],
@@ -33,7 +40,7 @@ def create_user_and_employee():
             type = data['type'] 
         )
         db.session.add(user)
-        db.session.commit()
+        db.session.flush() # Writes the new user so its id can be given to the employee. The user and employee are committed together at the end of the request.
         # next create a new instance of the employee based on the provided input. (SQL: Insert into employees (hired_date,job_title,...) values...)
         employee = Employee(
             user_id = user.id,
@@ -43,8 +50,8 @@ def create_user_and_employee():
             is_admin = data['employee']['is_admin']
         )
         db.session.add(employee)
-        db.session.commit()
-        return EmployeeSchema(exclude = ["subject_classes"]).dump(employee), 201
+        db.session.flush()
+        return dump(get_schema(EmployeeSchema, exclude = ["subject_classes"]), employee), 201
     except IntegrityError:
         return {'error': 'Email address already in use'}, 409 
 
@@ -53,10 +60,11 @@ def create_user_and_employee():
 @jwt_required()
 def get_all_employees():
     auth_admin()
-    # A route to return all instances of the employees resource in assending order by ID (SQL: select * from employees order by id)
-    stmt = db.select(Employee).order_by(Employee.hired_date.desc()) # Build query
-    employees = db.session.scalars(stmt) # Execute query
-    return EmployeeSchema(many=True).dump(employees) # Respond to client
+    # A route to return one page of the employees resource with the most recently hired first (SQL: select * from employees order by hired_date desc, id limit :limit)
+    schema = request_schema(EmployeeSchema, many=True)
+    stmt = db.select(Employee).options(*loading_plan(Employee, schema)) # Build query. The user, classes and class subjects are loaded up front.
+    employees, headers = paginate(stmt, Employee.hired_date.desc()) # Execute query for the requested page
+    return dump(schema, employees), headers # Respond to client
 
 # This specifies a restful parameter of employee_id that will be an integer. It will only match if the value passed in is an integer. 
 @employees_bp.route('/<int:employee_id>/') # Note this is employee_id not user_id
@@ -65,33 +73,27 @@ def get_one_employee(employee_id):
     auth_admin_or_self(employee_id)
     # A route to retrieve a single employee resource based on their employee_id
     # (SQL: select * from employees where id=employee_id)
-    stmt = db.select(Employee).filter_by(id=employee_id) # Build query
+    schema = request_schema(EmployeeSchema)
+    stmt = db.select(Employee).filter_by(id=employee_id).options(*loading_plan(Employee, schema)) # Build query
     employee = db.session.scalar(stmt) # Execute query (scalar is singular as only one employee instance is returned. 
     if employee:  # If the employee_id belongs to an exsiting employee then return that employee instance
-        return EmployeeSchema().dump(employee) # remove the many=True because we are only returning a single employee. 
+        return dump(schema, employee) # remove the many=True because we are only returning a single employee. 
     else:
         # A 404 error with a custom message will be returned if there is no employee with that employee_id. 
         return {'error': f'Employee not found with id {employee_id}.'}, 404
 
 # UPDATE
+EMPLOYEE_COLUMNS = column_fields(Employee, EmployeeSchema) # The employee's own fields, which are returned by the update route
+
 @employees_bp.route('/<int:employee_id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def update_one_employee(employee_id):
     auth_admin_or_self(employee_id) # Only admin or the employee themselves are allowed able to update an employee
-    # A route to update one employee resource (SQL: Update employees set .... where id = id)
-    stmt = db.select(Employee).filter_by(id=employee_id) # Build query
-    employee = db.session.scalar(stmt) # Execute query
- 
-    data = EmployeeSchema().load(request.json, partial=True) # this applies the validation rules set on the schema.
-    
-    if employee: # If an employee with that id exsists then update any provided fields
-        employee.hired_date = data.get('hired_date') or employee.hired_date # The get method will return none if the key doesn't exist rather than raising an exception. 
-        employee.job_title = data.get('job_title') or employee.job_title
-        employee.department = data.get('department') or employee.department
-        # employee.is_admin = data.get('is_admin') or employee.is_admin
-   
-        db.session.commit() # commit all changes to db      
-        return EmployeeSchema(only = ['id','user', 'hired_date', 'job_title', 'department', 'is_admin']).dump(employee) # Respond to client
+    # A route to update one employee resource with a single statement (SQL: Update employees set .... where id = id returning ...). Admin rights are changed through /auth/make_admin.
+    data = get_schema(EmployeeSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    employee, _ = update_returning(Employee, employee_id, data, ['hired_date', 'job_title', 'department'], returning=EMPLOYEE_COLUMNS)
+    if employee: # If an employee with that id exsists then return it with the changes
+        return dump(get_schema(EmployeeSchema, only=EMPLOYEE_COLUMNS), employee) # Respond to client
     else:# If there is no employee in a database with that provided id return a not found (404) error with a custom error message.
         return {'error': f'Employee not found with employee ID {employee_id}.'}, 404
 
@@ -100,13 +102,14 @@ def update_one_employee(employee_id):
 @jwt_required()
 def delete_one_employee(employee_id):
     auth_admin() # Only admin is allowed to delete an employee record
-    # A route to delete one employee resource (SQL: Delete from employees where id=employee_id)
-    stmt = db.select(Employee).filter_by(id=employee_id) # Build query to select the employee
-    employee = db.session.scalar(stmt)
-    # if the user's employee_id exsists delete their records from the database
+    # A route to delete one employee resource (SQL: Delete from employees where id=employee_id). The database deletes their classes and the enrollments in them with it (ON DELETE CASCADE).
+    # The timetables of the students in the employee's classes are recalculated without those classes first, while the enrollments still show who they are.
+    refresh_timetable_masks(Student.id.in_(db.select(Enrollment.student_id).join(SubjectClass).where(SubjectClass.employee_id == employee_id)), leaving=SubjectClass.employee_id == employee_id)
+    employee = delete_returning(Employee, employee_id, returning=['id', 'user_id'])
+    # if the employee_id existed their records have been deleted from the database
     if employee:
-        db.session.delete(employee)
-        db.session.commit() # commit the deletion
+        bump_token_version(User.id == employee.user_id) # Tokens that say this user is an employee (or admin) stop working
+        invalidate_principal(employee.user_id)
         return {'message': f'The records for the employee with Employee ID {employee.id} were deleted successfully'} # Respond to client
     # If the employee_id doesn't exist in the database return a not found (404) error
     else:
@@ -1,9 +1,17 @@
-from flask import Blueprint, request
-from init import db, bcrypt
+from flask import Blueprint, request, current_app
+from init import db
 from models.enrollment import Enrollment, EnrollmentSchema
+from models.student import Student, occupy_line, refresh_timetable_masks
+from models.subject_class import SubjectClass, reserve_places, release_places
+from marshmallow.exceptions import ValidationError
 from sqlalchemy.exc import IntegrityError
 from flask_jwt_extended import jwt_required
 from controllers.auth_controller import auth_admin, auth_employee
+from pagination import paginate, get_sort
+from filtering import apply_filters
+from loading import loading_plan
+from schemas import get_schema, request_schema, dump
+from dml import update_returning, delete_returning, column_fields
 
 # Create enrollments blueprint
 enrollments_bp = Blueprint('enrollments', __name__, url_prefix='/enrollments') 
@@ -16,35 +24,173 @@ def create_enrollment():
     auth_admin()
     # Create a new enrollment model instance
     # This allows the user's JSON input to be passed through the Schema to apply validation. 
-    data = EnrollmentSchema().load(request.json)
+    data = get_schema(EnrollmentSchema).load(request.json)
 
+    # Take a place in the class before adding the enrollment. If the class is already full the enrollment is rejected.
+    if not reserve_places(data['subject_class_id']):
+        return _class_unavailable(data['subject_class_id'])
+    # Add the class's timetable line to the student's timetable. With ?reject_clashes=true the enrollment is rejected if the student already has a class on that line.
+    reject_clashes = request.args.get('reject_clashes', 'false').lower() in ('1', 'true', 'yes')
+    if not occupy_line(data['student_id'], data['subject_class_id'], reject_clashes):
+        return _student_unavailable(data['student_id'], data['subject_class_id'])
     try:
         enrollment = Enrollment(
             date = data['date'],
             subject_class_id = data['subject_class_id'],
             student_id = data['student_id']
         )
-        # Add and commit enrollment to DB
+        # Add enrollment to DB. The place reserved above is committed in the same transaction at the end of the request.
         db.session.add(enrollment)
-        db.session.commit()
+        db.session.flush()
         # Respond to client
-        return EnrollmentSchema().dump(enrollment), 201
-    except IntegrityError:
+        return dump(get_schema(EnrollmentSchema), enrollment), 201
+    except IntegrityError: # The error response rolls the transaction back, which also gives back the reserved place
             return {'error': 'Foriegn Key Error. Either the student_id or subject_class_id does not exsit in the database'}, 409
+
+# Builds the error response when a place in a class couldn't be reserved, either because the class doesn't exist or because it is full.
+def _class_unavailable(subject_class_id):
+    db.session.rollback()
+    if db.session.get(SubjectClass, subject_class_id) is None:
+        return {'error': 'Foriegn Key Error. Either the student_id or subject_class_id does not exsit in the database'}, 409
+    return {'error': f'Class {subject_class_id} is full.'}, 409
+
+# Builds the error response when a student's timetable couldn't be updated, either because the student doesn't exist or because they already have a class on the same timetable line.
+def _student_unavailable(student_id, subject_class_id):
+    db.session.rollback()
+    if db.session.get(Student, student_id) is None:
+        return {'error': 'Foriegn Key Error. Either the student_id or subject_class_id does not exsit in the database'}, 409
+    return {'error': f'Student {student_id} already has a class on timetable line {db.session.get(SubjectClass, subject_class_id).timetable_line}.'}, 409
+
+
+BULK_CHUNK_SIZE = 1000 # The number of enrollments validated and inserted in each transaction
+
+#CREATE Many Enrollments
+# A route to create many enrollments in one request, for example when timetabling a whole cohort. The body is either a JSON array of enrollments or (with a Content-Type of application/x-ndjson) one enrollment per line, which is read as it streams in. Each enrollment looks like {"student_id": 1, "subject_class_id": "09EE01-2023", "date": "2023-01-01"} and the date can be left out.
+# Rows are handled in chunks. For each chunk the student and class ids are checked with one query each and the valid rows are inserted with a single statement and committed together. A row that fails doesn't stop the others, and the response lists the result of every row by its position in the body.
+@enrollments_bp.route('/bulk', methods=['POST'])
+@jwt_required()
+def create_enrollments_bulk():
+    auth_admin()
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        rows = _ndjson_rows(request.stream)
+    else:
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            return {'error': 'The request body must be a JSON array of enrollments.'}, 400
+
+    results = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == BULK_CHUNK_SIZE:
+            results.extend(_create_enrollment_chunk(chunk, len(results)))
+            chunk = []
+    if chunk:
+        results.extend(_create_enrollment_chunk(chunk, len(results)))
+
+    created = sum(1 for result in results if result['status'] == 'created')
+    # 201 if every row was created, otherwise 207 (Multi-Status) as the results are mixed.
+    return {'created': created, 'failed': len(results) - created, 'results': results}, 201 if created == len(results) else 207
+
+# Reads one JSON value per line from the request body. A line that isn't valid JSON is passed on as a ValueError so it is reported against its row.
+def _ndjson_rows(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield current_app.json.loads(line) # Uses the same JSON provider as the rest of the app
+        except ValueError as err:
+            yield err
+
+# Validates and inserts one chunk of rows. Start is the position of the first row in the request body.
+def _create_enrollment_chunk(rows, start):
+    schema = get_schema(EnrollmentSchema, only=['date', 'subject_class_id', 'student_id'])
+    results = [None] * len(rows)
+    valid = [] # (position in chunk, validated data)
+    for i, row in enumerate(rows):
+        try:
+            if isinstance(row, ValueError):
+                raise ValidationError(f'Invalid JSON: {row}')
+            data = schema.load(row)
+            if not isinstance(data.get('student_id'), int) or isinstance(data.get('student_id'), bool):
+                raise ValidationError({'student_id': ['A whole number student_id is required.']})
+            if not isinstance(data.get('subject_class_id'), str):
+                raise ValidationError({'subject_class_id': ['A subject_class_id is required.']})
+            valid.append((i, data))
+        except ValidationError as err:
+            results[i] = {'row': start + i, 'status': 'error', 'errors': err.messages}
+
+    # Check every foreign key in the chunk with one query per table (SQL: select id from students where id in (...)) rather than letting each insert fail on its own.
+    student_ids = {data['student_id'] for _, data in valid}
+    class_ids = {data['subject_class_id'] for _, data in valid}
+    existing_students = set(db.session.scalars(db.select(Student.id).where(Student.id.in_(student_ids)))) if student_ids else set()
+    existing_classes = set(db.session.scalars(db.select(SubjectClass.id).where(SubjectClass.id.in_(class_ids)))) if class_ids else set()
+
+    inserts = []
+    for i, data in valid:
+        errors = {}
+        if data['student_id'] not in existing_students:
+            errors['student_id'] = [f"Student not found with id {data['student_id']}."]
+        if data['subject_class_id'] not in existing_classes:
+            errors['subject_class_id'] = [f"Class not found with id {data['subject_class_id']}."]
+        if errors:
+            results[i] = {'row': start + i, 'status': 'error', 'errors': errors}
+        else:
+            inserts.append((i, {'date': data['date'], 'subject_class_id': data['subject_class_id'], 'student_id': data['student_id']}))
+
+    # Reserve places in each class for the rows in this chunk. If a class doesn't have room for all of them, places are taken one at a time until it is full and the remaining rows are rejected.
+    by_class = {}
+    for i, row in inserts:
+        by_class.setdefault(row['subject_class_id'], []).append((i, row))
+    inserts = []
+    for subject_class_id, class_rows in by_class.items():
+        if reserve_places(subject_class_id, len(class_rows)):
+            inserts.extend(class_rows)
+            continue
+        for position, (i, row) in enumerate(class_rows):
+            if not reserve_places(subject_class_id):
+                for j, _ in class_rows[position:]:
+                    results[j] = {'row': start + j, 'status': 'error', 'errors': {'subject_class_id': [f'Class {subject_class_id} is full.']}}
+                break
+            inserts.append((i, row))
+    inserts.sort(key=lambda insert: insert[0])
+
+    if inserts:
+        values = [row for _, row in inserts]
+        # Databases that support INSERT ... RETURNING with many rows (PostgreSQL) send back the new ids. Otherwise the rows are inserted with a single executemany.
+        if db.session.get_bind().dialect.full_returning:
+            ids = db.session.scalars(db.insert(Enrollment).values(values).returning(Enrollment.id)).all()
+        else:
+            db.session.execute(db.insert(Enrollment), values)
+            ids = [None] * len(values)
+        refresh_timetable_masks(Student.id.in_({row['student_id'] for row in values})) # One statement updates the timetable of every student in the chunk
+        db.session.commit() # One transaction per chunk
+        for (i, _), enrollment_id in zip(inserts, ids):
+            results[i] = {'row': start + i, 'status': 'created'}
+            if enrollment_id is not None:
+                results[i]['id'] = enrollment_id
+    return results
     
 
 # READ Enrollment
+# The query parameters the list of enrollments can be filtered by and the fields it can be sorted by
+ENROLLMENT_FILTERS = {'student_id': Enrollment.student_id, 'subject_class_id': Enrollment.subject_class_id, 'date': Enrollment.date}
+ENROLLMENT_SORTS = dict(ENROLLMENT_FILTERS, id=Enrollment.id)
+
 @enrollments_bp.route('/') 
 @jwt_required()
 def get_all_enrollments():
     auth_employee()
-    # A route to return all instances of the enrollments resource in assending order by subject_class_id 
-    # (select * from enrollments order by subject_class_id;)
+    # A route to return one page of the enrollments resource in assending order by subject_class_id 
+    # (select * from enrollments order by subject_class_id, id limit :limit;)
     
-    stmt = db.select(Enrollment).order_by(Enrollment.subject_class_id) # Build query
-    enrollments = db.session.scalars(stmt) # Execute the query
+    schema = request_schema(EnrollmentSchema, many=True, exclude=['student'])
+    stmt = db.select(Enrollment).options(*loading_plan(Enrollment, schema)) # Build query
+    stmt = apply_filters(stmt, ENROLLMENT_FILTERS) # For example ?subject_class_id=09EE01-2023 (SQL: ... where subject_class_id = :subject_class_id)
+    enrollments, headers = paginate(stmt, *get_sort(ENROLLMENT_SORTS, Enrollment.subject_class_id)) # Execute the query for the requested page
     # Return the results to the user in JSON format
-    return EnrollmentSchema(many=True, exclude=['student']).dump(enrollments)
+    return dump(schema, enrollments), headers
 
 
 @enrollments_bp.route('/<int:id>/') 
@@ -54,40 +200,43 @@ def get_one_enrollment(id):
     # A route to return one instance of a enrollment based on the enrollment id. 
     # (select * from enrollments where id = id;)
     #Make the query
-    stmt = db.select(Enrollment).filter_by(id=id) # Build query
+    schema = request_schema(EnrollmentSchema)
+    stmt = db.select(Enrollment).filter_by(id=id).options(*loading_plan(Enrollment, schema)) # Build query
     enrollment = db.session.scalar(stmt) # Execute query
     # If an enrollment exists with the specified id return the resource in JSON format
     if enrollment:    
-        return EnrollmentSchema().dump(enrollment)
+        return dump(schema, enrollment)
     else:
         # A 404 error with a custom message will be returned if there is no enrolment with that id.    
         return {'error': f'Enrolment not found with id {id}.'}, 404
 
 # UPDATE Enrollment
+ENROLLMENT_COLUMNS = column_fields(Enrollment, EnrollmentSchema) # The enrollment's own fields, which are returned by the update route
+
 @enrollments_bp.route('/<int:id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def update_one_enrollment(id):
     auth_admin()
-    # A route to update one enrollment resource (SQL: Update enrollments set .... where id = id)
-    # Select the correct enrollement resource through a query
-    stmt = db.select(Enrollment).filter_by(id=id) # Build  query
-    enrollment = db.session.scalar(stmt) # Execute query
-    # If an enrollment exists with the specified id update the resource attributes to match those provided in the JSON body. If a field is not provided leave it as it was before.
-    data = EnrollmentSchema().load(request.json) # This allows the user's JSON input to be passed through the Schema to apply validation.
-    if enrollment: 
-        try:
-            enrollment.id = data.get('id') or enrollment.id 
-            enrollment.date = data.get('date') or enrollment.date
-            enrollment.subject_class_id = data.get('subject_class_id') or enrollment.subject_class_id
-            enrollment.student_id = data.get('student_id') or enrollment.student_id   
-
-            db.session.commit() # Commit update      
-            return EnrollmentSchema().dump(enrollment)
-        except IntegrityError:
-            return {'error': 'Foriegn Key Error. Either the student_id or subject_class_id does not exsit in the database'}, 409
-    else:
+    # A route to update one enrollment resource (SQL: Update enrollments set .... where id = id returning ...). Only the fields provided in the JSON body are changed.
+    data = get_schema(EnrollmentSchema).load(request.json, partial=True) # This allows the user's JSON input to be passed through the Schema to apply validation.
+    # The enrollment's current class and student are needed to move its place and update the timetables (SQL: select subject_class_id, student_id from enrollments where id = id)
+    current = db.session.execute(db.select(Enrollment.subject_class_id, Enrollment.student_id).where(Enrollment.id == id)).first()
+    if current is None:
     # A 404 error with a custom message will be returned if there is no enrolment with that id. 
         return {'error': f'Enrolment not found with enrolment_id {id}.'}, 404
+    # Moving the enrollment to another class gives back its place in the old class and takes a place in the new one (which is rejected if the new class is full).
+    new_class_id = data.get('subject_class_id')
+    if new_class_id is not None and new_class_id != current.subject_class_id:
+        release_places(Enrollment.id == id)
+        if not reserve_places(new_class_id):
+            return _class_unavailable(new_class_id)
+    try:
+        enrollment, _ = update_returning(Enrollment, id, data, ['date', 'subject_class_id', 'student_id'], returning=ENROLLMENT_COLUMNS)
+    except IntegrityError:
+        return {'error': 'Foriegn Key Error. Either the student_id or subject_class_id does not exsit in the database'}, 409
+    if (enrollment.subject_class_id, enrollment.student_id) != tuple(current): # The timetables of the old and new student are recalculated if the enrollment moved
+        refresh_timetable_masks(Student.id.in_({current.student_id, enrollment.student_id}))
+    return dump(get_schema(EnrollmentSchema, only=ENROLLMENT_COLUMNS), enrollment)
 
 # DELETE Enrollment
 @enrollments_bp.route('/<int:id>/', methods=['DELETE'])
@@ -97,12 +246,11 @@ def delete_one_enrollment(id):
     # A route to delete one enrollment resource
     #(Delete from enrollments where id = id;)
     #Select the correct enrollement resource through a query
-    stmt = db.select(Enrollment).filter_by(id=id)
-    enrollment = db.session.scalar(stmt)# Execute query
-     # If an enrollment exists with the specified id delete the enrollment and return a message in JSON stating the deletion was successul. 
+    release_places(Enrollment.id == id) # Give the student's place in the class back
+    refresh_timetable_masks(Student.id.in_(db.select(Enrollment.student_id).where(Enrollment.id == id)), leaving=Enrollment.id == id) # Clear the class's timetable line unless the student has another class on it
+    enrollment = delete_returning(Enrollment, id, returning=['student_id', 'subject_class_id'])
+     # If an enrollment existed with the specified id it has been deleted, so return a message in JSON stating the deletion was successul. 
     if enrollment:
-        db.session.delete(enrollment)
-        db.session.commit()
         return {'message': f'The student with student_id {enrollment.student_id} was unenrolled from {enrollment.subject_class_id} successfully.'}
     # If the resource doesn't exist return a 404 with a descriptive error message. 
     else:
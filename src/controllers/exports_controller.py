@@ -0,0 +1,91 @@
+# This module contains routes for exporting data as files that can be opened in a spreadsheet or loaded into another system.
+# Exports can cover the whole school, so rather than loading every row and building the file in memory the rows are read from the database in batches (with a server-side cursor on PostgreSQL) and each batch is written to the response as soon as it is read. Memory use stays the same however big the school is and the client starts receiving the file straight away.
+import csv
+import io
+from datetime import date
+from flask import Blueprint, Response, current_app, stream_with_context
+from flask_jwt_extended import jwt_required
+from sqlalchemy.orm import aliased
+from init import db
+from models.enrollment import Enrollment
+from models.student import Student
+from models.subject_class import SubjectClass
+from models.subject import Subject
+from models.employee import Employee
+from models.user import User
+from controllers.auth_controller import auth_employee
+from filtering import apply_filters
+
+exports_bp = Blueprint('exports', __name__, url_prefix='/exports')
+
+EXPORT_BATCH_SIZE = 1000 # The number of rows read from the database and written to the response at a time
+
+# The query parameters a roster can be filtered by (for example ?subject_class_id=09MAB01-2023, ?homegroup=09WH1 or ?year_level=9)
+ROSTER_FILTERS = {'subject_class_id': Enrollment.subject_class_id, 'homegroup': Student.homegroup, 'year_level': Student.year_level}
+
+teacher = aliased(User, name='teacher')
+# The columns of a roster, one row per enrollment. These are selected directly rather than loading model instances so no objects are built for each row.
+ROSTER_COLUMNS = {
+    'subject_class_id': Enrollment.subject_class_id,
+    'subject_id': Subject.id,
+    'subject_name': Subject.name,
+    'timetable_line': SubjectClass.timetable_line,
+    'room': SubjectClass.room,
+    'teacher_first_name': teacher.first_name,
+    'teacher_last_name': teacher.last_name,
+    'student_id': Student.id,
+    'first_name': User.first_name,
+    'last_name': User.last_name,
+    'homegroup': Student.homegroup,
+    'year_level': Student.year_level,
+    'enrollment_date': Enrollment.date
+}
+
+# READ Roster
+# A route to export the students enrolled in each class, as CSV (/exports/roster.csv) or as one JSON object per line (/exports/roster.ndjson). Without filters the whole school is exported.
+# Rows are in class order and then in the order the students were enrolled, which is the order of the enrollments index so the database can start returning rows without sorting them first.
+# (SQL: select ... from enrollments join subject_classes ... join subjects ... join students ... join users ... left join employees ... left join users as teacher ... where ... order by subject_class_id, enrollments.id)
+@exports_bp.route('/roster.<any(csv, ndjson):format>')
+@jwt_required()
+def export_roster(format):
+    auth_employee()
+    stmt = (db.select(*ROSTER_COLUMNS.values())
+        .join(SubjectClass, Enrollment.subject_class_id == SubjectClass.id)
+        .join(Subject, SubjectClass.subject_id == Subject.id)
+        .join(Student, Enrollment.student_id == Student.id)
+        .join(User, Student.user_id == User.id)
+        .outerjoin(Employee, SubjectClass.employee_id == Employee.id)
+        .outerjoin(teacher, Employee.user_id == teacher.id)
+        .order_by(Enrollment.subject_class_id, Enrollment.id))
+    stmt = apply_filters(stmt, ROSTER_FILTERS) # The filters are checked before the response starts so an invalid one still returns a 400 error
+    write = _csv_lines if format == 'csv' else _ndjson_lines
+    response = Response(stream_with_context(write(stmt)), mimetype='text/csv' if format == 'csv' else 'application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename=roster.{format}'
+    response.headers['X-Accel-Buffering'] = 'no' # Tells nginx to pass each batch on rather than buffering the whole file
+    return response
+
+# Executes the statement and yields its rows in batches. yield_per reads EXPORT_BATCH_SIZE rows at a time, using a server-side cursor on databases that support one.
+def _batches(stmt):
+    result = db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    try:
+        yield from result.partitions()
+    finally:
+        result.close()
+
+def _csv_lines(stmt):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(ROSTER_COLUMNS) # The header row is sent before the query runs
+    yield buffer.getvalue()
+    for batch in _batches(stmt):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+def _ndjson_lines(stmt):
+    names = list(ROSTER_COLUMNS)
+    dumps = current_app.json.dumps
+    for batch in _batches(stmt):
+        # Dates are written as ISO strings (YYYY-MM-DD) like the rest of the API
+        yield ''.join(dumps({name: value.isoformat() if isinstance(value, date) else value for name, value in zip(names, row)}) + '\n' for row in batch)
@@ -0,0 +1,31 @@
+# This module contains routes that report whether the API and its database are working, for load balancers and monitoring. They don't need a token so they can be called by tools that can't log in.
+import time
+from flask import Blueprint
+from sqlalchemy.exc import SQLAlchemyError
+from init import db, replicas
+from database import pool_stats
+
+health_bp = Blueprint('health', __name__, url_prefix='/health')
+
+# READ Database health
+# Runs a trivial query (SQL: select 1) on the primary database and on each read replica and returns how long it took along with the state of this worker's connection pools. Comparing checked_out with size + overflow under load shows whether a pool is big enough. If the primary can't be reached a 503 is returned. A replica that can't be reached is reported but doesn't fail the check, as reads fall back to the primary.
+@health_bp.route('/db')
+def database_health():
+    result = _check(db.engine)
+    if replicas.engines:
+        result['replicas'] = {key: dict(_check(engine), in_use=replicas.healthy(key)) for key, engine in replicas.engines.items()}
+    return result, 200 if result['status'] == 'ok' else 503
+
+def _check(engine):
+    start = time.perf_counter()
+    try:
+        with engine.connect() as connection: # The connection is returned to the pool before its stats are read
+            connection.execute(db.text('SELECT 1'))
+        status = 'ok'
+    except SQLAlchemyError as err:
+        status = f'unavailable: {err.__class__.__name__}'
+    return {
+        'status': status,
+        'latency_ms': round((time.perf_counter() - start) * 1000, 2),
+        'pool': pool_stats(engine)
+    }
@@ -0,0 +1,13 @@
+# This module contains the route Prometheus scrapes for the API's runtime metrics (see metrics.py). Like the health checks it doesn't need a token so the scraper doesn't have to log in; set METRICS=false to turn it off.
+from flask import Blueprint, abort
+from init import metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# READ Metrics
+# Returns the request counts, latency histograms, database time and response bytes of every route, and the memory, threads and connection pools of each worker, in the Prometheus text format.
+@metrics_bp.route('/metrics')
+def get_metrics():
+    if not metrics.enabled:
+        abort(404)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
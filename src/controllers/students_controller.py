@@ -2,11 +2,18 @@
 from flask import Blueprint, request, abort
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from sqlalchemy.exc import IntegrityError
-from init import db, bcrypt
-from models.student import Student, StudentSchema
+from init import db, hasher
+from models.student import Student, StudentSchema, timetable_summaries
 from models.student_relation import StudentRelation, StudentRelationSchema
 from models.user import User, UserSchema
-from controllers.auth_controller import auth_employee, auth_admin, auth_employee_or_self
+from models.enrollment import Enrollment
+from models.subject_class import SubjectClass, SubjectClassSchema, release_places
+from controllers.auth_controller import auth_employee, auth_admin, auth_employee_or_self, invalidate_principal, bump_token_version
+from pagination import paginate, get_sort
+from filtering import apply_filters
+from loading import loading_plan
+from schemas import get_schema, request_schema, dump
+from dml import update_returning, delete_returning, column_fields
 
 # Adding a blueprint for students. This will automatically add the prefix students to the start of all URL's with this blueprint. 
 students_bp = Blueprint('students', __name__, url_prefix='/students') # students is a resource made available through the API
@@ -19,14 +26,14 @@ def create_user_and_student():
     auth_admin()
     # Create a new student and user model instance for the new student.  
     # first create a new instance of the user based on the provided input. (SQL: Insert into users (title, first_name...) values...)
-    data = UserSchema().load(request.json)
+    data = get_schema(UserSchema).load(request.json)
     try:
         user =  User(
             title = data['title'],
             first_name = data['first_name'],
             middle_name = data['middle_name'],
             last_name = data['last_name'],
-            password = bcrypt.generate_password_hash(request.json['password']).decode('utf8'),
+            password = hasher.hash_password(request.json['password']),
             email = data['email'],
             phone = data['phone'],
             dob = data['dob'],
@@ -34,7 +41,7 @@ def create_user_and_student():
             type = data['type'] 
         )
         db.session.add(user)
-        db.session.commit() # commit new user to the db
+        db.session.flush() # Writes the new user so its id can be given to the student. The user and student are committed together at the end of the request.
         
         # Now create a new student instance (SQL: Insert into student (homegroup, enrolment_date...) values...)
         student = Student(
@@ -45,21 +52,27 @@ def create_user_and_student():
             birth_country = data['student']['birth_country']
         )
         db.session.add(student)
-        db.session.commit()
-        return StudentSchema(exclude= ["student_relations"]).dump(student), 201
+        db.session.flush()
+        return dump(get_schema(StudentSchema, exclude= ["student_relations"]), student), 201
     except IntegrityError:
         return {'error': 'Email address already in use'}, 409
 
 # READ Student
+# The query parameters the list of students can be filtered by (for example ?year_level=9&homegroup=WH01) and the fields it can be sorted by (for example ?sort=-year_level,homegroup)
+STUDENT_FILTERS = {'year_level': Student.year_level, 'homegroup': Student.homegroup, 'birth_country': Student.birth_country}
+STUDENT_SORTS = dict(STUDENT_FILTERS, id=Student.id)
+
 @students_bp.route('/')
 @jwt_required() 
 def get_all_students():
     auth_employee() # only users who are employees can access this route. 
 
-# A route to return all instances of the students resource in assending order by ID (SQL: select * from students order by id)
-    stmt = db.select(Student).order_by(Student.id) # Build query
-    students = db.session.scalars(stmt) # Execute query
-    return StudentSchema(many=True, exclude = ['student_relations']).dump(students) # Respond to client
+# A route to return one page of the students resource in assending order by ID (SQL: select * from students where year_level = :year_level and id > :after order by id limit :limit)
+    schema = request_schema(StudentSchema, many=True, exclude = ['student_relations'])
+    stmt = db.select(Student).options(*loading_plan(Student, schema)) # Build query. The nested user is joined into the same query rather than lazy loaded for each student.
+    stmt = apply_filters(stmt, STUDENT_FILTERS)
+    students, headers = paginate(stmt, *get_sort(STUDENT_SORTS, Student.id)) # Execute query for the requested page
+    return dump(schema, students), headers # Respond to client with the link to the next page in the headers
 
 # This specifies a restful parameter of student_id that will be an integer. It will only match if the value passed in is an integer. 
 @students_bp.route('/<int:student_id>/') # Note this is student_id not user_id
@@ -69,33 +82,41 @@ def get_one_student(student_id):
     # Find the user who made the request and check they have authorisation to view that student's details
     # A route to retrieve a single student resource based on their student_id
     # (SQL: select * from students where id=student_id)
-    stmt = db.select(Student).filter_by(id=student_id) # Build query
+    schema = request_schema(StudentSchema)
+    stmt = db.select(Student).filter_by(id=student_id).options(*loading_plan(Student, schema)) # Build query
     student = db.session.scalar(stmt) # Execute query (scalar is singular as only one student instance is returned. 
     if student:  # If the student_id belongs to an exsiting student then return that student instance
-        return StudentSchema().dump(student) # remove the many=True because we are only returning a single Student. 
+        return dump(schema, student) # remove the many=True because we are only returning a single Student. 
     else:
         # A 404 error with a custom message will be returned if there is no student with that student_id.  
         return {'error': f'Student not found with id {student_id}.'}, 404
 
+# READ Student Timetable
+# A route to return the classes a student is enrolled in, in timetable line order, along with the lines they have classes on as a bitmask (timetable_mask, where line 1 is 1, line 2 is 2, line 3 is 4 and so on) and the lines where two or more of their classes clash.
+# (SQL: select * from subject_classes join enrollments on ... where enrollments.student_id = student_id order by timetable_line, id)
+@students_bp.route('/<int:student_id>/timetable')
+@jwt_required()
+def get_student_timetable(student_id):
+    auth_employee_or_self(student_id)
+    if db.session.get(Student, student_id) is None:
+        return {'error': f'Student not found with id {student_id}.'}, 404
+    schema = get_schema(SubjectClassSchema, many=True, only=['id', 'room', 'timetable_line', 'subject.id', 'subject.name', 'employee'])
+    stmt = db.select(SubjectClass).join(Enrollment).where(Enrollment.student_id == student_id).order_by(SubjectClass.timetable_line, SubjectClass.id).options(*loading_plan(SubjectClass, schema)) # Build query
+    subject_classes = db.session.scalars(stmt).all() # Execute query
+    return dict(student_id=student_id, **timetable_summaries([student_id])[student_id], classes=dump(schema, subject_classes))
+
 # UPDATE Student
+STUDENT_COLUMNS = column_fields(Student, StudentSchema) # The student's own fields, which are returned by the update route
+
 @students_bp.route('/<int:student_id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def update_one_student(student_id):
     auth_admin()
-    # A route to update one student resource (SQL: Update students set .... where id = id)
-    stmt = db.select(Student).filter_by(id=student_id) # Build query
-    student = db.session.scalar(stmt) # Execute query
- 
-    data = StudentSchema().load(request.json) # this applies the validation rules set on the schema.
-    
-    if student: # If a student with that id exsists then update any provided fields
-        student.homegroup = data.get('homegroup') or student.homegroup # The get method will return none if the key doesn't exist rather than raising an exception. 
-        student.enrollment_date = data.get('enrollment_date') or student.enrollment_date
-        student.year_level = data.get('year_level') or student.year_level
-        student.birth_country = data.get('birth_country') or student.birth_country
-
-        db.session.commit() # commit all changes to db      
-        return StudentSchema(exclude= ['student_relations']).dump(student) # Respond to client
+    # A route to update one student resource with a single statement (SQL: Update students set .... where id = id returning ...). Only the fields provided are changed.
+    data = get_schema(StudentSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    student, _ = update_returning(Student, student_id, data, ['homegroup', 'enrollment_date', 'year_level', 'birth_country'], returning=STUDENT_COLUMNS)
+    if student: # If a student with that id exsists then return it with the changes
+        return dump(get_schema(StudentSchema, only=STUDENT_COLUMNS), student) # Respond to client
     else:# If there is no student in a database with that provided id return a not found (404) error with a custom error message.
         return {'error': f'Student not found with student ID{student_id}.'}, 404
 
@@ -104,13 +125,13 @@ def update_one_student(student_id):
 @jwt_required()
 def delete_one_student(student_id):
     auth_admin()
-    # A route to delete one student resource (SQL: Delete from students where id=student_id)
-    stmt = db.select(Student).filter_by(id=student_id) # Build query to select the student
-    student = db.session.scalar(stmt) # Execute query
-    # if the user's student_id exsists delete their records from the database
+    # A route to delete one student resource (SQL: Delete from students where id=student_id). The database deletes their enrollments and student relations with them (ON DELETE CASCADE).
+    release_places(Enrollment.student_id == student_id) # The student's enrollments are deleted with them so their places in each class are given back
+    student = delete_returning(Student, student_id, returning=['id', 'user_id'])
+    # if the student_id existed their records have been deleted from the database
     if student:
-        db.session.delete(student)
-        db.session.commit()
+        bump_token_version(User.id == student.user_id) # Tokens carrying this student_id stop working
+        invalidate_principal(student.user_id)
         return {'message': f'The records for the student with Student ID{student.id} were deleted successfully'} # Respond to client
     # If the student_id doesn't exist in the database return a not found (404) error
     else:
@@ -125,7 +146,7 @@ def delete_one_student(student_id):
 def create_student_relations():
     auth_admin()  
     # Create a new instance of the student_relation based on the provided input. (SQL: Insert into student_relations (relationship_to_student...) values...)
-    data = StudentRelationSchema().load(request.json) 
+    data = get_schema(StudentRelationSchema).load(request.json) 
     student_relation =  StudentRelation(       
         relationship_to_student = data['relationship_to_student'],
         is_primary_contact = data['is_primary_contact'],
@@ -133,19 +154,20 @@ def create_student_relations():
         student_id = data['student_id']
     )
     db.session.add(student_relation)
-    db.session.commit() # commit new relationship to the db
+    db.session.flush() # Writes the new relationship so its student and user can be loaded for the response
     
-    return StudentRelationSchema().dump(student_relation), 201 # Respond to client
+    return dump(get_schema(StudentRelationSchema), student_relation), 201 # Respond to client
 
 # READ Student Relations 
 @students_bp.route('/relations/') 
 @jwt_required()
 def get_all_student_relations():
     auth_employee() # Must be an authenticated employee 
-# A route to return all student_caregiver relationships recorded in assending order by student_id (SQL: select * from student_relations order by student_id)
-    stmt = db.select(StudentRelation).order_by(StudentRelation.student_id) # Build query
-    student_relations = db.session.scalars(stmt) # Execute query
-    return StudentRelationSchema(many=True, exclude=['user', 'student']).dump(student_relations) # Respond to client
+# A route to return one page of the student_caregiver relationships recorded in assending order by student_id (SQL: select * from student_relations order by student_id, id limit :limit)
+    schema = request_schema(StudentRelationSchema, many=True, exclude=['user', 'student'])
+    stmt = db.select(StudentRelation).options(*loading_plan(StudentRelation, schema)) # Build query
+    student_relations, headers = paginate(stmt, StudentRelation.student_id) # Execute query for the requested page
+    return dump(schema, student_relations), headers # Respond to client
 
 # This specifies a restful parameter of caregiver_id that will be an integer. It will only match if the value passed in is an integer.  This will allow a caregiver to check/query the relationships they have on record for the students they care for. The caregiver_id is their user_id
 # @students_bp.route('/relations/<int:caregiver_id>/') 
@@ -168,32 +190,26 @@ def get_one_student_relation(student_relation_id):
     auth_employee()
     # A route to retrieve a single student_relation resource based on their student_relation_id
     # (SQL: select * from students_relations where id=student_relation_id)
-    stmt = db.select(StudentRelation).filter_by(id=student_relation_id) # Build query
+    schema = request_schema(StudentRelationSchema)
+    stmt = db.select(StudentRelation).filter_by(id=student_relation_id).options(*loading_plan(StudentRelation, schema)) # Build query
     student = db.session.scalar(stmt) # Execute query (scalar is singular as only one student_relation instance is returned. 
     if student:  # If the student_relations_id belongs to an exsiting student-caregiver relationship then return that instance
-        return StudentRelationSchema().dump(student) # remove the many=True because we are only returning a single student_relation. 
+        return dump(schema, student) # remove the many=True because we are only returning a single student_relation. 
     else:
         # A 404 error with a custom message will be returned if there is no student_relation with that id.  
         return {'error': f'A record of the student-caregiver relationship with id {student_relation_id} was not found.'}, 404
 # UPDATE
+STUDENT_RELATION_COLUMNS = column_fields(StudentRelation, StudentRelationSchema)
+
 @students_bp.route('/relations/<int:student_relation_id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def update_one_student_relation(student_relation_id):
     auth_admin()
-    # A route to update a single student_relation resource based on their student_relation_id (SQL: Update student_relations set .... where id = id)
-    stmt = db.select(StudentRelation).filter_by(id=student_relation_id) # Build query
-    student_relation = db.session.scalar(stmt) # Execute query
- 
-    data = StudentRelationSchema().load(request.json) # this applies the validation rules set on the schema.
-    
-    if student_relation: # If a student with that id exsists then update any provided fields
-        student_relation.relationship_to_student = data.get('relationship_to_student') or student_relation.relationship_to_student # The get method will return none if the key doesn't exist rather than raising an exception. 
-        student_relation.is_primary_contact = data.get('is_primary_contact') 
-        student_relation.user_id = data.get('user_id') or student_relation.user_id
-        student_relation.student_id = data.get('student_id') or student_relation.student_id
-
-        db.session.commit() # commit all changes to db      
-        return StudentRelationSchema().dump(student_relation) # Respond to client
+    # A route to update a single student_relation resource with a single statement (SQL: Update student_relations set .... where id = id returning ...). Only the fields provided are changed.
+    data = get_schema(StudentRelationSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    student_relation, _ = update_returning(StudentRelation, student_relation_id, data, STUDENT_RELATION_COLUMNS, returning=STUDENT_RELATION_COLUMNS) # A user_id or student_id that doesn't exist is returned as a 409 error
+    if student_relation: # If a relationship with that id exsists then return it with the changes
+        return dump(get_schema(StudentRelationSchema, only=STUDENT_RELATION_COLUMNS), student_relation) # Respond to client
     else:# If there is no student in a database with that provided id return a not found (404) error with a custom error message.
         return {'error': f'A record of the student-caregiver relationship with id {student_relation_id} was not found.'}, 404
 
@@ -203,12 +219,9 @@ def update_one_student_relation(student_relation_id):
 def delete_one_student_relation(student_relation_id):
     auth_admin()
     # A route to delete a single student_relation resource based on their student_relation_id (SQL: Delete from student_relations where id=student_relations_id)
-    stmt = db.select(StudentRelation).filter_by(id=student_relation_id) # Build query to select the student/caregiver relationship to delete
-    student_relation = db.session.scalar(stmt) # Execute query
-    # if the user's student_relation_id exsists delete the record from the database
+    student_relation = delete_returning(StudentRelation, student_relation_id, returning=['relationship_to_student'])
+    # if the student_relation_id existed the record has been deleted from the database
     if student_relation:
-        db.session.delete(student_relation)
-        db.session.commit()
         return {'message': f'The record of the Student-{student_relation.relationship_to_student} relationship with student_relation_id {student_relation_id} was successfully deleted'} # Respond to client
     # If the student_relation_id doesn't exist in the database return a not found (404) error
     else:
@@ -4,8 +4,16 @@ from sqlalchemy.exc import IntegrityError
 from init import db
 from models.subject_class import SubjectClass, SubjectClassSchema
 from models.subject import Subject, SubjectSchema
+from models.student import Student, refresh_timetable_masks
+from models.enrollment import Enrollment
 from flask_jwt_extended import jwt_required
 from controllers.auth_controller import auth_admin, auth_employee
+from pagination import paginate, get_sort
+from filtering import apply_filters
+from loading import loading_plan
+from catalog import cached_response
+from schemas import get_schema, request_schema, dump
+from dml import update_returning, delete_returning, column_fields
 
 # Add a blueprint for subjects. This will automatically add the prefix subject to the start of all URL's with this blueprint. 
 subjects_bp = Blueprint('subjects', __name__, url_prefix='/subjects') 
@@ -17,7 +25,7 @@ subjects_bp = Blueprint('subjects', __name__, url_prefix='/subjects')
 def create_subject():
     auth_admin()
     # Create a new Subject model instance (SQL: Insert into subjects (id, name...) values...)
-    data = SubjectSchema().load(request.json) # This applies the validation rules set on the schema. 
+    data = get_schema(SubjectSchema).load(request.json) # This applies the validation rules set on the schema. 
     try:
         subject = Subject(
             id = data['id'], # Subject_id's are a semantic string 
@@ -26,11 +34,11 @@ def create_subject():
             max_students = data.get('max_students'), # Get allows this field to be left blank and the default value to be set. 
             department = data['department']
         )
-        # Add and commit subject to DB
+        # Add subject to DB
         db.session.add(subject)
-        db.session.commit()
+        db.session.flush() # A subject id that is already in use is found here
         # Respond to client
-        return SubjectSchema(exclude= ['subject_classes']).dump(subject), 201
+        return dump(get_schema(SubjectSchema, exclude= ['subject_classes']), subject), 201
     except IntegrityError:
         return {'error': 'Subject_id address already in use'}, 409
     
@@ -38,10 +46,14 @@ def create_subject():
 # READ Subject
 @subjects_bp.route('/')
 def get_all_subjects():
-    # A route to return all instances of the subjects resource in assending order by subject id (select * from subjects order by id)
-    stmt = db.select(Subject).order_by(Subject.id) # Build query
-    subjects = db.session.scalars(stmt) # Execute query
-    return SubjectSchema(many=True, exclude=["subject_classes"]).dump(subjects) # Respond to client
+    # A route to return one page of the subjects resource in assending order by subject id (select * from subjects order by id limit :limit)
+    # This is the most frequently polled route so the response is served from the catalog cache and the query only runs when the catalog has changed.
+    def build():
+        schema = request_schema(SubjectSchema, many=True, exclude=["subject_classes"])
+        stmt = db.select(Subject).options(*loading_plan(Subject, schema)) # Build query
+        subjects, headers = paginate(stmt, Subject.id) # Execute query for the requested page
+        return dump(schema, subjects), headers # Respond to client
+    return cached_response(build)
 
 @subjects_bp.route('/<string:id>/') # subject id's are strings (for semantic identification) It consists of the year level and a 2-3 letter abbreviation of the subject name
 @jwt_required() 
@@ -49,36 +61,33 @@ def get_one_subject(id):
     
     # A route to return one instance of a subject resource based on the subject id. 
     # (select * from subjects where id=id)
-    stmt = db.select(Subject).filter_by(id=id) # Build the query
-    subject = db.session.scalar(stmt) # Execute the query
-    if subject: # If the subject_id belongs to an exsiting subject then return that subject instance   
-        return SubjectSchema().dump(subject) # Respond to client
-    else:
-        # A 404 error with a custom message will be returned if there is no subject with that id.    
-        return {'error': f'Subject not found with id {id}.'}, 404
+    # The response is the same for every user so it is served from the catalog cache.
+    def build():
+        schema = request_schema(SubjectSchema)
+        stmt = db.select(Subject).filter_by(id=id).options(*loading_plan(Subject, schema)) # Build the query
+        subject = db.session.scalar(stmt) # Execute the query
+        if subject: # If the subject_id belongs to an exsiting subject then return that subject instance   
+            return dump(schema, subject) # Respond to client
+        else:
+            # A 404 error with a custom message will be returned if there is no subject with that id.    
+            return {'error': f'Subject not found with id {id}.'}, 404
+    return cached_response(build)
 
 # UPDATE Subject
+SUBJECT_COLUMNS = column_fields(Subject, SubjectSchema) # The subject's own fields, which are returned by the update route. Its classes aren't loaded.
+
 @subjects_bp.route('/<string:id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def update_one_subject(id):
     auth_admin()
-    # A route to update one subject resource (SQL: Update subjects set .... where id = id)
-    stmt = db.select(Subject).filter_by(id=id) # Build query
-    subject = db.session.scalar(stmt) # Execute query
-    data = SubjectSchema().load(request.json, partial=True) # This applies the validation rules set on the schema. 
-    # If a subject with that id exsists then update any provided fields
-    if subject:
-        try: 
-            subject.id = data.get('id') or subject.id 
-            subject.name = data.get('name') or subject.name
-            subject.year_level = data.get('year_level') or subject.year_level
-            subject.max_students = data.get('max_students') or subject.max_students
-            subject.department = data.get('department') or subject.department
-                
-            db.session.commit()      
-            return SubjectSchema().dump(subject)
-        except IntegrityError:
-            return {'error': 'Subject_id address already in use'}, 409
+    # A route to update one subject resource with a single statement (SQL: Update subjects set .... where id = id returning ...). Only the fields provided are changed.
+    data = get_schema(SubjectSchema).load(request.json, partial=True) # This applies the validation rules set on the schema. 
+    try:
+        subject, _ = update_returning(Subject, id, data, SUBJECT_COLUMNS, returning=SUBJECT_COLUMNS)
+    except IntegrityError:
+        return {'error': 'Subject_id address already in use'}, 409
+    if subject: # If a subject with that id exsists then return it with the changes
+        return dump(get_schema(SubjectSchema, only=SUBJECT_COLUMNS), subject)
     else:
     # A 404 error with a custom message will be returned if there is no subject with that id. 
         return {'error': f'Subject not found with id {id}.'}, 404
@@ -88,12 +97,11 @@ def update_one_subject(id):
 @jwt_required()
 def delete_one_subject(id):
     auth_admin()
-    # A route to delete one subject resource (SQL: Delete from subjects where id=id)
-    stmt = db.select(Subject).filter_by(id=id) # Build query
-    subject = db.session.scalar(stmt) # Execute query
-    if subject:  # if the subject_id exsists delete the subject record from the database
-        db.session.delete(subject)
-        db.session.commit() # Commit transaction
+    # A route to delete one subject resource (SQL: Delete from subjects where id=id). The database deletes its classes and their enrollments with it (ON DELETE CASCADE), so this takes the same time however many students are enrolled.
+    # The timetables of the students in the subject's classes are recalculated without those classes first, while the enrollments still show who they are.
+    refresh_timetable_masks(Student.id.in_(db.select(Enrollment.student_id).join(SubjectClass).where(SubjectClass.subject_id == id)), leaving=SubjectClass.subject_id == id)
+    subject = delete_returning(Subject, id, returning=['id', 'name', 'year_level'])
+    if subject:  # if the subject_id existed the subject record has been deleted from the database
         return {'message': f'Year {subject.year_level} {subject.name} ({subject.id}) was deleted successfully.'}
 
     else:
@@ -106,7 +114,7 @@ def create_subject_class(subject_id):
     auth_admin()
     # Create a new SubjectClass model instance
     # Select the subject to add a class to based on the incoming subject_id
-    data = SubjectClassSchema().load(request.json) # This applies the validation rules set on the schema. 
+    data = get_schema(SubjectClassSchema).load(request.json) # This applies the validation rules set on the schema. 
     # Build the query to select the correct subject. 
     stmt = db.select(Subject).filter_by(id=subject_id)
     subject = db.session.scalar(stmt) # Execute query
@@ -120,11 +128,11 @@ def create_subject_class(subject_id):
                 timetable_line = data['timetable_line'],
                 subject = subject
             )
-            # Add and commit subject_class to DB
+            # Add subject_class to DB
             db.session.add(subject_class)
-            db.session.commit()
+            db.session.flush()
             # Respond to client
-            return SubjectClassSchema(exclude=['enrollments']).dump(subject_class), 201
+            return dump(get_schema(SubjectClassSchema, exclude=['enrollments']), subject_class), 201
         except IntegrityError:
             return {'error': 'Either the subject_class_id is already in use or there is not teacher in the system with that employee_id.'}, 409
     # If there is no subject in a database with that provided id return a not found (404) error with a custom error message.
@@ -133,13 +141,19 @@ def create_subject_class(subject_id):
 
 
 # READ SubjectClass
+# The query parameters the list of classes can be filtered by (for example ?timetable_line=2&employee_id=1) and the fields it can be sorted by
+SUBJECT_CLASS_FILTERS = {'timetable_line': SubjectClass.timetable_line, 'employee_id': SubjectClass.employee_id}
+SUBJECT_CLASS_SORTS = dict(SUBJECT_CLASS_FILTERS, id=SubjectClass.id)
+
 @subjects_bp.route('/classes/') 
 @jwt_required()
 def get_all_subject_classes():
-    # A route to return all instances of the classes resource. (SQL: select * from subject_classes)
-    stmt = db.select(SubjectClass) # Build query
-    subject_classes = db.session.scalars(stmt) # Execute query
-    return SubjectClassSchema(many=True, exclude=['enrollments']).dump(subject_classes) # Respond to client
+    # A route to return one page of the classes resource in assending order by class id. (SQL: select * from subject_classes order by id limit :limit)
+    schema = request_schema(SubjectClassSchema, many=True, exclude=['enrollments'])
+    stmt = db.select(SubjectClass).options(*loading_plan(SubjectClass, schema)) # Build query. The subject and teacher of each class are joined into the same query.
+    stmt = apply_filters(stmt, SUBJECT_CLASS_FILTERS)
+    subject_classes, headers = paginate(stmt, *get_sort(SUBJECT_CLASS_SORTS, SubjectClass.id)) # Execute query for the requested page
+    return dump(schema, subject_classes), headers # Respond to client
 
 
 @subjects_bp.route('/classes/<string:subject_class_id>/')
@@ -147,39 +161,33 @@ def get_all_subject_classes():
 def get_one_subject_class(subject_class_id):
     auth_employee()
     # A route to return one instance of a subject class based on the subject_class_id. 
-    stmt = db.select(SubjectClass).filter_by(id=subject_class_id)
+    schema = request_schema(SubjectClassSchema)
+    stmt = db.select(SubjectClass).filter_by(id=subject_class_id).options(*loading_plan(SubjectClass, schema)) # The class roster (enrollments, students and their users) is loaded in a fixed number of queries.
     subject_classes = db.session.scalar(stmt)
     if subject_classes:    
-        return SubjectClassSchema().dump(subject_classes)
+        return dump(schema, subject_classes)
     else:
         # This is the error that will be returned if there is no subject with that ID.
         #  This will return a not found 404 error.  
         return {'error': f'Class not found with id {subject_class_id}.'}, 404
 
 # UPDATE SubjectClass
+SUBJECT_CLASS_COLUMNS = column_fields(SubjectClass, SubjectClassSchema) # The class's own fields, which are returned by the update route
+
 @subjects_bp.route('/classes/<string:subject_class_id>/', methods=['PUT', 'PATCH']) 
 @jwt_required() 
 def update_one_subject_class(subject_class_id):
     auth_admin()
-# A route to update one subject_class resource (SQL: Update subjects_classes set .... where id = id)
-    stmt = db.select(SubjectClass).filter_by(id=subject_class_id) # Build query
-    subject_class = db.session.scalar(stmt) # Execute query
-
-    data = SubjectClassSchema().load(request.json) # this applies the validation rules set on the schema.
-    if subject_class:  # If a subject_class with that id exsists then update any provided fields 
-        try: 
-            subject_class.employee_id = data.get('employee_id') or subject_class.employee_id,
-            subject_class.room = data.get('room') or subject_class.room,
-            subject_class.timetable_line = data.get('timetable_line') or subject_class.timetable_line
-        
-            # Add and commit subject_class to DB
-            db.session.add(subject_class)
-            db.session.commit()
-            # Respond to client
-            return SubjectClassSchema(exclude=['enrollments']).dump(subject_class), 201
-        except IntegrityError:
-            return {'error': 'Either the subject_class_id is already in use or there is no teacher with that employee_id'}, 409
-        
+    # A route to update one subject_class resource with a single statement (SQL: Update subjects_classes set .... where id = id returning ...). Only the fields provided are changed.
+    data = get_schema(SubjectClassSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    try:
+        subject_class, changed = update_returning(SubjectClass, subject_class_id, data, ['employee_id', 'room', 'timetable_line'], returning=SUBJECT_CLASS_COLUMNS)
+    except IntegrityError:
+        return {'error': 'Either the subject_class_id is already in use or there is no teacher with that employee_id'}, 409
+    if subject_class:  # If a subject_class with that id exsists then return it with the changes
+        if changed and 'timetable_line' in data: # The class may have moved to another timetable line
+            refresh_timetable_masks(Student.id.in_(db.select(Enrollment.student_id).where(Enrollment.subject_class_id == subject_class_id)))
+        return dump(get_schema(SubjectClassSchema, only=SUBJECT_CLASS_COLUMNS), subject_class) # Respond to client
     # If there is no student in a database with that provided id return a not found (404) error with a custom error message.
     else:  
         return {'error': f'Class not found with id {subject_class_id}.'}, 404
@@ -189,13 +197,11 @@ def update_one_subject_class(subject_class_id):
 @jwt_required()
 def delete_one_subject_class(subject_class_id):
     auth_admin()
-    # A route to delete one subject_class resource (SQL: Delete from subject_classes where id=subject_class_id)
-    stmt = db.select(SubjectClass).filter_by(id=subject_class_id) # Build query to select the subject_class
-    subject_class = db.session.scalar(stmt) # Execute query
-    # if the subject_class_id exsists delete its records from the database
+    # A route to delete one subject_class resource (SQL: Delete from subject_classes where id=subject_class_id). The database deletes the class's enrollments with it (ON DELETE CASCADE).
+    refresh_timetable_masks(Student.id.in_(db.select(Enrollment.student_id).where(Enrollment.subject_class_id == subject_class_id)), leaving=Enrollment.subject_class_id == subject_class_id) # Clear the class's timetable line from its students' timetables first
+    subject_class = delete_returning(SubjectClass, subject_class_id, returning=['id'])
+    # if the subject_class_id existed its records have been deleted from the database
     if subject_class:
-        db.session.delete(subject_class)
-        db.session.commit()
         return {'message': f'The records for the Subject Class ID {subject_class_id} were deleted successfully'} # Respond to client
     # If the subject_class_id doesn't exist in the database return a not found (404) error
     else:
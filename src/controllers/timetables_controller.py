@@ -0,0 +1,25 @@
+# This module contains the routes that report on the timetables of many students at once, for example to find every student in a year level with a timetable clash.
+from flask import Blueprint
+from flask_jwt_extended import jwt_required
+from sqlalchemy.orm import load_only
+from init import db
+from models.student import Student, timetable_summaries
+from controllers.auth_controller import auth_employee
+from controllers.students_controller import STUDENT_FILTERS
+from pagination import paginate
+from filtering import apply_filters
+
+timetables_bp = Blueprint('timetables', __name__, url_prefix='/timetables')
+
+# READ Timetables
+# A route to return one page of student timetables in assending order by student id. The students can be filtered in the same way as /students/ (for example ?year_level=9&homegroup=09WH1).
+# Each timetable has the lines the student has classes on (as a list and as a bitmask where line 1 is 1, line 2 is 2, line 3 is 4 and so on) and the lines where two or more of their classes clash. Two queries are run for each page: one for the page of students and one that counts the classes each of them has on each line.
+@timetables_bp.route('/')
+@jwt_required()
+def get_timetables():
+    auth_employee()
+    stmt = db.select(Student).options(load_only(Student.id)) # Build query. Only the ids of the students are needed.
+    stmt = apply_filters(stmt, STUDENT_FILTERS)
+    students, headers = paginate(stmt, Student.id) # Execute query for the requested page
+    summaries = timetable_summaries([student.id for student in students])
+    return [dict(student_id=student_id, **summary) for student_id, summary in summaries.items()], headers
@@ -1,26 +1,73 @@
 # This module contains the CRUD operations for the User model.
+import csv
+import io
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from init import db, bcrypt
+from init import db, hasher
 from models.address import Address, AddressSchema
 from models.user import User, UserSchema
-from controllers.auth_controller import auth_admin, auth_self
+from models.student import Student, refresh_timetable_masks
+from models.enrollment import Enrollment
+from models.subject_class import SubjectClass, release_places
+from models.employee import Employee
+from controllers.auth_controller import auth_admin, auth_self, invalidate_principal
+from pagination import paginate, get_sort
+from filtering import apply_filters
+from loading import loading_plan
 from sqlalchemy.exc import IntegrityError
+from schemas import get_schema, request_schema, dump
+from importer import UserImport
+from dml import update_returning, delete_returning, column_fields
 
 # Adding a blueprint for users. This will automatically add the prefix users to the start of all the following URL's with this blueprint. 
 users_bp = Blueprint('users', __name__, url_prefix='/users') # users is a resource made available through the API
 
 # CREATE: Users are created through auth/register. 
+# A route for an admin to import a new intake of students and their caregivers from a CSV file (see importer.py for the columns). The file can be sent as the request body with Content-Type: text/csv or as the file field of a multipart form.
+# Each row is reported on by its line number in the file, like the bulk enrollments route. For very large files the flask db import command avoids holding a request open while the passwords are hashed.
+# This route deliberately doesn't use the request's single transaction (see unit_of_work.py): each chunk of rows is committed as soon as it is imported so a large file doesn't hold one long transaction open. Rows from earlier chunks are therefore kept if a later part of the file can't be read, and the response lists them.
+@users_bp.route('/import', methods=['POST'])
+@jwt_required()
+def import_users():
+    auth_admin()
+    if 'file' in request.files:
+        stream = io.TextIOWrapper(request.files['file'].stream, encoding='utf-8-sig', newline='')
+    elif request.mimetype == 'text/csv':
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='') # The body is read as it arrives rather than loaded into memory first
+    else:
+        return {'error': 'Send a CSV file as the request body (Content-Type: text/csv) or as the file field of a multipart form.'}, 400
+    results = []
+    try:
+        for result in UserImport().run(stream): # The results of a chunk are only yielded once it is committed
+            results.append(result)
+    except (UnicodeDecodeError, csv.Error) as err:
+        db.session.rollback() # The chunk being read when the error was found isn't imported
+        error = f'The file could not be read as a UTF-8 CSV file: {err}'
+        if not results:
+            return {'error': error}, 400
+        # The chunks before the error are already committed, so their results are returned with the error as a 207.
+        created = sum(1 for result in results if result['status'] == 'created')
+        return {'error': f'{error}. Only the rows listed in the results were read.', 'created': created, 'failed': len(results) - created, 'results': results}, 207
+    created = sum(1 for result in results if result['status'] == 'created')
+    # 201 if every row was created, otherwise 207 (Multi-Status) as the results are mixed.
+    return {'created': created, 'failed': len(results) - created, 'results': results}, 201 if created == len(results) else 207
+
 # READ
+# The query parameters the list of users can be filtered by (for example ?type=Caregiver) and the fields it can be sorted by
+USER_FILTERS = {'type': User.type, 'last_name': User.last_name}
+USER_SORTS = dict(USER_FILTERS, id=User.id)
+
 @users_bp.route('/')
 @jwt_required() 
 def get_all_users():
     auth_admin()
-    # A route to return all instances of the users resource in assending alphabetical order by last_name (SQL: select * from users order by last_name)
-    stmt = db.select(User).order_by(User.last_name) # Build query
-    users = db.session.scalars(stmt) # Execute query
+    # A route to return one page of the users resource in assending alphabetical order by last_name (SQL: select * from users order by last_name, id limit :limit)
+    schema = request_schema(UserSchema, many=True, exclude= ['student_relations', 'student', 'employee'])
+    stmt = db.select(User).options(*loading_plan(User, schema)) # Build query. Each user's address is joined into the same query.
+    stmt = apply_filters(stmt, USER_FILTERS)
+    users, headers = paginate(stmt, *get_sort(USER_SORTS, User.last_name)) # Execute query for the requested page. Users with the same last name are ordered by id.
     # Respond to client
-    return UserSchema(many=True, exclude= ['student_relations', 'student', 'employee']).dump(users)
+    return dump(schema, users), headers
 
 @users_bp.route('/<int:id>')
 @jwt_required() 
@@ -29,39 +76,33 @@ def get_one_user(id):
     auth_self(id)
     # A route to retrieve a single user resource based on their id
     # (SQL: select * from users where id=id)
-    stmt = db.select(User).filter_by(id=id) # Build query
+    schema = request_schema(UserSchema, exclude= ['student', 'employee'])
+    stmt = db.select(User).filter_by(id=id).options(*loading_plan(User, schema)) # Build query
     user = db.session.scalar(stmt) # Execute query (scalar is singular as only one user instance is returned. 
     if user: # If the id belongs to an exsiting user then return that user instance
-        return UserSchema(exclude= ['student', 'employee']).dump(user) # remove the many=True because we are only returning a single User. 
+        return dump(schema, user) # remove the many=True because we are only returning a single User. 
     else:
         # A 404 error with a custom message will be returned if there is no user with that ID.
         return {'error': f'User not found with id {id}.'}, 404
 
 # UPDATE
+# The fields a user can change about themselves. Their type can only be changed by an admin through /auth/set_user_type.
+USER_UPDATE_FIELDS = ['title', 'first_name', 'middle_name', 'last_name', 'password', 'email', 'phone', 'dob', 'gender']
+USER_COLUMNS = column_fields(User, UserSchema) # The user's own fields, which are returned by the update routes
+
 @users_bp.route('/<int:id>/', methods=['PUT', 'PATCH'])
 @jwt_required()
 def update_one_user(id):
     auth_self(id)
-    # A route to update one user resource (SQL: Update users set .... where id = id)
-    stmt = db.select(User).filter_by(id=id) # Build query
-    user = db.session.scalar(stmt) # Execute query
-
-    data = UserSchema().load(request.json, partial=True) # this applies the validation rules set on the schema.
-    
-    if user: # If a user with that id exsists then update any provided fields
-        user.title = data.get('title') or user.title # The get method will return none if the key doesn't exist rather than raising an exception. 
-        user.first_name = data.get('first_name') or user.first_name
-        user.middle_name = data.get('middle_name') or user.middle_name
-        user.last_name = data.get('last_name') or user.last_name
-        user.password = bcrypt.generate_password_hash(data.get('password')).decode('utf8') or user.password
-        user.email = data.get('email') or user.email
-        user.phone = data.get('phone') or user.phone
-        user.dob = data.get('dob') or user.dob
-        user.gender = data.get('gender') or user.gender
-
-        
-        db.session.commit()      
-        return UserSchema().dump(user) # Respond to client
+    # A route to update one user resource with a single statement (SQL: Update users set .... where id = id returning ...). Only the fields provided are changed.
+    data = get_schema(UserSchema).load(request.json, partial=True) # this applies the validation rules set on the schema.
+    if data.get('password'): # The password is only rehashed when a new one is provided
+        data['password'] = hasher.hash_password(data['password'])
+    user, changed = update_returning(User, id, data, USER_UPDATE_FIELDS, returning=USER_COLUMNS) # An email that is already in use is returned as a 409 error
+    if user: # If a user with that id exsists then return it with the changes
+        if changed:
+            invalidate_principal(id)
+        return dump(get_schema(UserSchema, only=USER_COLUMNS), user) # Respond to client
     else:# If there is no user in a database with that provided id return a not found (404) error with a custom error message.
         return {'error': f'User not found with user id {id}.'}, 404
 
@@ -70,13 +111,14 @@ def update_one_user(id):
 @jwt_required()
 def delete_one_user(id):
     auth_admin()
-    # A route to delete one user resource (SQL: Delete from users where id=id)
-    stmt = db.select(User).filter_by(id=id) # build query to select card
-    user = db.session.scalar(stmt) # execute query
-    # if the user's user_id exsists delete their records from the database
+    # A route to delete one user resource (SQL: Delete from users where id=id). The database deletes their employee, student, enrollment and student relation rows with them (ON DELETE CASCADE), along with the classes of a teacher and the enrollments in them.
+    release_places(Enrollment.student_id.in_(db.select(Student.id).where(Student.user_id == id))) # If the user is a student their enrollments are deleted too, so their places in each class are given back
+    taught = SubjectClass.employee_id.in_(db.select(Employee.id).where(Employee.user_id == id)) # If the user is a teacher, their students' timetables are recalculated without their classes
+    refresh_timetable_masks(Student.id.in_(db.select(Enrollment.student_id).join(SubjectClass).where(taught)), leaving=taught)
+    user = delete_returning(User, id, returning=['first_name', 'last_name'])
+    # if the user_id existed their records have been deleted from the database
     if user:
-        db.session.delete(user)
-        db.session.commit()
+        invalidate_principal(id) # A deleted user's token must stop working straight away
         return {'message': f'The records for {user.first_name} {user.last_name} were deleted successfully.'} # Respond to client
     # If the user_id doesn't exist in the database return a not found (404) error
     else:
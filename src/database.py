@@ -0,0 +1,68 @@
+# This module builds the options the SQLAlchemy engine is created with from environment variables, so the connection pool can be sized for how the app is deployed.
+# Each worker process (for example each gunicorn worker) has its own pool, so the most connections the app can open is workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW). This needs to stay below the database's max_connections.
+# - DB_POOL_SIZE: the number of connections each worker keeps open.
+# - DB_MAX_OVERFLOW: the number of extra connections a worker can open when the pool is busy. These are closed again when they are returned.
+# - DB_POOL_TIMEOUT: seconds a request waits for a free connection before giving up with an error.
+# - DB_POOL_RECYCLE: seconds after which a connection is replaced, so connections aren't closed underneath the app by the database or a proxy.
+# - DB_POOL_PRE_PING: check each connection is still alive (SQL: select 1) before it is used, so connections broken by a database restart or failover are replaced instead of causing a 500 error.
+# - DB_STATEMENT_TIMEOUT_MS: the longest a single statement can run before the database cancels it (PostgreSQL, and SELECT statements on MySQL). 0 turns it off.
+# SQLite doesn't keep a pool of connections like a database server does, so only pre-ping and recycle are used with it. SQLite also only enforces foreign keys, which the models rely on to delete or clear the rows that reference a deleted row (ON DELETE CASCADE and SET NULL), when they are turned on for each connection, so this is done as every SQLite connection is opened.
+import os
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+
+def _int_env(name, default):
+    return int(os.environ.get(name, default))
+
+def _bool_env(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+# (SQL: pragma foreign_keys = on) This runs for the connections of every engine, including replicas, but only changes SQLite ones.
+@event.listens_for(Engine, 'connect')
+def _sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
+
+
+# Returns the SQLALCHEMY_ENGINE_OPTIONS for the database at url.
+def engine_options(url):
+    options = {
+        'pool_pre_ping': _bool_env('DB_POOL_PRE_PING', 'true'),
+        'pool_recycle': _int_env('DB_POOL_RECYCLE', 1800)
+    }
+    if not url:
+        return options
+    backend = make_url(url).get_backend_name()
+    if backend == 'sqlite':
+        return options
+    options['pool_size'] = _int_env('DB_POOL_SIZE', 5)
+    options['max_overflow'] = _int_env('DB_MAX_OVERFLOW', 10)
+    options['pool_timeout'] = _int_env('DB_POOL_TIMEOUT', 30)
+
+    # The timeout is set when each connection is opened so it applies to every statement run on it.
+    statement_timeout = _int_env('DB_STATEMENT_TIMEOUT_MS', 30000)
+    if statement_timeout > 0:
+        if backend == 'postgresql':
+            options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+        elif backend == 'mysql':
+            options['connect_args'] = {'init_command': f'SET SESSION max_execution_time={statement_timeout}'}
+    return options
+
+
+# Returns the number of connections in the engine's pool that are open, in use and waiting to be used. Pools that don't keep a set of connections (such as the ones used for SQLite) only report their type.
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'type': type(pool).__name__}
+    if hasattr(pool, 'checkedout'):
+        stats.update(
+            size = pool.size(),
+            checked_in = pool.checkedin(),
+            checked_out = pool.checkedout(),
+            overflow = max(pool.overflow(), 0) # SQLAlchemy counts this from -size while the pool is filling up
+        )
+    return stats
@@ -0,0 +1,50 @@
+# This module updates and deletes one row with a single statement, for the PUT, PATCH and DELETE routes. Rather than selecting the row, copying each field onto the model instance and then flushing it, the validated body becomes one UPDATE:
+# (SQL: update users set phone = :phone where id = :id and (phone is distinct from :phone) returning id, title, ...)
+# - only the fields that are in the body are written, so a field can be set to a falsy value such as is_admin = false or a complex_number of 0.
+# - the IS DISTINCT FROM guard means a row that already has the values isn't written at all (no new row version, no triggers and nothing to replicate).
+# - the response is built from the row the UPDATE returns. On databases that can't return rows from an UPDATE (SQLite and MySQL) the row is selected after it instead.
+from sqlalchemy import or_
+from init import db
+
+
+# Updates the row of model with the primary key id to the values in data for the given fields (other keys in data are ignored). also holds extra values that are set only if something changed, such as a version counter.
+# Returns (row, changed), where row has the returning columns (the names of columns, all of the table's columns by default) and is None if there is no row with that id.
+def update_returning(model, id, data, fields, returning=None, also=None):
+    table = model.__table__
+    key = table.primary_key.columns.values()[0]
+    columns = [table.c[name] for name in returning] if returning is not None else list(table.c)
+    values = {name: data[name] for name in fields if name in data}
+    if not values: # Nothing to change, so the row is only read
+        return db.session.execute(db.select(*columns).where(key == id)).first(), False
+
+    changed = or_(*(table.c[name].is_distinct_from(value) for name, value in values.items()))
+    stmt = db.update(table).where(key == id, changed).values(**values, **(also or {}))
+    if db.session.get_bind().dialect.full_returning:
+        row = db.session.execute(stmt.returning(*columns)).first()
+        if row is not None:
+            return row, True
+        return db.session.execute(db.select(*columns).where(key == id)).first(), False # Either nothing changed or there is no row with that id
+    updated = db.session.execute(stmt).rowcount == 1
+    new_id = values.get(key.name, id) if updated else id # The primary key itself may have been changed
+    return db.session.execute(db.select(*columns).where(key == new_id)).first(), updated
+
+
+# Deletes the row of model with the primary key id (SQL: delete from subjects where id = :id returning id, name, ...). The rows that reference it are deleted or have their foreign key cleared by the database (ON DELETE CASCADE and SET NULL on the models' foreign keys), so the children are never loaded however many there are.
+# Returns the deleted row with the returning columns (all of the table's columns by default), or None if there is no row with that id. On databases that can't return rows from a DELETE the row is selected just before it.
+def delete_returning(model, id, returning=None):
+    table = model.__table__
+    key = table.primary_key.columns.values()[0]
+    columns = [table.c[name] for name in returning] if returning is not None else list(table.c)
+    stmt = db.delete(table).where(key == id)
+    if db.session.get_bind().dialect.full_returning:
+        return db.session.execute(stmt.returning(*columns)).first()
+    row = db.session.execute(db.select(*columns).where(key == id)).first()
+    if row is not None:
+        db.session.execute(stmt)
+    return row
+
+
+# Returns the names of the columns of model's table that the schema dumps (leaving out nested fields and load_only fields such as password). These are the columns a route returns from update_returning() and the only option of the schema it dumps the row with.
+def column_fields(model, schema_class):
+    declared = schema_class._declared_fields
+    return [name for name in schema_class.Meta.fields if name in model.__table__.c and not (name in declared and declared[name].load_only)]
@@ -0,0 +1,33 @@
+# This module turns filter query parameters into WHERE clauses so clients can ask the database for just the rows they need (for example /students/?year_level=9&homegroup=WH01) instead of downloading a whole table and filtering it themselves.
+# Each route passes in the parameters it allows and the columns they filter on, and every filtered column has an index (see the models) so the filters are answered with index scans.
+# - a parameter can be repeated or given a comma separated list of values to match any of them (SQL: where year_level in (9, 10)).
+# - values are converted to the column's type (such as a whole number for year_level or an ISO date for date) and a 400 error is returned if they can't be.
+# - any other query parameter (such as limit, fields or sort) is ignored here.
+from datetime import date, datetime
+from flask import request, abort
+
+
+# Converts a query parameter value to the python type of the column it filters on.
+def _coerce(name, column, value):
+    python_type = column.type.python_type
+    try:
+        if python_type in (date, datetime):
+            return python_type.fromisoformat(value)
+        if python_type is bool:
+            if value.lower() not in ('true', 'false', '1', '0'):
+                raise ValueError
+            return value.lower() in ('true', '1')
+        return python_type(value)
+    except ValueError:
+        abort(400, description=f"'{value}' is not a valid value for the {name} filter.")
+
+
+# Adds a WHERE clause to the statement for every filter parameter in the request. Filters maps the parameter names the route allows to the columns they filter on.
+def apply_filters(stmt, filters):
+    for name, column in filters.items():
+        values = [value.strip() for raw in request.args.getlist(name) for value in raw.split(',') if value.strip()]
+        if not values:
+            continue
+        values = [_coerce(name, column, value) for value in values]
+        stmt = stmt.where(column == values[0] if len(values) == 1 else column.in_(values))
+    return stmt
@@ -0,0 +1,79 @@
+# This module provides the password hashing service. Bcrypt is deliberately slow (that is what makes it resistant to brute force attacks) so hashing on the request thread means a burst of logins at the start of term can tie up every worker. Instead hashes are calculated in a bounded pool of worker processes so that:
+# - the number of hashes running at once is limited to BCRYPT_POOL_SIZE and other requests keep being served.
+# - many passwords can be hashed in parallel when seeding or importing users.
+# The cost factor is set with BCRYPT_LOG_ROUNDS (the same setting Flask-Bcrypt reads) and stored hashes with a different cost are upgraded the next time that user logs in.
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+
+
+# The following functions run inside the worker processes so they must be defined at the top level of the module to be picklable.
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt(rounds)).decode('utf8')
+
+def _hash_many(passwords, rounds):
+    return [_hash(password, rounds) for password in passwords]
+
+def _check(password_hash, password):
+    return bcrypt.checkpw(password.encode('utf8'), password_hash.encode('utf8'))
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.pool_size = 0
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('BCRYPT_POOL_SIZE', os.cpu_count() or 1)
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.pool_size = app.config['BCRYPT_POOL_SIZE'] # 0 hashes on the calling thread instead, which is useful when debugging
+        self._slots = threading.BoundedSemaphore(self.pool_size * 2) if self.pool_size else None
+        app.extensions['password_hasher'] = self
+
+    # The pool is created on first use in each process. Gunicorn forks its workers after the app is loaded, so a pool inherited from the parent process is replaced rather than shared.
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    # Runs a function in the pool and waits for the result. At most two jobs per worker are queued at once; any further requests wait here so a login storm can't build an unbounded backlog.
+    def _run(self, function, *args):
+        if not self.pool_size:
+            return function(*args)
+        with self._slots:
+            return self._get_executor().submit(function, *args).result()
+
+    def hash_password(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def check_password(self, password_hash, password):
+        return self._run(_check, password_hash, password)
+
+    # Hashes a list of passwords in parallel and returns the hashes in the same order. The list is split into a few chunks per worker so the cost of sending each job to a process is shared between many passwords.
+    def hash_passwords(self, passwords):
+        passwords = list(passwords)
+        if not self.pool_size or len(passwords) < 2:
+            return _hash_many(passwords, self.rounds)
+        size = max(1, len(passwords) // (self.pool_size * 4))
+        chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+        hashes = []
+        for chunk in self._get_executor().map(_hash_many, chunks, [self.rounds] * len(chunks)):
+            hashes.extend(chunk)
+        return hashes
+
+    # A bcrypt hash looks like $2b$12$<salt and hash> where 12 is the cost it was made with. A hash needs to be recalculated when that cost doesn't match the configured BCRYPT_LOG_ROUNDS.
+    def needs_rehash(self, password_hash):
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
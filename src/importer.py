@@ -0,0 +1,175 @@
+# This module imports a new intake of students and their caregivers from a CSV file. It is used by the flask db import command and the POST /users/import route.
+# Each row of the file is one person: their user details, their address and either their student details or (for caregivers) the email of their student and how they are related. The columns are listed in IMPORT_COLUMNS and can be in any order; empty cells are treated as missing.
+# The file is read as it streams in and handled IMPORT_CHUNK_SIZE rows at a time. For each chunk:
+# - every row is validated with the same schemas the API uses (UserSchema, AddressSchema, StudentSchema and StudentRelationSchema) and emails are checked against the file and the database with one query.
+# - the passwords are hashed in parallel in the password hashing pool.
+# - people at the same address share one address row, whether it was added earlier in the file or is already in the database.
+# - the addresses, users, students and student relations are inserted with one statement per table (COPY on PostgreSQL) and committed together.
+# A row that fails doesn't stop the others, and every row gets a result with its line number in the file.
+import csv
+from marshmallow.exceptions import ValidationError
+from sqlalchemy.exc import IntegrityError
+from init import db, hasher
+from models.address import Address, AddressSchema
+from models.user import User, UserSchema
+from models.student import Student, StudentSchema
+from models.student_relation import StudentRelation, StudentRelationSchema
+from schemas import get_schema
+from synthetic import bulk_insert
+
+IMPORT_CHUNK_SIZE = 1000 # The number of rows validated and inserted in each transaction
+IMPORT_TYPES = ('Student', 'Caregiver')
+
+ADDRESS_FIELDS = ['complex_number', 'street_number', 'street_name', 'suburb', 'postcode']
+USER_FIELDS = ['title', 'first_name', 'middle_name', 'last_name', 'password', 'email', 'phone', 'dob', 'gender']
+STUDENT_FIELDS = ['homegroup', 'enrollment_date', 'year_level', 'birth_country']
+RELATION_FIELDS = ['relationship_to_student', 'is_primary_contact']
+IMPORT_COLUMNS = ['type', *USER_FIELDS, *ADDRESS_FIELDS, *STUDENT_FIELDS, 'student_email', *RELATION_FIELDS] # student_email and the relation fields are only used for caregivers
+
+
+# Returns the key two addresses are matched on, so '12 Rose Street, Toowong' and '12 rose street, TOOWONG' are stored once.
+def _address_key(address):
+    return (address.get('complex_number'), address['street_number'], address['street_name'].casefold(), address['suburb'].casefold(), address['postcode'])
+
+
+class UserImport:
+    def __init__(self):
+        self.emails = set() # The emails of the people imported so far
+        self.student_ids = {} # email: student id of the students imported so far, so caregivers later in the file can be linked to them
+        self.address_ids = {} # address key: id of the addresses used so far
+
+    # Reads the CSV file from a text stream and imports it, yielding the result of each row as {'row': line number, 'status': 'created', 'id': user id} or {'row': line number, 'status': 'error', 'errors': {...}}.
+    def run(self, stream):
+        reader = csv.DictReader(stream)
+        chunk = []
+        for values in reader:
+            chunk.append((reader.line_num, values))
+            if len(chunk) == IMPORT_CHUNK_SIZE:
+                yield from self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self._import_chunk(chunk)
+
+    # Validates one row with the API's schemas. Returns (parsed row, errors).
+    def _validate(self, values):
+        values = {name.strip(): value.strip() for name, value in values.items() if name and isinstance(value, str) and value.strip()}
+        errors = {}
+        row = {'type': values.get('type')}
+        if row['type'] not in IMPORT_TYPES:
+            errors['type'] = [f"The type must be one of {', '.join(IMPORT_TYPES)}."]
+        if 'password' not in values:
+            errors['password'] = ['A password is required.']
+        parts = [('user', UserSchema, USER_FIELDS), ('address', AddressSchema, ADDRESS_FIELDS)]
+        if row['type'] == 'Student':
+            parts.append(('student', StudentSchema, STUDENT_FIELDS))
+        elif row['type'] == 'Caregiver':
+            parts.append(('relation', StudentRelationSchema, RELATION_FIELDS))
+            row['student_email'] = values.get('student_email')
+            if not row['student_email']:
+                errors['student_email'] = ["The email of the caregiver's student is required."]
+        for part, schema_class, fields in parts:
+            try:
+                row[part] = get_schema(schema_class, only=fields).load({name: values[name] for name in fields if name in values})
+            except ValidationError as err:
+                errors.update(err.messages)
+        return row, errors
+
+    def _import_chunk(self, chunk):
+        results = {}
+        rows = [] # (line number, parsed row) of the rows that are valid so far
+        for number, values in chunk:
+            row, errors = self._validate(values)
+            if errors:
+                results[number] = {'row': number, 'status': 'error', 'errors': errors}
+            else:
+                rows.append((number, row))
+
+        # Check the emails against the database and the rest of the file, and find the students that caregivers refer to, with one query each.
+        emails = {row['user']['email'] for _, row in rows}
+        existing = set(db.session.scalars(db.select(User.email).where(User.email.in_(emails)))) if emails else set()
+        student_emails = {row['student_email'] for _, row in rows if row['type'] == 'Caregiver'} - set(self.student_ids)
+        existing_students = dict(db.session.execute(db.select(User.email, Student.id).join(Student, Student.user_id == User.id).where(User.email.in_(student_emails))).all()) if student_emails else {}
+        new_students = set() # The emails of the students in this chunk
+        valid = []
+        for number, row in rows:
+            email = row['user']['email']
+            if email in existing:
+                results[number] = {'row': number, 'status': 'error', 'errors': {'email': ['Email address already in use.']}}
+            elif email in self.emails or email in new_students or any(email == other['user']['email'] for _, other in valid):
+                results[number] = {'row': number, 'status': 'error', 'errors': {'email': ['This email address is used earlier in the file.']}}
+            elif row['type'] == 'Caregiver' and row['student_email'] not in self.student_ids and row['student_email'] not in existing_students and row['student_email'] not in new_students:
+                results[number] = {'row': number, 'status': 'error', 'errors': {'student_email': [f"No student found with email {row['student_email']}. Students must be in the database or earlier in the file than their caregivers."]}}
+            else:
+                valid.append((number, row))
+                if row['type'] == 'Student':
+                    new_students.add(email)
+
+        if valid:
+            try:
+                for (number, row), user_id in zip(valid, self._insert(valid, existing_students)):
+                    results[number] = {'row': number, 'status': 'created', 'id': user_id}
+                    self.emails.add(row['user']['email'])
+                db.session.commit() # One transaction per chunk
+            except IntegrityError as err: # For example an email added through the API while the chunk was being imported
+                db.session.rollback()
+                self.address_ids.clear() # Addresses added in this chunk were rolled back
+                for email in new_students:
+                    self.student_ids.pop(email, None)
+                for number, row in valid:
+                    self.emails.discard(row['user']['email'])
+                    results[number] = {'row': number, 'status': 'error', 'errors': {'database': [str(err.orig)]}}
+        return [results[number] for number, _ in chunk]
+
+    # Inserts the valid rows of a chunk and returns their user ids in the same order.
+    def _insert(self, valid, existing_students):
+        passwords = hasher.hash_passwords([row['user']['password'] for _, row in valid])
+        address_ids = self._address_ids([row['address'] for _, row in valid])
+
+        users = []
+        for (_, row), password, address_id in zip(valid, passwords, address_ids):
+            user = {name: row['user'].get(name) for name in USER_FIELDS}
+            user.update(password=password, type=row['type'], address_id=address_id)
+            users.append(user)
+        bulk_insert(User.__table__, users)
+        emails = [user['email'] for user in users]
+        user_ids = dict(db.session.execute(db.select(User.email, User.id).where(User.email.in_(emails))).all()) # Read the new ids back by email as COPY doesn't return them
+
+        students = [dict({name: row['student'].get(name) for name in STUDENT_FIELDS}, user_id=user_ids[row['user']['email']]) for _, row in valid if row['type'] == 'Student']
+        if students:
+            bulk_insert(Student.__table__, students)
+            student_ids = dict(db.session.execute(db.select(User.email, Student.id).join(Student, Student.user_id == User.id).where(Student.user_id.in_([student['user_id'] for student in students]))).all())
+            self.student_ids.update(student_ids)
+
+        relations = [{
+            'relationship_to_student': row['relation']['relationship_to_student'],
+            'is_primary_contact': row['relation'].get('is_primary_contact', True),
+            'user_id': user_ids[row['user']['email']],
+            'student_id': self.student_ids.get(row['student_email']) or existing_students[row['student_email']]
+        } for _, row in valid if row['type'] == 'Caregiver']
+        bulk_insert(StudentRelation.__table__, relations)
+        return [user_ids[email] for email in emails]
+
+    # Returns the id of each address, reusing an address already in the database or earlier in the file and inserting the rest in one statement.
+    def _address_ids(self, addresses):
+        missing = {}
+        for address in addresses:
+            key = _address_key(address)
+            if key not in self.address_ids:
+                missing.setdefault(key, address)
+        if missing:
+            self._find_addresses(missing)
+            new = [{name: address.get(name) for name in ADDRESS_FIELDS} for key, address in missing.items() if key not in self.address_ids]
+            if new:
+                bulk_insert(Address.__table__, new)
+                self._find_addresses(missing)
+        return [self.address_ids[_address_key(address)] for address in addresses]
+
+    # Looks up the addresses in the database (SQL: select * from addresses where postcode in (...) and street_number in (...)) and records the ids of those that match.
+    def _find_addresses(self, addresses):
+        postcodes = {address['postcode'] for address in addresses.values()}
+        street_numbers = {address['street_number'] for address in addresses.values()}
+        stmt = db.select(Address.id, Address.complex_number, Address.street_number, Address.street_name, Address.suburb, Address.postcode).where(Address.postcode.in_(postcodes), Address.street_number.in_(street_numbers)).order_by(Address.id)
+        for address_id, *values in db.session.execute(stmt):
+            key = _address_key(dict(zip(ADDRESS_FIELDS, values)))
+            if key in addresses:
+                self.address_ids.setdefault(key, address_id) # The oldest matching address is used
@@ -2,9 +2,21 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
+from hashing import PasswordHasher
+from instrumentation import Instrumentation
+from replicas import RoutingSession, ReplicaRouter
+from unit_of_work import UnitOfWork
+from metrics import Metrics
+from profiling import RequestProfiler
 
 
-db = SQLAlchemy() 
+db = SQLAlchemy(session_options={'class_': RoutingSession}) # The session sends the reads of GET requests to a replica when replicas are configured (see replicas.py)
 ma = Marshmallow() 
 bcrypt = Bcrypt()
-jwt = JWTManager()
\ No newline at end of file
+jwt = JWTManager()
+hasher = PasswordHasher() # Hashes and checks passwords in a pool of worker processes
+instrumentation = Instrumentation() # Records the queries and timings of each request
+replicas = ReplicaRouter(db)
+unit_of_work = UnitOfWork(db, instrumentation) # Commits each request's changes once at the end of the request (see unit_of_work.py)
+metrics = Metrics(db, replicas) # Counts and times the requests to each route for the /metrics route (see metrics.py)
+profiler = RequestProfiler() # Profiles requests sent by admins with the X-Profile header, and one in PROFILE_SAMPLE_RATE requests (see profiling.py)
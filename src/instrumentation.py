@@ -0,0 +1,108 @@
+# This module measures where each request spends its time. Listeners on every SQLAlchemy engine count the queries a request runs and time them, and the auth and serialize phases are timed where they happen (see phase() below). At the end of the request:
+# - a Server-Timing header is added to the response (for example db;dur=12.5;desc="4 queries", auth;dur=0.3, serialize;dur=3.1, total;dur=18.2), which browser developer tools and most HTTP clients can display.
+# - statements that were run many times with only their parameters changing are logged as a likely N+1 query (a query run once per row of an earlier result).
+# - requests slower than SLOW_REQUEST_MS are logged along with the statements that took the most time.
+# Recording a query is a couple of clock reads and a dictionary update so this is cheap enough to leave on in production. It can be turned on and off while the app is running through the /admin/instrumentation route (for the worker process that serves the request).
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Lists of bound parameters such as (?, ?, ?) are collapsed so statements that only differ in the length of an IN list are counted as the same statement.
+_PARAMETER_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)')
+
+
+class RequestStats:
+    __slots__ = ('start', 'queries', 'db_ms', 'statements', 'phases')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.statements = defaultdict(lambda: [0, 0.0]) # statement: [times run, total ms]
+        self.phases = defaultdict(float) # phase name: total ms
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.slow_request_ms = 500
+        self.n_plus_one_threshold = 10
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION', True)
+        app.config.setdefault('SLOW_REQUEST_MS', 500)
+        app.config.setdefault('N_PLUS_ONE_THRESHOLD', 10)
+        self.enabled = app.config['INSTRUMENTATION']
+        self.slow_request_ms = app.config['SLOW_REQUEST_MS']
+        self.n_plus_one_threshold = app.config['N_PLUS_ONE_THRESHOLD'] # A statement run this many times in one request is reported as a likely N+1 query
+        if not self._listening: # The listeners are added to the Engine class so they apply to every engine (including any added later)
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            self._listening = True
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.extensions['instrumentation'] = self
+
+    def _stats(self):
+        if not self.enabled or not has_request_context():
+            return None
+        return g.get('request_stats')
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._stats() is not None:
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self._stats()
+        starts = conn.info.get('query_start')
+        if stats is None or not starts:
+            return
+        elapsed = (time.perf_counter() - starts.pop()) * 1000
+        stats.queries += 1
+        stats.db_ms += elapsed
+        entry = stats.statements[_PARAMETER_LIST.sub('(...)', statement)]
+        entry[0] += 1
+        entry[1] += elapsed
+
+    def _start_request(self):
+        if self.enabled:
+            g.request_stats = RequestStats()
+
+    def _finish_request(self, response):
+        stats = self._stats()
+        if stats is None:
+            return response
+        total = (time.perf_counter() - stats.start) * 1000
+        timings = [f'db;dur={stats.db_ms:.1f};desc="{stats.queries} {"query" if stats.queries == 1 else "queries"}"']
+        timings += [f'{name};dur={ms:.1f}' for name, ms in stats.phases.items()]
+        timings.append(f'total;dur={total:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+        repeated = [(statement, count) for statement, (count, _) in stats.statements.items() if count >= self.n_plus_one_threshold]
+        for statement, count in repeated:
+            current_app.logger.warning('Possible N+1 query in %s %s: run %d times: %s', request.method, request.path, count, statement)
+        if total >= self.slow_request_ms:
+            slowest = sorted(stats.statements.items(), key=lambda item: item[1][1], reverse=True)[:5]
+            lines = ''.join(f'\n  {ms:.1f} ms, {count}x: {statement}' for statement, (count, ms) in slowest)
+            current_app.logger.warning('Slow request %s %s took %.1f ms (%d queries, %.1f ms in the database). Slowest statements:%s', request.method, request.path, total, stats.queries, stats.db_ms, lines)
+        return response
+
+    # Times a block of code as one phase of the request, for example: with instrumentation.phase('serialize'): ...
+    @contextmanager
+    def phase(self, name):
+        stats = self._stats()
+        if stats is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats.phases[name] += (time.perf_counter() - start) * 1000
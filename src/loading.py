@@ -0,0 +1,76 @@
+# This module builds a relationship loading plan for a query from the shape of the schema that will be used to serialize its results. By default SQLAlchemy lazy loads every relationship, which means that dumping a list of students with their nested user issues one extra SELECT per student (the N+1 query problem). Instead the schema's nested fields (after its only/exclude options have been applied) are walked and each matching relationship is loaded up front:
+# - relationships that return a single object (such as student.user) are joined into the same query with joinedload.
+# - relationships that return a list (such as student.student_relations) are loaded with selectinload, which runs one extra query for the whole page (SQL: select * from student_relations where student_id in (...)).
+# This keeps the number of queries a route runs fixed no matter how many rows it returns.
+# Each table in the plan is also limited to the columns the schema will dump (with load_only), so a route that only returns names doesn't select every column (including users.password). The primary key and any foreign keys the relationships need are always selected. If a schema dumps something other than a column or relationship (such as a property) every column of that table is loaded as it may depend on any of them.
+from marshmallow import fields
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload, defaultload, load_only
+from cache import TTLCache
+
+_plans = TTLCache(maxsize=1024, ttl=24 * 60 * 60) # Plans only depend on the model and the schema's shape so they are built once and reused. Clients can pick the shape with ?fields= so the number of plans is bounded.
+
+
+# Returns the nested schema of a field such as fields.Nested('UserSchema') or fields.List(fields.Nested('StudentRelationSchema')). Marshmallow resolves string references and applies the nested only/exclude options when the schema property is first read.
+def _nested_schema(field):
+    if isinstance(field, fields.List):
+        field = field.inner
+    if isinstance(field, fields.Nested):
+        return field.schema
+    return None
+
+
+# Returns the columns of the model the schema will dump, or None if it dumps an attribute that isn't a column or relationship.
+def _dumped_columns(model, schema):
+    mapper = inspect(model)
+    columns = []
+    for name, field in schema.dump_fields.items():
+        attribute = field.attribute or name
+        if attribute in mapper.relationships:
+            continue
+        if attribute not in mapper.column_attrs:
+            return None
+        columns.append(getattr(model, attribute))
+    return columns
+
+
+# Walks the schema's dump fields and yields one loader chain for every relationship path that will be serialized, along with a load_only option for each table.
+def _loader_paths(model, schema, parent=None, path=()):
+    columns = _dumped_columns(model, schema)
+    if columns is not None:
+        if path:
+            yield _defaultload_chain(path).load_only(*columns)
+        else:
+            yield load_only(*columns)
+    relationships = inspect(model).relationships
+    for name, field in schema.dump_fields.items():
+        attribute = field.attribute or name
+        nested = _nested_schema(field)
+        if nested is None or attribute not in relationships:
+            continue
+        relationship = relationships[attribute]
+        column = getattr(model, attribute)
+        if parent is None:
+            loader = selectinload(column) if relationship.uselist else joinedload(column)
+        else:
+            loader = parent.selectinload(column) if relationship.uselist else parent.joinedload(column)
+        yield loader
+        yield from _loader_paths(relationship.mapper.class_, nested, loader, path + (column,))
+
+
+# Builds defaultload(A.b).defaultload(B.c)... for a path of relationship attributes.
+def _defaultload_chain(path):
+    loader = defaultload(path[0])
+    for column in path[1:]:
+        loader = loader.defaultload(column)
+    return loader
+
+
+# Returns a list of loader options to pass to stmt.options() for the given model and schema instance.
+def loading_plan(model, schema):
+    key = (model, type(schema), frozenset(schema.only or ()), frozenset(schema.exclude or ()))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = list(_loader_paths(model, schema))
+        _plans.set(key, plan)
+    return plan
@@ -1,5 +1,5 @@
 from flask import Flask
-from init import db, ma, bcrypt, jwt
+from init import db, ma, bcrypt, jwt, hasher, instrumentation, replicas, unit_of_work, metrics, profiler
 from controllers.cli_controller import db_commands
 from controllers.users_controller import users_bp 
 from controllers.auth_controller import auth_bp 
@@ -8,14 +8,44 @@ from controllers.employees_controller import employees_bp
 from controllers.subjects_controller import subjects_bp 
 from controllers.enrollments_controller import enrollments_bp 
 from controllers.addresses_controller import addresses_bp 
+from controllers.admin_controller import admin_bp, auth_profiling
+from controllers.health_controller import health_bp
+from controllers.metrics_controller import metrics_bp
+from controllers.timetables_controller import timetables_bp
+from controllers.exports_controller import exports_bp
+from catalog import catalog_changed
+from json_provider import json_provider_class
+from database import engine_options
+from replicas import replica_binds
 from marshmallow.exceptions import ValidationError
 import os
 
 def create_app(): 
     app = Flask (__name__)
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI']) # Connection pool size, pre-ping and statement timeout (see database.py)
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(os.environ.get('DATABASE_REPLICA_URLS')) # Read replicas that GET requests are sent to (see replicas.py)
+    app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 5)) # Seconds a client's requests stay on the primary after it writes, so it sees its own changes
+    app.config['REPLICA_RETRY_SECONDS'] = int(os.environ.get('REPLICA_RETRY_SECONDS', 30)) # Seconds a replica that failed is left out before it is tried again
     app.config['JSON_SORT_KEYS']= False
+    app.config['JSON_PROVIDER'] = os.environ.get('JSON_PROVIDER', 'auto').lower() # The JSON encoder used for responses: orjson, json (the standard library) or auto (orjson when it is installed)
+    app.json = json_provider_class(app.config['JSON_PROVIDER'])(app)
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
+    app.config['PRINCIPAL_CACHE_TTL'] = int(os.environ.get('PRINCIPAL_CACHE_TTL', 60)) # Seconds a user's permissions are cached for between requests
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)) # The bcrypt cost factor. Each extra round doubles the time taken to hash a password.
+    app.config['BCRYPT_POOL_SIZE'] = int(os.environ.get('BCRYPT_POOL_SIZE', os.cpu_count() or 1)) # The number of worker processes used to hash passwords (0 hashes on the request thread)
+    app.config['CATALOG_CACHE_TTL'] = int(os.environ.get('CATALOG_CACHE_TTL', 60)) # Seconds a cached subject catalog response is kept for (this bounds how out of date another worker's copy can be)
+    app.config['COMPILED_SERIALIZERS'] = os.environ.get('COMPILED_SERIALIZERS', 'false').lower() in ('1', 'true', 'yes') # Dump responses with functions built from each schema instead of calling marshmallow for every field
+    app.config['JWT_ROLE_CLAIMS'] = os.environ.get('JWT_ROLE_CLAIMS', 'false').lower() in ('1', 'true', 'yes') # Sign the user's type and admin rights into their token so permission checks don't need the database
+    app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION', 'true').lower() in ('1', 'true', 'yes') # Add a Server-Timing header to each response and log slow requests and likely N+1 queries (can be changed at /admin/instrumentation)
+    app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500)) # Requests taking at least this many milliseconds are logged with their slowest statements
+    app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10)) # A statement run this many times in one request is logged as a likely N+1 query
+    app.config['METRICS'] = os.environ.get('METRICS', 'true').lower() in ('1', 'true', 'yes') # Record request counts, latencies and response sizes for each route and serve them at /metrics
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR') # A directory shared by the worker processes so /metrics reports all of them rather than only the one that answers
+    app.config['METRICS_FLUSH_SECONDS'] = int(os.environ.get('METRICS_FLUSH_SECONDS', 5)) # How often each worker writes its metrics to METRICS_DIR
+    app.config['PROFILE_SAMPLE_RATE'] = int(os.environ.get('PROFILE_SAMPLE_RATE', 0)) # Profile one in this many requests (0 only profiles requests sent by admins with the X-Profile header)
+    app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 50)) # The number of profiles kept on disk before the oldest is deleted
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR') # Where profiles are saved (api-profiles in the temporary directory by default)
 
     # Each of the following errorhandler functions will change the error message returned with the specified status code. It will catch the specific error that happens (anywhere in the app) and return the error message in JSON instead of HTML. This provides consistency across the app's responses.  
 
@@ -48,7 +78,12 @@ def create_app():
     db.init_app(app) # Here I have used the init_app method and passed it the app. Init is a method of SQLAlchemy.
     ma.init_app(app)
     bcrypt.init_app(app)
+    hasher.init_app(app)
     jwt.init_app(app)
+    profiler.init_app(app, authorize=auth_profiling) # First so a profile covers every other before_request and after_request function
+    metrics.init_app(app) # Before instrumentation so a request is timed from its first before_request function to its last after_request function
+    instrumentation.init_app(app)
+    replicas.init_app(app)
 
     # register the following blueprints:
 
@@ -60,6 +95,14 @@ def create_app():
     app.register_blueprint(enrollments_bp)
     app.register_blueprint(employees_bp)
     app.register_blueprint(addresses_bp)
+    app.register_blueprint(timetables_bp)
+    app.register_blueprint(exports_bp)
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(health_bp)
+    app.register_blueprint(metrics_bp)
+
+    app.after_request(catalog_changed) # Any change to the data clears the cached subject catalog
+    unit_of_work.init_app(app) # Registered last so the request's changes are committed before the other after_request functions run
     
 
 
@@ -0,0 +1,261 @@
+# This module records runtime metrics for every request and renders them in the Prometheus text format for the /metrics route. For each blueprint, endpoint and method it keeps:
+# - the number of requests with each status code (http_requests_total)
+# - a histogram of how long the requests took (http_request_duration_seconds)
+# - the time spent in the database and the number of queries run (taken from the request's instrumentation, so they are 0 while INSTRUMENTATION is off)
+# - the bytes sent in the response bodies, including streamed exports (http_response_bytes_total)
+# along with gauges for the worker process's memory (RSS), its threads and its database connection pools.
+# Each thread records into its own set of counters (a shard), so recording a request doesn't take a lock; a lock is only taken the first time a thread records anything. The shards are added together when /metrics is read. The shards of threads that have exited are added into one shared total, so servers that start a thread per request don't keep a shard for every request.
+# With several worker processes (for example gunicorn workers) each process only sees its own requests. Setting METRICS_DIR to a directory shared by the workers makes each one write a snapshot of its metrics there every METRICS_FLUSH_SECONDS, and /metrics adds up the snapshots of every worker, so it doesn't matter which worker answers the scrape. The directory should be emptied whenever the app is deployed or restarted.
+import glob
+import json
+import os
+import resource
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request, has_app_context
+from database import pool_stats
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # The upper bounds (in seconds) of the latency histogram's buckets
+
+
+class RouteStats:
+    __slots__ = ('statuses', 'buckets', 'count', 'seconds', 'db_seconds', 'queries', 'bytes')
+
+    def __init__(self):
+        self.statuses = {} # status code: number of requests
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1) # requests in each bucket (not cumulative), the last one for those slower than every bound
+        self.count = 0
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.bytes = 0
+
+    def record(self, status, seconds, db_seconds, queries, size):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.buckets[bisect_left(DURATION_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.db_seconds += db_seconds
+        self.queries += queries
+        self.bytes += size
+
+
+class Metrics:
+    def __init__(self, db, replicas, app=None):
+        self.db = db
+        self.replicas = replicas # The pools of the replica engines are reported too
+        self.enabled = False
+        self.directory = None
+        self.flush_seconds = 5
+        self._local = threading.local()
+        self._shards = {} # thread id: the routes dictionary of each running thread that has recorded a request
+        self._retired = {} # The totals of the threads that have exited, in the same form as a snapshot's routes
+        self._shards_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flushed = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    # Must be called before the other extensions register their before_request and after_request functions so the time measured covers them (including the commit).
+    def init_app(self, app):
+        app.config.setdefault('METRICS', True)
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_SECONDS', 5)
+        self.enabled = app.config['METRICS']
+        self.directory = app.config['METRICS_DIR'] or None
+        self.flush_seconds = app.config['METRICS_FLUSH_SECONDS']
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.extensions['metrics'] = self
+
+    def _start_request(self):
+        if self.enabled:
+            g.metrics_start = time.perf_counter()
+
+    def _finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        key = (request.blueprint or 'app', request.endpoint or 'unmatched', request.method) # Requests for URLs that don't exist share one endpoint so they can't create new series
+        status = str(response.status_code)
+        stats = g.get('request_stats') # Filled in by instrumentation while it is on
+        if response.is_streamed: # The body of a streamed response (such as an export) is counted as it is sent and the request is recorded once it has all been sent
+            response.response = self._counting(response.response, key, status, start, stats)
+        else:
+            self._record(key, status, time.perf_counter() - start, stats, response.calculate_content_length() or 0)
+        return response
+
+    def _counting(self, chunks, key, status, start, stats):
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self._record(key, status, time.perf_counter() - start, stats, size)
+
+    def _record(self, key, status, seconds, stats, size):
+        routes = getattr(self._local, 'routes', None)
+        if routes is None: # The first request on this thread
+            routes = self._local.routes = {}
+            with self._shards_lock:
+                self._retire_shards(reused=threading.get_ident())
+                self._shards[threading.get_ident()] = routes
+        route = routes.get(key)
+        if route is None:
+            route = routes[key] = RouteStats()
+        route.record(status, seconds, stats.db_ms / 1000 if stats else 0.0, stats.queries if stats else 0, size)
+        # Only one thread writes the snapshot and the others carry on. The end of a streamed response is outside the app context, so its request is written with the next snapshot.
+        if self.directory and has_app_context() and time.monotonic() - self._flushed >= self.flush_seconds and self._flush_lock.acquire(blocking=False):
+            try:
+                self._flush()
+            finally:
+                self._flush_lock.release()
+
+    # Adds up the shards of every thread in this process. Each dictionary is copied in one step (which the GIL makes atomic) so a thread recording at the same time can't break the iteration; its request is simply counted in the next scrape.
+    def snapshot(self):
+        routes = {}
+        with self._shards_lock:
+            self._retire_shards()
+            shards = list(self._shards.values())
+            for key, stats in self._retired.items():
+                _add(routes, key, stats)
+        for shard in shards:
+            for key, stats in list(shard.items()):
+                _add(routes, '|'.join(key), _stats_dict(stats))
+        return {'pid': os.getpid(), 'routes': routes, 'process': self._process()}
+
+    # Moves the shards of threads that have exited into the shared total. A thread that has exited can't record anything else, so its shard can be read without copying. reused is the id of a new thread, which may have been given the id of a thread that exited. Must be called with _shards_lock held.
+    def _retire_shards(self, reused=None):
+        running = {thread.ident for thread in threading.enumerate()} - {reused}
+        for ident in [ident for ident in self._shards if ident not in running]:
+            for key, stats in self._shards.pop(ident).items():
+                _add(self._retired, '|'.join(key), _stats_dict(stats))
+
+    def _process(self):
+        pools = {}
+        engines = {'primary': self.db.engine, **self.replicas.engines}
+        for name, engine in engines.items():
+            stats = pool_stats(engine)
+            pools[name] = {state: stats[state] for state in ('size', 'checked_in', 'checked_out', 'overflow') if state in stats}
+        return {'rss_bytes': _rss_bytes(), 'threads': threading.active_count(), 'pools': pools}
+
+    # Writes this process's snapshot to METRICS_DIR. It is written to a temporary file and renamed so a scrape never reads half a file.
+    def _flush(self, snapshot=None):
+        self._flushed = time.monotonic()
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(snapshot or self.snapshot(), file)
+        os.replace(f'{path}.tmp', path)
+
+    # Returns the snapshots of every worker: this process's current one and, with METRICS_DIR, the last one written by each other worker.
+    def snapshots(self):
+        own = self.snapshot()
+        if not self.directory:
+            return [own]
+        with self._flush_lock:
+            self._flush(own)
+        snapshots = [own]
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError): # Removed or replaced while it was being read
+                continue
+            if snapshot['pid'] == own['pid']:
+                continue
+            if not _running(snapshot['pid']):
+                snapshot['process'] = None # The counters of a worker that has exited still count towards the totals but its gauges no longer mean anything
+            snapshots.append(snapshot)
+        return snapshots
+
+    # Returns the metrics of every worker in the Prometheus text format (version 0.0.4).
+    def render(self):
+        snapshots = self.snapshots()
+        routes = {}
+        for snapshot in snapshots:
+            for key, stats in snapshot['routes'].items():
+                _add(routes, key, stats)
+
+        lines = []
+        def metric(name, kind, description, samples):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{sample_name}{_labels(labels)} {_number(value)}' for sample_name, labels, value in samples)
+
+        route_labels = {key: dict(zip(('blueprint', 'endpoint', 'method'), key.split('|'))) for key in routes}
+        metric('http_requests_total', 'counter', 'Requests handled, by route and status code.', [
+            ('http_requests_total', dict(route_labels[key], status=status), count) for key, stats in sorted(routes.items()) for status, count in sorted(stats['statuses'].items())])
+        samples = []
+        for key, stats in sorted(routes.items()):
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + ('+Inf',), stats['buckets']):
+                cumulative += count
+                samples.append(('http_request_duration_seconds_bucket', dict(route_labels[key], le=bound if bound == '+Inf' else _number(bound)), cumulative))
+            samples.append(('http_request_duration_seconds_sum', route_labels[key], stats['seconds']))
+            samples.append(('http_request_duration_seconds_count', route_labels[key], stats['count']))
+        metric('http_request_duration_seconds', 'histogram', 'Time taken to handle requests, by route.', samples)
+        metric('http_request_db_seconds_total', 'counter', 'Time requests spent waiting for the database, by route (recorded while instrumentation is on).', [
+            ('http_request_db_seconds_total', route_labels[key], stats['db_seconds']) for key, stats in sorted(routes.items())])
+        metric('http_request_db_queries_total', 'counter', 'Database queries run by requests, by route (recorded while instrumentation is on).', [
+            ('http_request_db_queries_total', route_labels[key], stats['queries']) for key, stats in sorted(routes.items())])
+        metric('http_response_bytes_total', 'counter', 'Bytes sent in response bodies, by route.', [
+            ('http_response_bytes_total', route_labels[key], stats['bytes']) for key, stats in sorted(routes.items())])
+
+        processes = [snapshot for snapshot in snapshots if snapshot['process'] is not None]
+        metric('process_resident_memory_bytes', 'gauge', 'Resident memory of each worker process.', [
+            ('process_resident_memory_bytes', {'pid': snapshot['pid']}, snapshot['process']['rss_bytes']) for snapshot in processes])
+        metric('process_threads', 'gauge', 'Threads running in each worker process.', [
+            ('process_threads', {'pid': snapshot['pid']}, snapshot['process']['threads']) for snapshot in processes])
+        metric('db_pool_connections', 'gauge', "Connections in each worker's database connection pools, by state.", [
+            ('db_pool_connections', {'pid': snapshot['pid'], 'engine': engine, 'state': state}, count) for snapshot in processes for engine, pool in sorted(snapshot['process']['pools'].items()) for state, count in pool.items()])
+        return '\n'.join(lines) + '\n'
+
+
+_TOTALS = ('count', 'seconds', 'db_seconds', 'queries', 'bytes')
+
+def _stats_dict(stats):
+    return {'statuses': dict(stats.statuses), 'buckets': list(stats.buckets), **{name: getattr(stats, name) for name in _TOTALS}}
+
+# Adds the stats of one route (as a dictionary) to its total in routes.
+def _add(routes, key, stats):
+    total = routes.setdefault(key, {'statuses': {}, 'buckets': [0] * (len(DURATION_BUCKETS) + 1), **{name: 0 for name in _TOTALS}})
+    for status, count in stats['statuses'].items():
+        total['statuses'][status] = total['statuses'].get(status, 0) + count
+    for i, count in enumerate(stats['buckets']):
+        total['buckets'][i] += count
+    for name in _TOTALS:
+        total[name] += stats[name]
+
+# Returns the current resident memory of this process. /proc is read on Linux; elsewhere the peak resident memory is the best that is available.
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024 # ru_maxrss is in bytes on macOS and kilobytes on Linux
+
+def _running(pid):
+    try:
+        os.kill(pid, 0) # Signal 0 only checks the process exists
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Formats the labels of a sample, for example {blueprint="students",endpoint="students.get_one_student",method="GET"}. Backslashes, quotes and new lines in the values are escaped.
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
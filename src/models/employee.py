@@ -13,11 +13,11 @@ class Employee(db.Model):
     job_title = db.Column(db.String(128), nullable=False)
     department = db.Column(db.String(50), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, unique=True) # perhaps make this unique to force only one user
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, unique=True) # perhaps make this unique to force only one user
     
     user = db.relationship('User', back_populates='employee')
 
-    subject_classes = db.relationship('SubjectClass', back_populates='employee', cascade='all, delete') 
+    subject_classes = db.relationship('SubjectClass', back_populates='employee', cascade='all, delete', passive_deletes=True) # If an employee is deleted their classes and the enrollments in them are deleted too. The database does this itself (ON DELETE CASCADE) without SQLAlchemy loading the classes.
 
 
 class EmployeeSchema(ma.Schema):
@@ -4,12 +4,13 @@ from datetime import date
 
 class Enrollment(db.Model):
     __tablename__ = 'enrollments'
+    __table_args__ = (db.Index('ix_enrollments_subject_class_id_id', 'subject_class_id', 'id'),) # Enrollments are listed in subject_class_id order and filtered by class. The id is included so the pages can be read straight from the index.
 
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, default = date.today())
+    date = db.Column(db.Date, default = date.today(), index=True)
     
-    subject_class_id = db.Column(db.String(15), db.ForeignKey('subject_classes.id'), nullable=False) # perhaps make this unique to force only one user
-    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    subject_class_id = db.Column(db.String(15), db.ForeignKey('subject_classes.id', ondelete='CASCADE'), nullable=False) # perhaps make this unique to force only one user
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='CASCADE'), nullable=False, index=True)
 
     subject_class = db.relationship('SubjectClass', back_populates='enrollments')
     student = db.relationship('Student', back_populates='enrollments')
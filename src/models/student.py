@@ -4,21 +4,25 @@ from models.user import User, UserSchema
 from marshmallow.exceptions import ValidationError
 from datetime import date
 from marshmallow.validate import Length, OneOf, And, Regexp, Range
+from sqlalchemy import func, literal, distinct, not_
+from models.subject_class import SubjectClass
+from models.enrollment import Enrollment
 
 class Student(db.Model):
     __tablename__ = 'students'
 
     id = db.Column(db.Integer, primary_key=True)
-    homegroup = db.Column(db.String(20))
+    homegroup = db.Column(db.String(20), index=True) # Indexed as students can be filtered by homegroup, year_level and birth_country
     enrollment_date = db.Column(db.Date) # Date of enrollment to the school
-    year_level = db.Column(db.Integer)
-    birth_country = db.Column(db.String(56)) # The United Kingdom of Great Britain and Northern Ireland is the country with the longest name at 56 characters.
+    year_level = db.Column(db.Integer, index=True)
+    birth_country = db.Column(db.String(56), index=True) # The United Kingdom of Great Britain and Northern Ireland is the country with the longest name at 56 characters.
     
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, unique=True) # perhaps make this unique to force only one user
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, unique=True) # perhaps make this unique to force only one user
+    timetable_mask = db.Column(db.Integer, nullable=False, default=0, server_default='0') # The timetable lines the student has classes on, one bit per line (see line_bit below). This is kept up to date in the same transaction as their enrollments change so a clash can be checked without loading their classes.
     
     user = db.relationship('User', back_populates='student')
-    enrollments = db.relationship('Enrollment', back_populates='student', cascade= 'all, delete') # Enrollment is plural as a student can have many enrollments but student is singular as each enrollment relates to exactly one student. Student is the parent enrollment is the child. If a student is deleted all their enrollments need to be deleted too. Back populates is an attribute name that exsists in the related model which in this case is enrollment. 
-    student_relations = db.relationship('StudentRelation', back_populates='student', cascade= 'all, delete')
+    enrollments = db.relationship('Enrollment', back_populates='student', cascade='all, delete', passive_deletes=True) # Enrollment is plural as a student can have many enrollments but student is singular as each enrollment relates to exactly one student. Student is the parent enrollment is the child. If a student is deleted all their enrollments need to be deleted too. Back populates is an attribute name that exsists in the related model which in this case is enrollment. 
+    student_relations = db.relationship('StudentRelation', back_populates='student', cascade='all, delete', passive_deletes=True)
 
 
 class StudentSchema(ma.Schema):
@@ -50,3 +54,46 @@ class StudentSchema(ma.Schema):
         fields = ('id','user', 'homegroup', 'enrollment_date', 'year_level', 'birth_country', 'student_relations')
         ordered = True # puts the keys in the same order as the fields lists above otherwise it will be alphabetical order.
 
+
+# The following functions keep timetable_mask in step with the student's enrollments.
+
+# The bit for a timetable line in timetable_mask: line 1 is 1, line 2 is 2, line 3 is 4 and so on (SQL: 1 << (timetable_line - 1)). Classes without a timetable line have no bit.
+def line_bit(timetable_line):
+    return literal(1, db.Integer).op('<<', return_type=db.Integer)((timetable_line - 1).self_group())
+
+# Adds the timetable line of a class to a student's timetable_mask when they are enrolled in it. With reject_clashes the student is only updated if they don't already have a class on that line, so the clash check and the update are a single statement that doesn't read any of the student's classes.
+# (SQL: update students set timetable_mask = timetable_mask | :bit where id = :student_id and timetable_mask & :bit = 0)
+# Returns True if the student was updated, or False if they don't exist (or have a clash when reject_clashes is set).
+def occupy_line(student_id, subject_class_id, reject_clashes=False):
+    bit = func.coalesce(db.select(line_bit(SubjectClass.timetable_line)).where(SubjectClass.id == subject_class_id).scalar_subquery(), 0)
+    stmt = db.update(Student).where(Student.id == student_id).values(timetable_mask=Student.timetable_mask.op('|', return_type=db.Integer)(bit)).execution_options(synchronize_session=False)
+    if reject_clashes:
+        stmt = stmt.where(Student.timetable_mask.op('&', return_type=db.Integer)(bit) == 0)
+    return db.session.execute(stmt).rowcount == 1
+
+# Recalculates timetable_mask from the enrollments of the students matching the where clause (or every student if there isn't one). This is used after enrollments are deleted or moved, or a class changes timetable line, as a bit can only be cleared once none of the student's classes are on that line.
+# leaving is a condition on the enrollments and classes that are about to be deleted, so the masks can be set before a DELETE that removes them (and the enrollments to be removed don't need to be read first to find their students).
+# (SQL: update students set timetable_mask = (select coalesce(sum(distinct 1 << (timetable_line - 1)), 0) from enrollments join subject_classes ... where enrollments.student_id = students.id) where ...)
+def refresh_timetable_masks(where=None, leaving=None):
+    occupied = db.select(func.coalesce(func.sum(distinct(line_bit(SubjectClass.timetable_line))), 0)).select_from(Enrollment).join(SubjectClass, Enrollment.subject_class_id == SubjectClass.id).where(Enrollment.student_id == Student.id)
+    if leaving is not None:
+        occupied = occupied.where(not_(leaving))
+    occupied = occupied.scalar_subquery()
+    stmt = db.update(Student).values(timetable_mask=occupied).execution_options(synchronize_session=False)
+    if where is not None:
+        stmt = stmt.where(where)
+    db.session.execute(stmt)
+
+# Returns the timetable of each of the students as {student_id: {'timetable_mask': ..., 'lines': [...], 'clashes': [...]}}. The number of classes each student has on each line is counted in one aggregated query (SQL: select student_id, timetable_line, count(*) from enrollments join subject_classes ... where student_id in (...) group by student_id, timetable_line) and a line with more than one class is a clash.
+def timetable_summaries(student_ids):
+    summaries = {student_id: {'timetable_mask': 0, 'lines': [], 'clashes': []} for student_id in student_ids}
+    if not summaries:
+        return summaries
+    stmt = db.select(Enrollment.student_id, SubjectClass.timetable_line, func.count()).join(SubjectClass, Enrollment.subject_class_id == SubjectClass.id).where(Enrollment.student_id.in_(summaries), SubjectClass.timetable_line.is_not(None)).group_by(Enrollment.student_id, SubjectClass.timetable_line).order_by(Enrollment.student_id, SubjectClass.timetable_line)
+    for student_id, timetable_line, classes in db.session.execute(stmt):
+        summary = summaries[student_id]
+        summary['timetable_mask'] |= 1 << (timetable_line - 1)
+        summary['lines'].append(timetable_line)
+        if classes > 1:
+            summary['clashes'].append(timetable_line)
+    return summaries
@@ -11,8 +11,8 @@ class StudentRelation(db.Model):
     relationship_to_student = db.Column(db.String(50))
     is_primary_contact = db.Column(db.Boolean, default=True)
     
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False) 
-    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True) 
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='CASCADE'), nullable=False, index=True)
     
     user = db.relationship('User', back_populates='student_relations')
     
@@ -12,7 +12,7 @@ class Subject(db.Model):
     max_students = db.Column(db.Integer, default = 28)
     department = db.Column(db.String(50))
     
-    subject_classes = db.relationship('SubjectClass', back_populates='subject', cascade='all, delete') 
+    subject_classes = db.relationship('SubjectClass', back_populates='subject', cascade='all, delete', passive_deletes=True) 
   
 
 class SubjectSchema(ma.Schema):
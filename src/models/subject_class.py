@@ -1,20 +1,24 @@
 from init import db, ma # Imports start at the root folder. 
 from marshmallow import fields
 from marshmallow.validate import Length, OneOf, And, Regexp, Range
+from sqlalchemy import func
+from models.subject import Subject
+from models.enrollment import Enrollment
 
 class SubjectClass(db.Model):
     __tablename__ = 'subject_classes'
 
     id = db.Column(db.String(15), primary_key=True)
     room = db.Column(db.String(7))
-    timetable_line = db.Column(db.Integer) # often a school will strcuture their timetable so that each subject will have schedualed classes base on a specified timetable line (for example 1-6). Classes occuring at the same timetable line will occur at the same time. 
-    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id') ) 
-    subject_id = db.Column(db.String(15), db.ForeignKey('subjects.id'), nullable=False)
+    timetable_line = db.Column(db.Integer, index=True) # often a school will strcuture their timetable so that each subject will have schedualed classes base on a specified timetable line (for example 1-6). Classes occuring at the same timetable line will occur at the same time. 
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), index=True) 
+    subject_id = db.Column(db.String(15), db.ForeignKey('subjects.id', ondelete='CASCADE'), nullable=False, index=True)
+    enrollment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # The number of students enrolled in the class. This is kept up to date in the same transaction as each enrollment is added or removed so the class's capacity can be checked without counting its enrollments.
     employee = db.relationship('Employee', back_populates='subject_classes')
     
     subject = db.relationship('Subject', back_populates='subject_classes')
     
-    enrollments = db.relationship('Enrollment', back_populates='subject_class', cascade= 'all, delete') # If a subject_class is deleted all of the enrollments in the class will also be deleted. 
+    enrollments = db.relationship('Enrollment', back_populates='subject_class', cascade='all, delete', passive_deletes=True) # If a subject_class is deleted all of the enrollments in the class will also be deleted. The database does this itself (ON DELETE CASCADE) without SQLAlchemy loading the enrollments.
   
 
 class SubjectClassSchema(ma.Schema):
@@ -32,8 +36,31 @@ class SubjectClassSchema(ma.Schema):
         Regexp('^[a-zA-Z0-9.]+$', error='Only letters, numbers and periods (dots) are allowed')
     ))
     timetable_line = fields.Integer(validate=Range(min=1, max=6))
+    enrollment_count = fields.Integer(dump_only=True) # This is maintained by the API so it can't be set by clients
     
     class Meta:
-        fields = ('id','room', 'timetable_line', 'subject', 'employee_id','employee','enrollments')
-        ordered = True # puts the keys in the same order as the fields lists above otherwise it will be alphabetical order. 
+        fields = ('id','room', 'timetable_line', 'subject', 'employee_id','employee', 'enrollment_count', 'enrollments')
+        ordered = True # puts the keys in the same order as the fields lists above otherwise it will be alphabetical order.
 
+
+# The following functions keep enrollment_count in step with the enrollments table. They are called in the same transaction as the enrollments are inserted or deleted.
+
+# Reserves places in a class for new enrollments. The check and the increase happen in a single conditional UPDATE, so when many students enroll in the same class at once the database's row lock on the class makes each reservation wait for the one before it and the count can never go past the subject's max_students. No table locks are needed.
+# (SQL: update subject_classes set enrollment_count = enrollment_count + :places where id = :id and enrollment_count + :places <= (select max_students from subjects where subjects.id = subject_classes.subject_id))
+# Returns True if the places were reserved, or False if the class is full (or doesn't exist).
+def reserve_places(subject_class_id, places=1):
+    capacity = db.select(func.coalesce(Subject.max_students, 28)).where(Subject.id == SubjectClass.subject_id).scalar_subquery()
+    stmt = db.update(SubjectClass).where(SubjectClass.id == subject_class_id, SubjectClass.enrollment_count + places <= capacity).values(enrollment_count=SubjectClass.enrollment_count + places).execution_options(synchronize_session=False)
+    return db.session.execute(stmt).rowcount == 1
+
+# Gives back the places held by the enrollments matching the where clause (for example Enrollment.student_id == 1) before they are deleted or moved to another class.
+# (SQL: update subject_classes set enrollment_count = enrollment_count - (select count(*) from enrollments where enrollments.subject_class_id = subject_classes.id and ...) where id in (select subject_class_id from enrollments where ...))
+def release_places(where):
+    released = db.select(func.count()).select_from(Enrollment).where(Enrollment.subject_class_id == SubjectClass.id, where).scalar_subquery()
+    stmt = db.update(SubjectClass).where(SubjectClass.id.in_(db.select(Enrollment.subject_class_id).where(where))).values(enrollment_count=SubjectClass.enrollment_count - released).execution_options(synchronize_session=False)
+    db.session.execute(stmt)
+
+# Recalculates enrollment_count for every class from the enrollments table. This is used after enrollments are created without going through reserve_places (such as when the database is seeded).
+def refresh_enrollment_counts():
+    counted = db.select(func.count()).select_from(Enrollment).where(Enrollment.subject_class_id == SubjectClass.id).scalar_subquery()
+    db.session.execute(db.update(SubjectClass).values(enrollment_count=counted).execution_options(synchronize_session=False))
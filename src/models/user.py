@@ -10,6 +10,7 @@ VALID_TYPES = ('Employee', 'Caregiver', 'Student', 'Other', 'TBC')
 class User(db.Model):
     #A model is created for the User entity to provide an abstract representation the users table. A model is a python class that represents a table where each class attribute is a field (column) of the table.  This class inherits from the db.Model. 
 
+    __table_args__ = (db.Index('ix_users_last_name_id', 'last_name', 'id'),) # Users are listed (and can be filtered) by last_name, with ties ordered by id
     __tablename__ = 'users' # This names the table (otherwise SQLAlchemy will name it after the class which is singular: User). Tables must be plural. 
     
     # The following class attributes are defined to represent a field (column) of the table.   Here we include information such as a name, datatype, and constraints.  
@@ -17,32 +18,35 @@ class User(db.Model):
     title = db.Column(db.String(50)) # to store honorific titles
     first_name = db.Column(db.String(50), nullable= False) # Nullable = False means that the attribute cannot be left null. Each user must have a first name listed.
     middle_name = db.Column(db.String(50))
-    last_name = db.Column(db.String(50), nullable= False)
+    last_name = db.Column(db.String(50), nullable= False) # Indexed together with id below as users are listed in last_name order
     password = db.Column(db.String, nullable= False)
     email = db.Column(db.String(100), unique=True, nullable= False) # Unique = True means no two users are permitted to have the same email address. Each instance of the user model must have a unique email attribute. 
     phone = db.Column(db.String(20), nullable= False)
     dob = db.Column(db.Date) 
     gender = db.Column(db.String(50))
-    type = db.Column(db.String(9), default= "TBC") # Users will need to have their type set by an admin employee as their type gives them access rights to different routes in the API. 
+    type = db.Column(db.String(9), default= "TBC", index=True) # Users will need to have their type set by an admin employee as their type gives them access rights to different routes in the API. 
+    token_version = db.Column(db.Integer, nullable= False, default= 0, server_default= '0') # This is increased whenever the user's type or admin rights change. Tokens that carry role claims record the version they were issued with and are rejected once it no longer matches. It is not included in the schema so it is never sent to clients.
 
     # User is linked to the addresses table by the foreign key addresses id (which is that model’s primary key). User represents the child side of this one-to-many relationship as each user has only one address, but each address can belong to multiple users.
     
-    address_id = db.Column(db.Integer, db.ForeignKey('addresses.id')) 
+    address_id = db.Column(db.Integer, db.ForeignKey('addresses.id', ondelete='SET NULL'), index=True) # If the address is deleted the database clears this (ON DELETE SET NULL)
     # The relation then needs to be defined with Relationship().  This takes numerous parameters. The first parameter indicates which other model (class name) it relates to as a string. Address will encapsulate data from the Address model.  This allows an address object to be provided for each user. The second parameter back_populates is used to specify the other side of the relationship.  It adds a field to each address called user that will return the entire user object for an address. 
     address = db.relationship('Address', back_populates='users')
 
     
+    # The employees, students and student_relations tables reference users ON DELETE CASCADE, so deleting a user is a single DELETE statement and the database removes their rows in those tables itself. passive_deletes=True stops SQLAlchemy from selecting each of those rows first to delete them one by one.
+
     # Establish a one-to-one relationship between user and employee. One user can have zero to one employee information stored about them (not all users are employees) and each employee will have exactly one entry in the user’s table to store their personal information. Employee is singular as a user can only relate to one employee.  
      
-    employee = db.relationship('Employee', back_populates='user', cascade='all, delete', uselist=False) # Relationship() is specified on the user to link the user to the employee model Again the first parameter indicates which model it relates to.  This allows an employee object to be provided for a user. Back_populates is again used to specify the other side of the relationship. It will add a property to employee called user that will return the entire address object for a user.  Cascade all delete was added which means that if a user is deleted their related resource in the employee or student table will also be deleted.  Uselist=False was added here because this is a one-to-one relationship, and this indicates the result is a single object (rather than a list). 
+    employee = db.relationship('Employee', back_populates='user', cascade='all, delete', passive_deletes=True, uselist=False) # Relationship() is specified on the user to link the user to the employee model Again the first parameter indicates which model it relates to.  This allows an employee object to be provided for a user. Back_populates is again used to specify the other side of the relationship. It will add a property to employee called user that will return the entire address object for a user.  Cascade all delete was added which means that if a user is deleted their related resource in the employee or student table will also be deleted.  Uselist=False was added here because this is a one-to-one relationship, and this indicates the result is a single object (rather than a list). 
 
     # The same process is then repeated to link user to student.  This is another one-to-one relationship: 
 
-    student = db.relationship('Student', back_populates='user', cascade='all, delete', uselist=False) 
+    student = db.relationship('Student', back_populates='user', cascade='all, delete', passive_deletes=True, uselist=False) 
     
     # Users are also linked to the student_relations table. This is a one-to-one relationship as one user can have many student relations (they may be a caregiver to multiple siblings). Cascade all delete was added which means that if a user is deleted their related student_relations record will also be deleted. . 
 
-    student_relations = db.relationship('StudentRelation', back_populates='user', cascade= 'all, delete')
+    student_relations = db.relationship('StudentRelation', back_populates='user', cascade='all, delete', passive_deletes=True)
 
 # Add any defaults in both places
 class UserSchema(ma.Schema):
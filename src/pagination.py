@@ -0,0 +1,141 @@
+# This module provides keyset (cursor) pagination for the list routes. Rather than returning every row in a table, each list route returns one page of results and a cursor pointing to the last row on that page. The next page is then selected with a WHERE clause on the sort keys (SQL: ... where (last_name, id) > (:last_name, :id) order by last_name, id limit 100) which stays fast no matter how deep into the table the client is, unlike OFFSET which has to scan and throw away every earlier row.
+import base64
+import json
+import zlib
+from datetime import date, datetime
+from flask import request, abort, url_for
+from sqlalchemy import and_, or_, tuple_, inspect, false
+from sqlalchemy.orm import undefer
+from sqlalchemy.sql import operators
+from init import db
+
+DEFAULT_PAGE_SIZE = 100 # The number of rows returned when the client doesn't provide a limit
+MAX_PAGE_SIZE = 1000 # The largest page a client is allowed to request
+
+
+# Reads the limit and after query parameters from the request. A 400 error is returned if the limit isn't a whole number between 1 and MAX_PAGE_SIZE.
+def get_page_args():
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400, description='The limit parameter must be a whole number.')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        abort(400, description=f'The limit parameter must be between 1 and {MAX_PAGE_SIZE}.')
+    return limit, request.args.get('after')
+
+
+# Splits an order_by expression such as Employee.hired_date.desc() into the column and a flag saying whether it is sorted in descending order.
+def _sort_key(expression):
+    if getattr(expression, 'modifier', None) is operators.desc_op:
+        return expression.element, True
+    if getattr(expression, 'modifier', None) is operators.asc_op:
+        return expression.element, False
+    return expression, False
+
+
+# Reads the sort query parameter, a comma separated list of the fields to sort by where a leading - sorts that field in descending order (for example ?sort=-year_level,homegroup). Sortable maps the names the client can use to the model's columns. The default ordering is returned when no sort parameter is given, and a 400 error for a field that can't be sorted by.
+def get_sort(sortable, *default):
+    sort = request.args.get('sort')
+    if not sort:
+        return default
+    order_by = []
+    for name in sort.split(','):
+        name = name.strip()
+        descending = name.startswith('-')
+        column = sortable.get(name.lstrip('-'))
+        if column is None:
+            abort(400, description=f"Can't sort by '{name.lstrip('-')}'. Fields that can be sorted by: {', '.join(sortable)}.")
+        order_by.append(column.desc() if descending else column)
+    return order_by
+
+
+# A short checksum of the sort keys and their directions. It is stored in the cursor so a cursor from one ordering can't be used with another, which would silently skip or repeat rows.
+def _fingerprint(keys):
+    return zlib.crc32(','.join(f"{'-' if descending else ''}{column.table.name}.{column.key}" for column, descending in keys).encode('utf8'))
+
+
+# The cursor is made opaque by base64 encoding the sort key fingerprint and the sort key values of the last row on the page. Dates are stored as ISO strings and converted back using the column's python type.
+def encode_cursor(values, keys):
+    raw = json.dumps([_fingerprint(keys)] + [v.isoformat() if isinstance(v, (date, datetime)) else v for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, keys):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(keys) + 1:
+            raise ValueError
+        fingerprint, values = values[0], values[1:]
+        if fingerprint != _fingerprint(keys):
+            abort(400, description='The after cursor was created for a different sort order. Start again from the first page.')
+        decoded = []
+        for (column, _), value in zip(keys, values):
+            python_type = column.type.python_type
+            if value is not None and python_type in (date, datetime):
+                value = python_type.fromisoformat(value)
+            decoded.append(value)
+        return decoded
+    except (ValueError, TypeError, UnicodeError):
+        abort(400, description='The after parameter is not a valid pagination cursor.')
+
+
+# Orders by a sort key. Columns that can be null have their nulls put last in ascending order and first in descending order, so the order is the same on every database (PostgreSQL and SQLite put nulls at opposite ends by default).
+def _order(column, descending):
+    if not column.nullable:
+        return column.desc() if descending else column
+    return column.desc().nulls_first() if descending else column.asc().nulls_last()
+
+
+# Selects the rows that come after the value in one sort key's order.
+def _after(column, descending, value):
+    if value is None: # Nulls come after every value in ascending order and before every value in descending order
+        return column.isnot(None) if descending else false()
+    if descending:
+        return column < value
+    return or_(column > value, column.is_(None)) if column.nullable else column > value
+
+
+# Builds the WHERE clause that selects the rows after the cursor. When every key is sorted in the same direction and none can be null a row value comparison is used as it can be answered directly from a composite index. Otherwise (such as hired_date desc, id asc) it is expanded into (a < :a) or (a = :a and b > :b).
+def _after_clause(keys, values):
+    directions = {descending for _, descending in keys}
+    if len(directions) == 1 and not any(column.nullable for column, _ in keys):
+        columns = tuple_(*[column for column, _ in keys])
+        cursor = tuple_(*values)
+        return columns < cursor if directions.pop() else columns > cursor
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal = [keys[j][0].is_(None) if values[j] is None else keys[j][0] == values[j] for j in range(i)]
+        clauses.append(and_(*equal, _after(column, descending, values[i])))
+    return or_(*clauses)
+
+
+# Applies the requested ordering, cursor and limit to a select statement and executes it. The primary key of the selected model is always added as the final sort key so rows that tie on the other keys (for example two users with the same last name) keep a stable order and are never skipped or repeated between pages.
+# Returns the rows on the page and the response headers to send with them. The Link header contains the URL of the next page (RFC 8288) and is left out on the last page.
+def paginate(stmt, *order_by):
+    limit, after = get_page_args()
+    model = stmt.column_descriptions[0]['entity']
+    keys = [_sort_key(expression) for expression in order_by]
+    for column in inspect(model).primary_key:
+        if not any(key.key == column.key for key, _ in keys):
+            keys.append((getattr(model, column.key).expression, False))
+
+    stmt = stmt.order_by(*[_order(column, descending) for column, descending in keys])
+    columns = inspect(model).column_attrs
+    stmt = stmt.options(*[undefer(getattr(model, column.key)) for column, _ in keys if column.key in columns]) # The sort keys are read from the last row to build the cursor so they are always loaded, even if the schema doesn't dump them.
+    if after:
+        stmt = stmt.where(_after_clause(keys, decode_cursor(after, keys)))
+    rows = db.session.scalars(stmt.limit(limit + 1)).all() # One extra row is selected to find out if there is another page without running a count query.
+
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        cursor = encode_cursor([getattr(last, column.key) for column, _ in keys], keys)
+        args = request.args.to_dict(flat=False) # Any other query parameters are kept on the next link
+        args.update(after=cursor, limit=limit)
+        next_url = url_for(request.endpoint, **(request.view_args or {}), **args)
+        headers['Link'] = f'<{next_url}>; rel="next"'
+        headers['X-Next-Cursor'] = cursor
+    return rows, headers
@@ -0,0 +1,173 @@
+# This module profiles requests on the running app so a slow route can be looked into without redeploying. There are two ways a request is profiled:
+# - on demand: an admin employee sends the request with an X-Profile header. The header is checked with auth_admin, so anyone else sending it gets a 401. With X-Profile: text the profile is returned as the response body instead of the route's response; with any other value the route's response is returned as normal.
+# - sampling: with PROFILE_SAMPLE_RATE set to N, one in every N requests is profiled whoever sends it.
+# Each profile is saved under a new id made by the server, and can be read back through /admin/profiles. The id is returned in the X-Profile-Id header of requests profiled with the X-Profile header (sampled requests can come from anyone, so they aren't told). If the client sent an X-Request-ID header it is recorded in the profile so the profile can be matched to other logs. Profiles are kept in PROFILE_DIR, which is a ring buffer: once it holds PROFILE_KEEP profiles the oldest is deleted as each new one is saved, so it can't fill the disk.
+# Profiles are taken with pyinstrument (a sampling profiler, which slows the request down much less) when it is installed and with the standard library's cProfile otherwise. pyinstrument is optional and is not in requirements.txt. Only the thread handling the request is profiled, from the first before_request function to the last after_request function (the body of a streamed response is sent after the profile ends).
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import re
+import tempfile
+import time
+import uuid
+from flask import g, request, current_app
+
+try:
+    import pyinstrument
+except ImportError: # pyinstrument is optional
+    pyinstrument = None
+
+_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$') # Profile ids are used as file names so anything else is rejected. Request ids are checked the same way before they are recorded.
+
+
+class RequestProfiler:
+    def __init__(self, app=None, authorize=None):
+        self.sample_rate = 0
+        self.keep = 50
+        self.directory = None
+        self.authorize = authorize
+        self._requests = itertools.count(1)
+        if app is not None:
+            self.init_app(app, authorize)
+
+    # Must be called before the other extensions register their before_request and after_request functions so the profile covers them. authorize is called when the X-Profile header is sent and should abort the request if the user isn't allowed to profile it.
+    def init_app(self, app, authorize=None):
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0)
+        app.config.setdefault('PROFILE_KEEP', 50)
+        app.config.setdefault('PROFILE_DIR', None)
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE'] # 0 turns sampling off
+        self.keep = app.config['PROFILE_KEEP']
+        self.directory = app.config['PROFILE_DIR'] or os.path.join(tempfile.gettempdir(), 'api-profiles')
+        self.authorize = authorize or self.authorize
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._stop)
+        app.extensions['profiler'] = self
+
+    def _start_request(self):
+        mode = request.headers.get('X-Profile')
+        if mode is not None:
+            self.authorize() # Checked before the profile starts so only admins can profile a request
+            mode = 'text' if mode.strip().lower() == 'text' else 'saved'
+        elif self.sample_rate and next(self._requests) % self.sample_rate == 0:
+            mode = 'sampled'
+        else:
+            return
+        profiler = pyinstrument.Profiler() if pyinstrument is not None else cProfile.Profile()
+        try:
+            if pyinstrument is not None:
+                profiler.start()
+            else:
+                profiler.enable()
+        except (RuntimeError, ValueError): # Another profiler is already running on this thread
+            current_app.logger.warning('Could not profile %s %s: another profiler is running', request.method, request.path)
+            return
+        request_id = request.headers.get('X-Request-ID', '')
+        g.profile = {'profiler': profiler, 'mode': mode, 'id': uuid.uuid4().hex, 'request_id': request_id if _ID.match(request_id) else None, 'start': time.perf_counter()}
+
+    def _finish_request(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        profiler = profile['profiler']
+        duration_ms = round((time.perf_counter() - profile['start']) * 1000, 3)
+        if pyinstrument is not None:
+            profiler.stop()
+            report = profiler.output_text(unicode=True, color=False)
+        else:
+            profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(60) # The 60 functions with the most time spent in them and the functions they call
+            report = output.getvalue()
+        summary = {
+            'id': profile['id'],
+            'request_id': profile['request_id'],
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': duration_ms,
+            'mode': profile['mode'],
+            'profiler': 'pyinstrument' if pyinstrument is not None else 'cProfile',
+            'created': time.time()
+        }
+        try:
+            self._save(summary, report, profiler if pyinstrument is None else None)
+        except OSError as err: # A full or read only disk shouldn't break the request
+            current_app.logger.warning('Could not save the profile of %s %s: %s', request.method, request.path, err)
+        if profile['mode'] == 'text':
+            response = current_app.response_class(f"{summary['method']} {summary['path']} {summary['status']} in {summary['duration_ms']} ms\n\n{report}", mimetype='text/plain')
+        if profile['mode'] != 'sampled': # Only requests that were authorised to be profiled are given the id
+            response.headers['X-Profile-Id'] = profile['id']
+        return response
+
+    # Makes sure the profiler is stopped if the request ended without reaching _finish_request (for example if another after_request function raised an error), as it would otherwise keep profiling the thread.
+    def _stop(self, exc):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            if pyinstrument is not None:
+                profile['profiler'].stop()
+            else:
+                profile['profiler'].disable()
+
+    # Saves a profile as <id>.json (the summary and the text report) along with <id>.prof (the raw cProfile stats, which tools such as snakeviz can open) and then deletes the oldest profiles past the limit.
+    def _save(self, summary, report, stats):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, summary['id'])
+        if stats is not None:
+            stats.dump_stats(f'{path}.prof')
+        with open(f'{path}.json.tmp', 'w') as file:
+            json.dump(dict(summary, report=report), file)
+        os.replace(f'{path}.json.tmp', f'{path}.json') # Renamed into place so a profile is never read half written
+        for old in self._paths()[self.keep:]:
+            for name in (old, old[:-len('.json')] + '.prof'):
+                try:
+                    os.remove(name)
+                except FileNotFoundError: # Already removed by another thread or worker
+                    pass
+
+    # Returns the paths of the saved profiles, newest first.
+    def _paths(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        except FileNotFoundError:
+            return []
+        paths = [os.path.join(self.directory, name) for name in names]
+        modified = {}
+        for path in paths:
+            try:
+                modified[path] = os.path.getmtime(path)
+            except FileNotFoundError:
+                pass
+        return sorted(modified, key=modified.get, reverse=True)
+
+    # Returns the summaries of the saved profiles, newest first.
+    def profiles(self):
+        summaries = []
+        for path in self._paths():
+            profile = self._read(path)
+            if profile is not None:
+                profile.pop('report')
+                summaries.append(profile)
+        return summaries
+
+    # Returns the saved profile with the id (its summary and report), or None if there isn't one.
+    def profile(self, profile_id):
+        if not _ID.match(profile_id):
+            return None
+        return self._read(os.path.join(self.directory, f'{profile_id}.json'))
+
+    # Returns the path of the raw cProfile stats of the profile with the id, or None if there aren't any.
+    def stats_path(self, profile_id):
+        path = os.path.join(self.directory, f'{profile_id}.prof')
+        return path if _ID.match(profile_id) and os.path.exists(path) else None
+
+    def _read(self, path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError): # Deleted from the ring buffer since it was listed
+            return None
@@ -0,0 +1,114 @@
+# This module sends the queries of GET requests to read replicas of the database so that reads don't compete with writes on the primary. It is turned on by listing the replicas in DATABASE_REPLICA_URLS (comma separated). Each one becomes a Flask-SQLAlchemy bind called replica_1, replica_2 and so on.
+# - each GET or HEAD request picks the next healthy replica in turn (round-robin) and every query it runs goes to that replica. Any statement that writes, and every request that isn't a GET, uses the primary.
+# - a replica that fails to connect or loses its connection is skipped for REPLICA_RETRY_SECONDS, and requests go to the other replicas or the primary until then. The query that found the replica was down is run again on the primary, along with the rest of that request's queries.
+# - replicas lag slightly behind the primary, so a client that has just changed something would not always see their change. For REPLICA_STICKY_SECONDS after a successful write, that client's requests are sent to the primary. The client is recognised by its token (or address) in this process, and by a short-lived cookie for requests that reach a different worker.
+# This can be tried locally with two SQLite files: seed the database, copy the file and set DATABASE_REPLICA_URLS=sqlite:////path/to/copy.db.
+import itertools
+import time
+from hashlib import sha1
+from flask import g, request, current_app, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.util import EMPTY_DICT
+from cache import TTLCache
+
+STICKY_COOKIE = 'read_primary'
+
+
+# Builds the SQLALCHEMY_BINDS for the comma separated replica urls.
+def replica_binds(urls):
+    urls = [url.strip() for url in (urls or '').split(',') if url.strip()]
+    return {f'replica_{i}': url for i, url in enumerate(urls, start=1)}
+
+
+class ReplicaRouter:
+    def __init__(self, db):
+        self.db = db
+        self.engines = {} # bind key: engine
+        self.sticky_seconds = 5
+        self.retry_seconds = 30
+        self._turn = itertools.count() # Round-robin counter (next() on a count is safe across threads)
+        self._down_until = {} # bind key: time the replica can be tried again
+        self._recent_writers = TTLCache(maxsize=10000, ttl=self.sticky_seconds)
+
+    def init_app(self, app):
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        app.config.setdefault('REPLICA_RETRY_SECONDS', 30)
+        self.sticky_seconds = app.config['REPLICA_STICKY_SECONDS']
+        self.retry_seconds = app.config['REPLICA_RETRY_SECONDS']
+        self._recent_writers = TTLCache(maxsize=10000, ttl=self.sticky_seconds)
+        with app.app_context():
+            self.engines = {key: engine for key, engine in self.db.engines.items() if key and key.startswith('replica_')}
+        for key, engine in self.engines.items():
+            event.listen(engine, 'handle_error', self._replica_error(key))
+        if self.engines:
+            app.before_request(self._choose_replica)
+            app.after_request(self._remember_writer)
+        app.extensions['replica_router'] = self
+
+    # Returns a handle_error listener that takes the replica out of use when it can't be connected to or its connection is lost.
+    def _replica_error(self, key):
+        def handle_error(context):
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+                self._down_until[key] = time.monotonic() + self.retry_seconds
+        return handle_error
+
+    def healthy(self, key):
+        return self._down_until.get(key, 0) <= time.monotonic()
+
+    def _client(self):
+        return sha1((request.headers.get('Authorization') or request.remote_addr or '').encode()).hexdigest()
+
+    def _choose_replica(self):
+        if request.method not in ('GET', 'HEAD'):
+            return
+        if request.cookies.get(STICKY_COOKIE) or self._recent_writers.get(self._client()):
+            return # The client has just written something so it reads from the primary
+        keys = list(self.engines)
+        start = next(self._turn)
+        for i in range(len(keys)):
+            key = keys[(start + i) % len(keys)]
+            if self.healthy(key):
+                g.replica_key, g.replica = key, self.engines[key]
+                return
+
+    # Stops the current request reading from its replica after the replica failed, so the rest of its queries go to the primary.
+    def fall_back(self, err):
+        key = g.pop('replica_key', None)
+        g.pop('replica', None)
+        current_app.logger.warning('Read replica %s is unavailable, reading from the primary: %s', key, err)
+
+    def _remember_writer(self, response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 and request.endpoint != 'auth.auth_login': # Logging in doesn't change anything the client reads
+            self._recent_writers.set(self._client(), True)
+            response.set_cookie(STICKY_COOKIE, '1', max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+        return response
+
+
+# Returns True when the current request's queries are going to a replica.
+def reading_from_replica():
+    return has_request_context() and g.get('replica') is not None
+
+
+# The session used by db. Reads in a request that chose a replica go to that replica and everything else goes to the engine Flask-SQLAlchemy would normally pick.
+# A read that must see the latest data (such as the user's permissions) can be sent to the primary with db.session.execute(stmt, bind_arguments={'primary': True}).
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, primary=False, **kwargs):
+        if bind is None and not primary and not self._flushing and not isinstance(clause, UpdateBase) and reading_from_replica():
+            return g.replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    # If the replica a query was sent to fails, the query is run again on the primary instead of the request returning a 500 error. The session is rolled back first as a lost connection leaves its replica transaction unusable (a GET request has nothing to commit, and any objects it already loaded are reloaded from the primary when they are next used). Any other database error is raised as usual.
+    def execute(self, statement, params=None, execution_options=EMPTY_DICT, bind_arguments=None, **kwargs):
+        replica = g.replica if reading_from_replica() and not isinstance(statement, UpdateBase) and not (bind_arguments or {}).get('primary') else None
+        try:
+            return super().execute(statement, params, execution_options, bind_arguments, **kwargs)
+        except OperationalError as err:
+            router = current_app.extensions['replica_router']
+            if replica is None or g.get('replica') is not replica or router.healthy(g.replica_key): # The error didn't come from the replica (its handle_error listener takes it out of use)
+                raise
+            router.fall_back(err)
+            self.rollback()
+            return super().execute(statement, params, execution_options, bind_arguments, **kwargs)
@@ -0,0 +1,174 @@
+# This module keeps one instance of each schema shape so routes don't build new schemas on every request, and provides an optional faster way to dump them.
+# Building a marshmallow schema is not free: every field is copied from the class, only/exclude are applied and each fields.Nested('...') string reference is looked up in the class registry the first time it is used. A schema is not changed by dump() or load() so one instance can be shared by every request (and thread) that needs the same shape.
+# GET routes build their schema with request_schema(), which lets the client choose the fields returned with the fields and include query parameters (see below).
+# Dumping with marshmallow also calls several methods for every field of every row. When COMPILED_SERIALIZERS is turned on, dump() instead uses a function built once per schema that reads each attribute and converts it directly. Only the field types used by this API (Integer, String, Boolean, Date, inferred fields, Nested and List(Nested)) are converted this way; any other field, or a schema with pre/post dump hooks, falls back to marshmallow so the output is always the same (benchmark.py --verify-serializers compares the two).
+import datetime
+from flask import current_app, request, abort
+from marshmallow import Schema, fields
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
+from marshmallow.utils import missing
+from cache import TTLCache
+from init import instrumentation
+from loading import _nested_schema
+
+_schemas = {}
+_sparse_schemas = TTLCache(maxsize=512, ttl=24 * 60 * 60) # Shapes chosen by clients with ?fields= are kept separately so their number is bounded
+
+
+# Returns the shared instance of schema_class with the given options, creating it the first time it is asked for. For example get_schema(StudentSchema, many=True, exclude=['student_relations']).
+def get_schema(schema_class, many=False, only=None, exclude=()):
+    key = (schema_class, many, tuple(only) if only is not None else None, tuple(exclude))
+    schema = _schemas.get(key)
+    if schema is None:
+        schema = _schemas.setdefault(key, schema_class(many=many, only=only, exclude=exclude))
+    return schema
+
+
+# Returns the schema for a GET route, applying the fields and include query parameters to the route's default shape:
+# - fields is a comma separated list of the fields to return (for example ?fields=id,user.first_name,user.last_name). Nested fields are given as dotted paths. This becomes the schema's only option, and because the query's columns and relationship loading are planned from the schema (see loading.py) the fields that aren't asked for are not selected from the database either.
+# - include is a comma separated list of fields the route leaves out by default (its exclude option) that should be returned (for example /students/?include=student_relations).
+# A 400 error is returned for a field that doesn't exist or can't be returned by the route.
+def request_schema(schema_class, many=False, only=None, exclude=()):
+    requested = _split_arg('fields')
+    included = _split_arg('include')
+    if not requested and not included:
+        return get_schema(schema_class, many, only, exclude)
+    exclude = list(exclude)
+    for name in included:
+        if name not in exclude:
+            abort(400, description=f"The field '{name}' can't be included. Fields that can be included here: {', '.join(exclude) or 'none'}.")
+        exclude.remove(name)
+    schema = get_schema(schema_class, many, only, exclude)
+    if not requested:
+        return schema
+    # Each path is checked against the route's shape and the paths are put in the order the schema dumps them, so the same fields asked for in a different order share one schema.
+    requested = sorted(set(requested), key=lambda path: _field_position(schema, path))
+    key = (schema_class, many, tuple(requested), tuple(exclude))
+    sparse = _sparse_schemas.get(key)
+    if sparse is None:
+        sparse = schema_class(many=many, only=requested, exclude=exclude)
+        _sparse_schemas.set(key, sparse)
+    return sparse
+
+
+def _split_arg(name):
+    return [value.strip() for value in request.args.get(name, '').split(',') if value.strip()]
+
+
+# Returns the position of each part of a dotted field path in the schema it belongs to, or aborts with a 400 error if the path doesn't exist.
+# Marshmallow intersects the fields asked for inside a nested field with the nested field's own only option (such as fields.Nested('EnrollmentSchema', only=['student'])), so the rest of a path that goes into one of those fields must be one of its only entries.
+def _field_position(schema, path):
+    position = []
+    parts = path.split('.')
+    for i, part in enumerate(parts):
+        names = list(schema.dump_fields) if schema is not None else []
+        if part not in names:
+            abort(400, description=f"Unknown field '{path}' in the fields parameter.")
+        position.append(names.index(part))
+        field = schema.dump_fields[part]
+        only = getattr(field.inner if isinstance(field, fields.List) else field, 'only', None)
+        rest = '.'.join(parts[i + 1:])
+        if rest and only is not None:
+            if rest not in only:
+                abort(400, description=f"Unknown field '{path}' in the fields parameter. Fields that can be selected in {'.'.join(parts[:i + 1])}: {', '.join(sorted(only))}.")
+            break
+        schema = _nested_schema(field)
+    return position
+
+
+# Serializes obj (or a list of objects if the schema has many=True) with the schema. This is used by the routes in place of schema.dump().
+def dump(schema, obj):
+    with instrumentation.phase('serialize'): # Reported in the Server-Timing header
+        if not current_app.config.get('COMPILED_SERIALIZERS'):
+            return schema.dump(obj)
+        dump_one = compiled_dump(schema)
+        if schema.many:
+            return [dump_one(item) for item in obj]
+        return dump_one(obj)
+
+
+# Returns the function that dumps a single object with the schema, building it the first time. The function is stored on the schema so it is thrown away along with the schema.
+def compiled_dump(schema):
+    dump_one = getattr(schema, '_compiled_dump', None)
+    if dump_one is None:
+        dump_one = schema._compiled_dump = _compile(schema)
+    return dump_one
+
+
+def _has_dump_hooks(schema):
+    return any(schema._hooks[(tag, pass_many)] for tag in (PRE_DUMP, POST_DUMP) for pass_many in (True, False))
+
+
+def _compile(schema):
+    if _has_dump_hooks(schema) or type(schema).get_attribute is not Schema.get_attribute:
+        return lambda obj: schema.dump(obj, many=False)
+
+    plan = [] # (key, attribute, converter, field name, field). A converter of None means the field is serialized by marshmallow.
+    for name, field in schema.dump_fields.items():
+        key = field.data_key if field.data_key is not None else name
+        attribute = field.attribute or name
+        converter = _converter(field) if '.' not in attribute else None
+        plan.append((key, attribute, converter, name, field))
+
+    def dump_one(obj):
+        data = {}
+        for key, attribute, converter, name, field in plan:
+            if converter is None:
+                value = field.serialize(name, obj, accessor=schema.get_attribute)
+                if value is missing:
+                    continue
+                data[key] = value
+            else:
+                data[key] = converter(getattr(obj, attribute))
+        return data
+    return dump_one
+
+
+# Returns a function that converts an attribute's value the same way the field would, or None if the field has to be serialized by marshmallow.
+def _converter(field):
+    if isinstance(field, fields.List) and isinstance(field.inner, fields.Nested) and type(field)._serialize is fields.List._serialize:
+        nested = _nested_converter(field.inner)
+        if nested is None:
+            return None
+        return lambda value: None if value is None else [nested(item) for item in value]
+    if isinstance(field, fields.Nested):
+        return _nested_converter(field)
+    if type(field)._serialize is fields.Integer._serialize and not field.as_string:
+        return _integer
+    if type(field)._serialize is fields.String._serialize:
+        return _string
+    if type(field)._serialize is fields.Date._serialize and isinstance(field, fields.Date) and field.format in (None, 'iso'):
+        return _date
+    if type(field)._serialize is fields.Boolean._serialize:
+        return lambda value: value if value is None or value is True or value is False else field._serialize(value, None, None)
+    if type(field) is fields.Inferred:
+        return lambda value: _INFERRED[type(value)](value) if type(value) in _INFERRED else field._serialize(value, None, None)
+    return None
+
+
+def _nested_converter(field):
+    if type(field)._serialize is not fields.Nested._serialize:
+        return None
+    dump_one = compiled_dump(field.schema)
+    if field.schema.many or field.many:
+        return lambda value: None if value is None else [dump_one(item) for item in value]
+    return lambda value: None if value is None else dump_one(value)
+
+
+def _integer(value):
+    return None if value is None else int(value)
+
+def _string(value):
+    return None if value is None else str(value)
+
+def _date(value):
+    return None if value is None else value.isoformat()
+
+# How inferred fields (those only listed in Meta.fields) convert the value types stored in this API's tables.
+_INFERRED = {
+    type(None): lambda value: None,
+    str: str,
+    int: int,
+    bool: bool,
+    datetime.date: _date
+}
@@ -0,0 +1,245 @@
+# This module generates a large, realistic school so that the API can be tried out at scale. Every value it creates passes the validation rules on the marshmallow schemas and every foreign key points at a row it has created (or one that already exists), so the generated data behaves exactly like data entered through the API.
+# Rows are built as plain dictionaries with their ids assigned up front, which allows related rows to reference each other without a round trip to the database. They are then written with bulk inserts (or COPY on PostgreSQL) instead of adding one ORM object at a time.
+import csv
+import io
+import math
+import random
+from datetime import date, timedelta
+from sqlalchemy import func
+from init import db, hasher
+from models.address import Address
+from models.user import User
+from models.student import Student
+from models.employee import Employee
+from models.student_relation import StudentRelation
+from models.subject import Subject
+from models.subject_class import SubjectClass
+from models.enrollment import Enrollment
+
+SYNTHETIC_PASSWORD = 'Synthetic1!' # Every generated user shares this password so it only needs to be hashed once. It meets the password rules on the UserSchema.
+BATCH_SIZE = 5000 # The number of rows sent to the database in each insert statement
+
+FIRST_NAMES = ['Oliver', 'Charlotte', 'Noah', 'Amelia', 'Jack', 'Isla', 'William', 'Olivia', 'Leo', 'Mia', 'Lucas', 'Ava', 'Thomas', 'Grace', 'Henry', 'Chloe', 'Charlie', 'Willow', 'James', 'Matilda', 'Ethan', 'Harper', 'Mason', 'Ella', 'Hudson', 'Zoe', 'Archie', 'Sophie', 'Liam', 'Ruby', 'Oscar', 'Evie', 'Arlo', 'Lily', 'Hunter', 'Sienna', 'Harrison', 'Isabella', 'Max', 'Ivy']
+LAST_NAMES = ['Smith', 'Jones', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Johnson', 'White', 'Martin', 'Anderson', 'Thompson', 'Nguyen', 'Thomas', 'Walker', 'Harris', 'Lee', 'Ryan', 'Robinson', 'Kelly', 'King', 'Davis', 'Wright', 'Evans', 'Roberts', 'Green', 'Hall', 'Wood', 'Jackson', 'Clarke', 'Patel', 'Khan', 'Lewis', 'James', 'Phillips', 'Mitchell', 'Campbell', 'Morgan', 'Cooper', 'Murphy', 'Hughes']
+STREET_NAMES = ['Rose Street', 'Sand Street', 'York Street', 'Captain Road', 'Boundary Street', 'Main Avenue', 'Park Road', 'Church Street', 'Hill Crescent', 'River Terrace', 'Station Road', 'Ocean Parade', 'Queen Street', 'King Street', 'Wattle Place']
+SUBURBS = [('Toowong', 4066), ('Milton', 4064), ('Nundah', 4012), ('West End', 4101), ('Paddington', 4064), ('Ashgrove', 4060), ('Bardon', 4065), ('Indooroopilly', 4068), ('Kenmore', 4069), ('Chermside', 4032), ('Wynnum', 4178), ('Carindale', 4152)]
+BIRTH_COUNTRIES = ['Australia'] * 8 + ['New Zealand', 'India', 'China', 'United Kingdom', 'Vietnam', 'Philippines', 'South Africa']
+CAREGIVER_RELATIONSHIPS = ['Mother', 'Father', 'Grandmother', 'Grandfather', 'Aunt', 'Uncle', 'Guardian']
+HOUSES = ['WH', 'RD', 'BL', 'GR']
+# (abbreviation, subject name, department). Names only use letters and spaces and departments are at least 5 letters long to match the SubjectSchema.
+SUBJECTS = [('EN', 'English', 'English'), ('MA', 'Mathematics', 'Maths'), ('SC', 'Science', 'Science'), ('HI', 'History', 'Humanities'), ('GE', 'Geography', 'Humanities'), ('VA', 'Visual Art', 'Creative Arts'), ('MU', 'Music', 'Creative Arts'), ('PE', 'Physical Education', 'Health'), ('JA', 'Japanese', 'Languages'), ('FR', 'French', 'Languages'), ('DT', 'Digital Technology', 'Technology'), ('BS', 'Business Studies', 'Business'), ('DR', 'Drama', 'Creative Arts'), ('EC', 'Economics', 'Business'), ('CH', 'Chemistry', 'Science'), ('PH', 'Physics', 'Science'), ('BI', 'Biology', 'Science'), ('LS', 'Legal Studies', 'Humanities')]
+JOB_TITLES = ['Teacher', 'Senior Teacher', 'Head of Department', 'Teacher Aide', 'Librarian', 'Guidance Officer']
+TIMETABLE_LINES = 6
+
+
+class _Ids:
+    # Hands out ids for a table starting after the largest id already in the database.
+    def __init__(self, model):
+        self.next = (db.session.scalar(db.select(func.max(model.id))) or 0) + 1
+
+    def take(self):
+        value = self.next
+        self.next += 1
+        return value
+
+
+def _random_date(rng, start, end):
+    return start + timedelta(days=rng.randrange((end - start).days + 1))
+
+
+def _phone(rng):
+    return '04' + ''.join(rng.choice('0123456789') for _ in range(8))
+
+
+# Builds every row for a school with the requested number of students, employees and subjects. Returns a dictionary of table: list of row dictionaries in the order they need to be inserted.
+def generate_school(students, employees, subjects, seed=None):
+    rng = random.Random(seed)
+    today = date.today()
+    address_ids, user_ids, student_ids, employee_ids, relation_ids, enrollment_ids = (_Ids(model) for model in (Address, User, Student, Employee, StudentRelation, Enrollment))
+    existing_subject_ids = set(db.session.scalars(db.select(Subject.id)))
+    existing_class_ids = set(db.session.scalars(db.select(SubjectClass.id)))
+    rows = {table: [] for table in ('addresses', 'users', 'employees', 'students', 'student_relations', 'subjects', 'subject_classes', 'enrollments')}
+
+    def add_address():
+        suburb, postcode = rng.choice(SUBURBS)
+        row = {
+            'id': address_ids.take(),
+            'complex_number': rng.choice([None, None, None, rng.randint(1, 40)]),
+            'street_number': rng.randint(1, 400),
+            'street_name': rng.choice(STREET_NAMES),
+            'suburb': suburb,
+            'postcode': postcode
+        }
+        rows['addresses'].append(row)
+        return row['id']
+
+    def add_user(user_type, address_id, dob, last_name=None, domain='bgbc.edu.au'):
+        user_id = user_ids.take()
+        gender = rng.choice(['female', 'male'])
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = last_name or rng.choice(LAST_NAMES)
+        rows['users'].append({
+            'id': user_id,
+            'title': None if user_type == 'Student' else ('Ms' if gender == 'female' else 'Mr'),
+            'first_name': first_name,
+            'middle_name': rng.choice(FIRST_NAMES),
+            'last_name': last_name,
+            'password': password_hash,
+            'email': f'{first_name}.{last_name}.{user_id}@{domain}'.lower(), # The user id keeps every email address unique
+            'phone': _phone(rng),
+            'dob': dob,
+            'gender': gender,
+            'type': user_type,
+            'address_id': address_id,
+            'token_version': 0
+        })
+        return user_id
+
+    password_hash = hasher.hash_password(SYNTHETIC_PASSWORD)
+
+    # Employees. The first one generated is an admin so the generated school can be managed through the API straight away.
+    for i in range(employees):
+        user_id = add_user('Employee', add_address(), _random_date(rng, date(1960, 1, 1), date(1998, 12, 31)))
+        rows['employees'].append({
+            'id': employee_ids.take(),
+            'hired_date': _random_date(rng, date(2000, 1, 1), today),
+            'job_title': 'Teacher' if i % 5 else rng.choice(JOB_TITLES),
+            'department': rng.choice(SUBJECTS)[2],
+            'is_admin': i == 0,
+            'user_id': user_id
+        })
+
+    # Subjects are spread evenly over year levels 7 to 12. Subject ids follow the existing pattern of a two digit year level and an abbreviation (such as 09EN) with a number added when the id is already taken.
+    subjects_by_year = {year: [] for year in range(7, 13)}
+    for i in range(subjects):
+        year = 7 + i % 6
+        abbreviation, name, department = SUBJECTS[(i // 6) % len(SUBJECTS)]
+        repeat = i // (6 * len(SUBJECTS))
+        subject_id = f'{year:02d}{abbreviation}' + (str(repeat + 1) if repeat else '')
+        counter = 2
+        while subject_id in existing_subject_ids:
+            subject_id = f'{year:02d}{abbreviation}{counter}'
+            counter += 1
+        existing_subject_ids.add(subject_id)
+        row = {
+            'id': subject_id,
+            'name': name + (f' {repeat + 1}' if repeat else ''),
+            'year_level': year,
+            'max_students': rng.choice([24, 25, 26, 28, 30]),
+            'department': department
+        }
+        rows['subjects'].append(row)
+        # Each subject in a year level runs on its own timetable line so a student can take one subject from every line without a clash.
+        row['timetable_line'] = len(subjects_by_year[year]) % TIMETABLE_LINES + 1
+        subjects_by_year[year].append(row)
+
+    # Students, their caregivers and the subjects they choose. Each student lives with their caregivers at one address.
+    choices = {} # subject_id: list of student ids taking that subject
+    for i in range(students):
+        year = 7 + i % 6
+        address_id = add_address()
+        family_name = rng.choice(LAST_NAMES)
+        student_user_id = add_user('Student', address_id, _random_date(rng, date(today.year - year - 6, 1, 1), date(today.year - year - 5, 12, 31)), family_name)
+        student_id = student_ids.take()
+        rows['students'].append({
+            'id': student_id,
+            'homegroup': f'{year:02d}{HOUSES[i % len(HOUSES)]}{(i // 24) % 9 + 1}',
+            'enrollment_date': _random_date(rng, date(today.year - (year - 7), 1, 1), min(today, date(today.year - (year - 7), 2, 28))),
+            'year_level': year,
+            'birth_country': rng.choice(BIRTH_COUNTRIES),
+            'user_id': student_user_id
+        })
+        for caregiver in range(rng.choice([1, 1, 2])):
+            caregiver_user_id = add_user('Caregiver', address_id, _random_date(rng, date(1960, 1, 1), date(1992, 12, 31)), family_name, domain='example.com')
+            rows['student_relations'].append({
+                'id': relation_ids.take(),
+                'relationship_to_student': rng.choice(CAREGIVER_RELATIONSHIPS),
+                'is_primary_contact': caregiver == 0,
+                'user_id': caregiver_user_id,
+                'student_id': student_id
+            })
+        by_line = {}
+        for subject in subjects_by_year[year]:
+            by_line.setdefault(subject['timetable_line'], []).append(subject)
+        for line_subjects in by_line.values():
+            choices.setdefault(rng.choice(line_subjects)['id'], []).append(student_id)
+        rows['students'][-1]['timetable_mask'] = sum(1 << (line - 1) for line in by_line if line is not None) # The student takes one subject on each line their year level has
+
+    # Classes. Each subject gets just enough classes to keep every class at or under the subject's max_students and the students taking it are shared evenly between them.
+    enrollment_date = date(today.year, 1, 30) if today >= date(today.year, 1, 30) else date(today.year - 1, 1, 30)
+    employee_index = 0
+    for subject in rows['subjects']:
+        line = subject.pop('timetable_line')
+        enrolled = choices.get(subject['id'], [])
+        class_count = max(1, math.ceil(len(enrolled) / subject['max_students']))
+        suffix = 0
+        for number in range(class_count):
+            suffix += 1
+            class_id = f"{subject['id']}{suffix:02d}-{enrollment_date.year}"
+            while class_id in existing_class_ids: # Skip over class ids that are already in use
+                suffix += 1
+                class_id = f"{subject['id']}{suffix:02d}-{enrollment_date.year}"
+            existing_class_ids.add(class_id)
+            employee_id = rows['employees'][employee_index % len(rows['employees'])]['id'] if rows['employees'] else None
+            employee_index += 1
+            class_students = enrolled[number::class_count]
+            rows['subject_classes'].append({
+                'id': class_id,
+                'room': f"{rng.choice('ABCDEFGHJK')}{rng.randint(1, 4)}.{rng.randint(1, 9)}",
+                'timetable_line': line,
+                'employee_id': employee_id,
+                'subject_id': subject['id'],
+                'enrollment_count': len(class_students)
+            })
+            for student_id in class_students:
+                rows['enrollments'].append({
+                    'id': enrollment_ids.take(),
+                    'date': enrollment_date,
+                    'subject_class_id': class_id,
+                    'student_id': student_id
+                })
+    return rows
+
+
+# Writes rows to PostgreSQL with COPY, which streams them as CSV in a single command and is much faster than INSERT for large numbers of rows.
+def _copy_rows(connection, table, rows):
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if row[column] is None else row[column] for column in columns]) # An empty unquoted field is read as NULL
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    cursor.close()
+
+
+# Inserts a list of row dictionaries into a table. PostgreSQL uses COPY and other databases use executemany inserts of BATCH_SIZE rows at a time.
+def bulk_insert(table, rows):
+    if not rows:
+        return
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        _copy_rows(connection, table, rows)
+    else:
+        for start in range(0, len(rows), BATCH_SIZE):
+            connection.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+# Moves each PostgreSQL id sequence past the ids that were assigned by the generator so rows created later through the API don't reuse them.
+def _reset_sequences(connection, tables):
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        connection.exec_driver_sql(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+
+
+# Generates and writes a school in a single transaction. Returns the number of rows written to each table.
+def seed_synthetic(students, employees, subjects, seed=None):
+    rows = generate_school(students, employees, subjects, seed)
+    tables = {model.__tablename__: model.__table__ for model in (Address, User, Employee, Student, StudentRelation, Subject, SubjectClass, Enrollment)}
+    for name, table_rows in rows.items():
+        bulk_insert(tables[name], table_rows)
+    _reset_sequences(db.session.connection(), ['addresses', 'users', 'employees', 'students', 'student_relations', 'enrollments'])
+    db.session.commit()
+    return {name: len(table_rows) for name, table_rows in rows.items()}
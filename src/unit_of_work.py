@@ -0,0 +1,64 @@
+# This module gives each request a single database transaction. Routes add, change and delete rows on db.session and call db.session.flush() when they need a new row's id, but they don't commit. When the route returns:
+# - a successful response (below 400) to a request that changes data (anything but GET, HEAD and OPTIONS) commits everything the route did in one commit. A request that turned out not to write anything (such as logging in) doesn't commit at all.
+# - any error response, including those from abort() and the error handlers, rolls everything back so a request that fails halfway doesn't leave some of its rows behind.
+# - an IntegrityError (a duplicate email or a foreign key to a row that doesn't exist), whether it is raised by a flush in the route or by the final commit, is rolled back and returned as a 409 Conflict.
+# Work that should only happen once the change is saved, such as dropping cached copies of the rows that changed, is registered with after_commit() and runs straight after the commit.
+# Long jobs that deliberately commit in chunks (the bulk enrollments route and the CSV import) still commit each chunk themselves; the commit at the end of the request then has nothing left to do.
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class UnitOfWork:
+    def __init__(self, db, instrumentation):
+        self.db = db
+        self.instrumentation = instrumentation # The commit is timed as the commit phase in the Server-Timing header
+
+    # Must be called after every other after_request function is registered: Flask runs them in the reverse order they were added, so the commit happens first and the rest (such as the catalog cache and replica stickiness) see a 409 rather than a 2xx if it fails.
+    def init_app(self, app):
+        # The session records that it has written something when it flushes changes or runs an insert, update or delete statement
+        event.listen(self.db.session, 'after_flush', self._wrote)
+        event.listen(self.db.session, 'do_orm_execute', lambda state: (state.is_insert or state.is_update or state.is_delete) and self._wrote(state.session))
+        app.after_request(self._finish)
+        app.register_error_handler(IntegrityError, self._conflict)
+        app.extensions['unit_of_work'] = self
+
+    def _wrote(self, session, *args):
+        session.info['writes'] = True
+
+    def _finish(self, response):
+        session = self.db.session
+        if response.status_code >= 400:
+            session.rollback()
+            g.pop('after_commit', None)
+            return response
+        wrote = session.info.pop('writes', False) or session.new or session.dirty or session.deleted
+        if request.method in SAFE_METHODS or not wrote:
+            return response
+        try:
+            with self.instrumentation.phase('commit'):
+                session.commit()
+        except IntegrityError as err:
+            return current_app.make_response(self._conflict(err))
+        except Exception:
+            session.rollback()
+            raise
+        for callback in g.pop('after_commit', []):
+            callback()
+        return response
+
+    def _conflict(self, err):
+        self.db.session.info.pop('writes', None)
+        self.db.session.rollback()
+        g.pop('after_commit', None)
+        return {'error': f'The change conflicts with the existing records ({err.orig}).'}, 409
+
+
+# Runs callback once the current request's changes have been committed. Outside a request (for example in a CLI command) it runs straight away.
+def after_commit(callback):
+    if not has_request_context():
+        callback()
+        return
+    g.setdefault('after_commit', []).append(callback)